@@ -0,0 +1,84 @@
+"""
+   Description:
+
+   The cost of recording which API call resources are charged to, and an
+   example of the table it produces.   record_charge() is timed on its own,
+   then tattle_quantity('netsend', 1) is timed with record_charge() replaced
+   by a function that does nothing and with it recording.   Finally two
+   threads make different calls that share a slow resource and the per-call
+   table is printed.
+
+   Usage: python bench_attribution.py [calls]
+"""
+
+import sys
+import time
+import threading
+
+import benchutil
+
+import nanny
+import restrictions
+import resource_attribution
+
+
+def run(name, calls):
+  restrictions.assertisallowed('sendmess')
+  start = time.time()
+  for count in xrange(calls):
+    nanny.tattle_quantity('netsend', 1)
+  elapsed = time.time() - start
+  benchutil.report(name, calls, elapsed, "calls")
+  return elapsed / calls
+
+
+
+def main():
+  calls = 1000000
+  if len(sys.argv) > 1:
+    calls = int(sys.argv[1])
+
+  # lograte is slow so the threads below block on it
+  benchutil.init_restrictions(resources={'lograte':100000})
+
+  recordcharge = resource_attribution.record_charge
+  start = time.time()
+  for count in xrange(calls):
+    recordcharge('netsend', 1, 0.0)
+  benchutil.report("record_charge", calls, time.time() - start, "calls")
+
+  def donothing(resource, quantity, blocked, operations=1):
+    pass
+
+  resource_attribution.record_charge = donothing
+  without = run("tattle_quantity without attribution", calls)
+
+  resource_attribution.record_charge = recordcharge
+  with_attribution = run("tattle_quantity with attribution", calls)
+
+  print "  difference: %.3f usec per tattle" % ((with_attribution - without) * 1000000)
+
+  # Two calls share lograte.   The large writes should be charged most of the
+  # bytes and both should be blocked.
+  def writer(call, size, count):
+    for number in xrange(count):
+      restrictions.assertisallowed(call)
+      reservation = nanny.reserve_quantity('lograte', size)
+      nanny.commit_quantity(reservation, size)
+
+  threads = [threading.Thread(target=writer, args=('log.write', 10000, 30), name="BigWriter"),
+      threading.Thread(target=writer, args=('log.writelines', 100, 300), name="SmallWriter")]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  attribution = resource_attribution.get_call_attribution()
+  print "  %-14s %-10s %10s %12s %10s" % ("call", "resource", "operations", "charged", "blocked")
+  for call in ['log.write', 'log.writelines']:
+    (operations, charged, blocked) = attribution[call]['lograte']
+    print "  %-14s %-10s %10d %12.0f %9.3fs" % (call, 'lograte', operations, charged, blocked)
+
+
+if __name__ == '__main__':
+  main()
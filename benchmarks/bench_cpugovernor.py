@@ -0,0 +1,117 @@
+"""
+   Description:
+
+   Compares the interval and pi CPU governors.   For each CPU limit, a child
+   process that always wants the CPU is kept to the limit the way the
+   resource monitor does it (stopping it with signals) for a while.   As in
+   repy, the CPU the monitoring uses is charged too.   The share of CPU
+   charged overall and in each one second window, the longest stop and how
+   much CPU the monitoring used are printed.   The pi governor's own window
+   statistics are printed too.
+
+   Usage: python bench_cpugovernor.py [seconds] [limit ...]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+import benchutil
+
+import cpu_enforcement
+import linux_api
+import nanny_resource_limits
+import nonportable
+import repy_constants
+
+
+LIMITS = [0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.75, 1.0]
+
+
+def run(governorname, cpulimit, seconds):
+  child = subprocess.Popen([sys.executable, "-c", "while True: pass"])
+  ourpid = os.getpid()
+  backend = cpu_enforcement.SignalCPUBackend(child.pid, cpulimit)
+
+  cpu_enforcement.governor_name = governorname
+  governor = cpu_enforcement.create_governor(cpulimit)
+  if governor is None:
+    interval = repy_constants.CPU_POLLING_FREQ_LINUX
+  else:
+    interval = governor.slicetime
+
+  # Let the child start up
+  time.sleep(0.2)
+
+  ourstart = linux_api.get_process_cpu_time(ourpid)
+  childstart = linux_api.get_process_cpu_time(child.pid)
+  start = nonportable.getruntime()
+
+  windowstart = start
+  windowcpu = ourstart + childstart
+  windowerrors = []
+  longeststop = 0.0
+
+  lasttime = start
+  lastcpu = None
+  while True:
+    now = nonportable.getruntime()
+    if now - start >= seconds:
+      break
+
+    childcpu = linux_api.get_process_cpu_time(child.pid)
+    totalcpu = linux_api.get_process_cpu_time(ourpid) + childcpu
+
+    if now - windowstart >= cpu_enforcement.GOVERNOR_WINDOW:
+      windowerrors.append((totalcpu - windowcpu) / (now - windowstart) - cpulimit)
+      windowstart = now
+      windowcpu = totalcpu
+
+    if governor is None:
+      if lastcpu is None:
+        stoptime = 0.0
+      else:
+        stoptime = nanny_resource_limits.calculate_cpu_sleep_interval(cpulimit, (totalcpu - lastcpu) / (now - lasttime), now - lasttime)
+      lastcpu = totalcpu
+    else:
+      stoptime = governor.get_stop_time(now, totalcpu)
+
+    longeststop = max(longeststop, backend.enforce(stoptime))
+    lasttime = nonportable.getruntime()
+    time.sleep(interval)
+
+  elapsed = nonportable.getruntime() - start
+  monitorcpu = linux_api.get_process_cpu_time(ourpid) - ourstart
+  share = (linux_api.get_process_cpu_time(child.pid) - childstart + monitorcpu) / elapsed
+  child.kill()
+  child.wait()
+
+  abserrors = [abs(error) for error in windowerrors]
+  print "%-8s %5.2f  share %.3f (%+.3f)  window error mean %.3f max %.3f  longest stop %.3fs  monitor cpu %.1f%%" % (
+      governorname, cpulimit, share, share - cpulimit,
+      sum(abserrors) / max(1, len(abserrors)), max(abserrors + [0.0]),
+      longeststop, 100.0 * monitorcpu / elapsed)
+
+  if governor is not None:
+    stats = governor.get_window_stats()
+    print "         governor stats: %d windows, mean error %+.4f, rms %.4f, max %.4f, %d stops in %d updates" % (
+        stats['windows'], stats['meanerror'], stats['rmserror'], stats['maxabserror'], stats['stops'], stats['updates'])
+
+
+
+def main():
+  seconds = 10.0
+  limits = LIMITS
+  if len(sys.argv) > 1:
+    seconds = float(sys.argv[1])
+  if len(sys.argv) > 2:
+    limits = [float(limit) for limit in sys.argv[2:]]
+
+  for cpulimit in limits:
+    for governorname in ["interval", "pi"]:
+      run(governorname, cpulimit, seconds)
+
+
+if __name__ == '__main__':
+  main()
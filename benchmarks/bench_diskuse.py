@@ -0,0 +1,82 @@
+"""
+   Description:
+
+   Compares scanning a vessel directory to find its disk use (what the
+   resource monitor did every half second) with the nanny's running total,
+   which is updated as files are written.   The directory is filled with
+   small files first.   The scans per second and the file writes per second
+   (with and without the running total) are printed.
+
+   Usage: python bench_diskuse.py [files] [scans] [writes]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import benchutil
+
+import nanny
+import nanny_resource_limits
+import nonportable
+import emulfile
+
+
+def main():
+  filecount = 1000
+  scans = 100
+  writes = 100000
+  if len(sys.argv) > 1:
+    filecount = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    scans = int(sys.argv[2])
+  if len(sys.argv) > 3:
+    writes = int(sys.argv[3])
+
+  benchutil.init_restrictions()
+
+  # emulfile only takes file names, so work in the directory
+  startdir = os.getcwd()
+  dirname = tempfile.mkdtemp()
+  os.chdir(dirname)
+  try:
+    for count in xrange(filecount):
+      smallfile = file("file" + str(count), "w")
+      smallfile.write("X" * 100)
+      smallfile.close()
+
+    start = time.time()
+    for count in xrange(scans):
+      filesizes = nonportable.get_disk_file_sizes(dirname)
+      diskused = nanny_resource_limits.calculate_disk_use(filesizes)
+    benchutil.report("scan of " + str(filecount) + " files", scans, time.time() - start, "scans")
+
+    nanny_resource_limits.reconcile_disk_use(diskused, filesizes)
+
+    fileobj = emulfile.emulated_open("written", "w")
+    start = time.time()
+    for count in xrange(writes):
+      fileobj.write("X")
+    benchutil.report("write with running total", writes, time.time() - start, "writes")
+
+    # The same writes without updating the total
+    realextended = nanny.tattle_file_extended
+    nanny.tattle_file_extended = lambda filename, size: None
+    try:
+      start = time.time()
+      for count in xrange(writes):
+        fileobj.write("X")
+      benchutil.report("write without running total", writes, time.time() - start, "writes")
+    finally:
+      nanny.tattle_file_extended = realextended
+    fileobj.close()
+
+  finally:
+    os.chdir(startdir)
+    shutil.rmtree(dirname)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,89 @@
+"""
+   Description:
+
+   Measures how many UDP messages per second recvmess can deliver to a
+   handler when events run on the worker pool and when a thread is started
+   for each event, and the largest number of threads seen while doing so.
+
+   Usage: python bench_eventdelivery.py [messages] [port] [events]
+"""
+
+import sys
+import time
+import socket
+import threading
+
+import benchutil
+
+import emulcomm
+
+
+# The most messages that may be outstanding before the sender waits.   This
+# keeps us from overflowing the socket buffer and dropping messages.
+WINDOW = 200
+
+
+def run(usepool, messagecount, port):
+  emulcomm.use_event_pool = usepool
+
+  received = [0]
+  lastreceived = [0.0]
+  peakthreads = [0]
+  countlock = threading.Lock()
+  done = threading.Event()
+
+  def handler(ip, port, message, commhandle):
+    countlock.acquire()
+    received[0] = received[0] + 1
+    lastreceived[0] = time.time()
+    peakthreads[0] = max(peakthreads[0], threading.activeCount())
+    if received[0] == messagecount:
+      done.set()
+    countlock.release()
+
+  handle = emulcomm.recvmess('127.0.0.1', port, handler)
+
+  sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  start = time.time()
+  for sent in xrange(messagecount):
+    while sent - received[0] > WINDOW:
+      time.sleep(0.0005)
+    sender.sendto("X" * 64, ('127.0.0.1', port))
+
+  # UDP may drop a few messages, so don't wait forever for all of them
+  done.wait(5)
+  elapsed = lastreceived[0] - start
+  sender.close()
+  emulcomm.stopcomm(handle)
+
+  # Let the selector notice that there is nothing left to listen on
+  time.sleep(1)
+
+  if usepool:
+    name = "worker pool"
+  else:
+    name = "thread per event"
+  benchutil.report(name, received[0], elapsed, "msgs")
+  print "  peak thread count:", peakthreads[0]
+
+
+
+def main():
+  messagecount = 20000
+  port = 12345
+  events = 10
+  if len(sys.argv) > 1:
+    messagecount = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    port = int(sys.argv[2])
+  if len(sys.argv) > 3:
+    events = int(sys.argv[3])
+
+  benchutil.init_restrictions(resources={'events':events}, ports=[port])
+
+  run(False, messagecount, port)
+  run(True, messagecount, port)
+
+
+if __name__ == '__main__':
+  main()
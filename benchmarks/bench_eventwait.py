@@ -0,0 +1,86 @@
+"""
+   Description:
+
+   Measures how quickly a thread waiting for an event (because the program
+   is at its events limit) gets one after another thread releases it.   Each
+   thread repeatedly takes an event with wait_for_event, holds it briefly and
+   releases it, so most of the threads are always waiting.   The events per
+   second and the mean and largest time from a release to the next thread
+   getting the event are printed.
+
+   Usage: python bench_eventwait.py [threads] [events] [seconds]
+"""
+
+import sys
+import time
+import threading
+
+import benchutil
+
+import emulcomm
+import nanny
+
+
+# How long each thread holds its event
+HOLD_TIME = 0.001
+
+
+def main():
+  threadcount = 16
+  events = 2
+  seconds = 5.0
+  if len(sys.argv) > 1:
+    threadcount = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    events = int(sys.argv[2])
+  if len(sys.argv) > 3:
+    seconds = float(sys.argv[3])
+
+  benchutil.init_restrictions(resources={'events':events})
+
+  # When each event was last released and how long each wait after a
+  # release took
+  releasetimes = []
+  latencies = []
+  statlock = threading.Lock()
+  stoptime = time.time() + seconds
+
+  def worker(number):
+    count = 0
+    while time.time() < stoptime:
+      eventname = "bench" + str(number) + "_" + str(count)
+      count = count + 1
+      emulcomm.wait_for_event(eventname)
+      gottime = time.time()
+
+      statlock.acquire()
+      if releasetimes:
+        latencies.append(gottime - releasetimes.pop(0))
+      statlock.release()
+
+      time.sleep(HOLD_TIME)
+
+      statlock.acquire()
+      releasetimes.append(time.time())
+      statlock.release()
+      nanny.tattle_remove_item('events', eventname)
+
+  threads = []
+  for number in xrange(threadcount):
+    threads.append(threading.Thread(target=worker, args=(number,)))
+
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+
+  benchutil.report(str(threadcount) + " threads, " + str(events) + " events", len(latencies), elapsed, "events")
+  if latencies:
+    print "  mean wake latency: %.3f ms" % (1000.0 * sum(latencies) / len(latencies))
+    print "  max wake latency:  %.3f ms" % (1000.0 * max(latencies))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,59 @@
+"""
+   Description:
+
+   Measures how many getruntime() calls per second a number of threads can
+   make together, using the uptime based getruntime (a lock, reading
+   /proc/uptime and checking time.time() for skew) and the monotonic clock
+   version used on Linux.
+
+   Usage: python bench_getruntime.py [threads] [calls per thread]
+"""
+
+import sys
+import time
+import threading
+
+import benchutil
+
+import nonportable
+
+
+def run(name, function, threadcount, calls):
+  def caller():
+    for count in xrange(calls):
+      function()
+
+  threads = []
+  for number in xrange(threadcount):
+    threads.append(threading.Thread(target=caller))
+
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+
+  benchutil.report(name, threadcount * calls, elapsed, "calls")
+
+
+
+def main():
+  threadcount = 16
+  calls = 20000
+  if len(sys.argv) > 1:
+    threadcount = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    calls = int(sys.argv[2])
+
+  name = str(threadcount) + " threads, "
+  run(name + "uptime", nonportable.getruntime_uptime, threadcount, calls)
+
+  if nonportable.getruntime == nonportable.getruntime_monotonic:
+    run(name + "monotonic clock", nonportable.getruntime_monotonic, threadcount, calls)
+  else:
+    print "There is no monotonic clock, so getruntime uses uptime"
+
+
+if __name__ == '__main__':
+  main()
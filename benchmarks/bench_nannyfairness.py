@@ -0,0 +1,92 @@
+"""
+   Description:
+
+   Many threads charging the same renewable resources as fast as they can.
+   N threads call tattle_quantity('netsend', ...) and N more call
+   tattle_quantity('filewrite', ...) for a few seconds.   For each resource
+   this prints the total charged per second (which should be close to the
+   limit), Jain's fairness index of the per-thread totals (1.0 means every
+   thread got the same share) and the longest a single call took.
+
+   Usage: python bench_nannyfairness.py [threads] [seconds] [chunk]
+"""
+
+import sys
+import time
+import threading
+
+import benchutil
+
+import nanny
+
+
+# The limits (bytes per second) of the resources being charged
+LIMIT = 1000000
+
+RESOURCES = ['netsend', 'filewrite']
+
+
+def fairness(totals):
+  # Jain's fairness index
+  squares = sum([total * total for total in totals])
+  if squares == 0:
+    return 0.0
+  return float(sum(totals)) ** 2 / (len(totals) * squares)
+
+
+
+def main():
+  threadcount = 16
+  seconds = 5.0
+  chunk = 1000
+  if len(sys.argv) > 1:
+    threadcount = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    seconds = float(sys.argv[2])
+  if len(sys.argv) > 3:
+    chunk = int(sys.argv[3])
+
+  resources = {}
+  for resource in RESOURCES:
+    resources[resource] = LIMIT
+  benchutil.init_restrictions(resources=resources)
+
+  stop = threading.Event()
+  totals = {}
+  longest = {}
+  for resource in RESOURCES:
+    totals[resource] = [0] * threadcount
+    longest[resource] = 0.0
+
+  def hammer(resource, index):
+    while not stop.isSet():
+      start = time.time()
+      nanny.tattle_quantity(resource, chunk)
+      longest[resource] = max(longest[resource], time.time() - start)
+      totals[resource][index] = totals[resource][index] + chunk
+
+  # Use up the burst allowance first, so that the first threads to start
+  # don't get it all and what's measured is the threads taking turns.
+  for resource in RESOURCES:
+    nanny.tattle_quantity(resource, LIMIT)
+
+  threads = []
+  for resource in RESOURCES:
+    for index in xrange(threadcount):
+      threads.append(threading.Thread(target=hammer, args=(resource, index)))
+
+  for thread in threads:
+    thread.start()
+  time.sleep(seconds)
+  stop.set()
+  for thread in threads:
+    thread.join()
+
+  for resource in RESOURCES:
+    name = resource + " (" + str(threadcount) + " threads)"
+    benchutil.report(name, sum(totals[resource]), seconds, "bytes")
+    print "  fairness: %.3f   slowest share: %d   fastest share: %d   longest call: %.3fs" % (fairness(totals[resource]), min(totals[resource]), max(totals[resource]), longest[resource])
+
+
+if __name__ == '__main__':
+  main()
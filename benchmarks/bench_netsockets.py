@@ -0,0 +1,81 @@
+"""
+   Description:
+
+   Measures the cost of one exists_listening_network_socket() and one
+   exists_outgoing_network_socket() call when netstat is run (nix_common_api)
+   and when /proc/net is parsed (linux_api), both with and without the
+   snapshot cache.   Each case is run against one listening TCP socket and
+   one established connection on loopback.
+
+   Usage: python bench_netsockets.py [calls] [port]
+"""
+
+import sys
+import time
+import socket
+
+import benchutil
+
+import nix_common_api
+import linux_api
+
+
+def run(name, calls, function, *args):
+  start = time.time()
+  for count in xrange(calls):
+    function(*args)
+  benchutil.report(name, calls, time.time() - start, "calls")
+
+
+
+def uncached_listening(ip, port, tcp):
+  linux_api.socket_snapshot = None
+  return linux_api.exists_listening_network_socket(ip, port, tcp)
+
+
+
+def uncached_outgoing(localip, localport, remoteip, remoteport):
+  linux_api.socket_snapshot = None
+  return linux_api.exists_outgoing_network_socket(localip, localport, remoteip, remoteport)
+
+
+
+def main():
+  calls = 1000
+  port = 12345
+  if len(sys.argv) > 1:
+    calls = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    port = int(sys.argv[2])
+
+  listensocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listensocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listensocket.bind(('127.0.0.1', port))
+  listensocket.listen(1)
+  client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  client.connect(('127.0.0.1', port))
+  server, addr = listensocket.accept()
+  localport = client.getsockname()[1]
+
+  listenargs = ('127.0.0.1', port, True)
+  outgoingargs = ('127.0.0.1', localport, '127.0.0.1', port)
+
+  # netstat is slow, so don't run it as often
+  netstatcalls = max(1, calls / 100)
+  run("netstat listening", netstatcalls, nix_common_api.exists_listening_network_socket, *listenargs)
+  run("netstat outgoing", netstatcalls, nix_common_api.exists_outgoing_network_socket, *outgoingargs)
+
+  run("/proc/net listening", calls, uncached_listening, *listenargs)
+  run("/proc/net outgoing", calls, uncached_outgoing, *outgoingargs)
+
+  # A socket that doesn't exist is answered from the snapshot
+  run("/proc/net cached listening (missing)", calls, linux_api.exists_listening_network_socket, '127.0.0.1', port + 1, True)
+  run("/proc/net cached outgoing (missing)", calls, linux_api.exists_outgoing_network_socket, '127.0.0.1', localport, '127.0.0.1', port + 1)
+
+  client.close()
+  server.close()
+  listensocket.close()
+
+
+if __name__ == '__main__':
+  main()
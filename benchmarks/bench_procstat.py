@@ -0,0 +1,64 @@
+"""
+   Description:
+
+   Measures how many CPU and memory samples per second can be taken from
+   /proc/PID/stat, the way the resource monitor takes them each tick:
+   get_process_cpu_time() followed by get_process_rss().   For comparison,
+   the file is also opened, read and split into every field for each sample,
+   which is what linux_api used to do.   The thread CPU time is timed too.
+
+   Usage: python bench_procstat.py [samples]
+"""
+
+import os
+import sys
+import time
+
+import benchutil
+
+import linux_api
+
+
+# The old way: open the file for every sample and split the whole line
+def open_and_split(pid):
+  fileo = open("/proc/" + str(pid) + "/stat", "r")
+  data = fileo.read()
+  fileo.close()
+  data = data.strip("\n")
+  start_index = data.find("(")
+  if start_index != -1:
+    end_index = data.find(")", start_index)
+    data = data[:start_index-1] + data[end_index+1:]
+  fields = data.split(" ")
+  cputime = (int(fields[linux_api.FIELDS["utime"]]) + int(fields[linux_api.FIELDS["stime"]])) / linux_api.JIFFIES_PER_SECOND
+  rss = int(fields[linux_api.FIELDS["rss"]]) * linux_api.PAGE_SIZE
+  return (cputime, rss)
+
+
+
+def main():
+  samples = 200000
+  if len(sys.argv) > 1:
+    samples = int(sys.argv[1])
+
+  pid = os.getpid()
+
+  start = time.time()
+  for count in xrange(samples):
+    open_and_split(pid)
+  benchutil.report("open, read and split", samples, time.time() - start, "samples")
+
+  start = time.time()
+  for count in xrange(samples):
+    linux_api.get_process_cpu_time(pid)
+    linux_api.get_process_rss()
+  benchutil.report("kept open", samples, time.time() - start, "samples")
+
+  start = time.time()
+  for count in xrange(samples):
+    linux_api.get_current_thread_cpu_time()
+  benchutil.report("thread cpu time", samples, time.time() - start, "samples")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,95 @@
+"""
+   Description:
+
+   Compares socket.recv() with socket.recv_into() for loopback TCP transfers
+   of 1MB to 100MB.   Both are called through the namespace wrappers, just as
+   user code would call them.   recv() collects the strings and joins them at
+   the end, recv_into() fills one buffer.
+
+   Usage: python bench_recv.py [port]
+"""
+
+import sys
+import time
+import socket
+import threading
+
+import benchutil
+
+import namespace
+
+
+CHUNKSIZE = 65536
+
+SIZES = [1024*1024, 10*1024*1024, 100*1024*1024]
+
+
+# Sends size bytes to the first connection on listensocket
+def serve(listensocket, size):
+  conn, addr = listensocket.accept()
+  block = "X" * CHUNKSIZE
+  sent = 0
+  while sent < size:
+    sent = sent + conn.send(block[:min(CHUNKSIZE, size - sent)])
+  conn.close()
+
+
+
+def transfer(context, port, size, receive):
+  listensocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listensocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listensocket.bind(('127.0.0.1', port))
+  listensocket.listen(1)
+  server = threading.Thread(target=serve, args=(listensocket, size))
+  server.start()
+
+  sockobj = context['openconn']('127.0.0.1', port)
+  start = time.time()
+  receive(context, sockobj, size)
+  elapsed = time.time() - start
+
+  sockobj.close()
+  server.join()
+  listensocket.close()
+  return elapsed
+
+
+
+def receive_with_recv(context, sockobj, size):
+  chunks = []
+  received = 0
+  while received < size:
+    data = sockobj.recv(CHUNKSIZE)
+    chunks.append(data)
+    received = received + len(data)
+  return "".join(chunks)
+
+
+
+def receive_with_recv_into(context, sockobj, size):
+  buf = context['createbuffer'](size)
+  received = 0
+  while received < size:
+    received = received + sockobj.recv_into(buf, min(CHUNKSIZE, size - received), received)
+  return buf
+
+
+
+def main():
+  port = 12345
+  if len(sys.argv) > 1:
+    port = int(sys.argv[1])
+
+  benchutil.init_restrictions(ports=[port])
+
+  context = {}
+  namespace.wrap_and_insert_api_functions(context)
+
+  for size in SIZES:
+    for (name, receive) in [("recv", receive_with_recv), ("recv_into", receive_with_recv_into)]:
+      elapsed = transfer(context, port, size, receive)
+      benchutil.report(name + " " + str(size / (1024*1024)) + "MB", size / (1024*1024), elapsed, "MB")
+
+
+if __name__ == '__main__':
+  main()
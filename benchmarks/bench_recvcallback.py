@@ -0,0 +1,146 @@
+"""
+   Description:
+
+   An echo server for many loopback clients, written two ways: with a
+   thread (event) per connection blocked in recv(), and with
+   setrecvcallback() so the SocketSelector reports data and only the
+   connections with data use an event.   The clients are plain sockets
+   driven by one thread.   Each round every client sends a message and waits
+   for the echo.   The echoes per second and the largest number of threads
+   seen are printed.
+
+   The restriction tables can only be set up once, so each server runs in
+   its own process.
+
+   Usage: python bench_recvcallback.py [clients] [rounds] [port]
+"""
+
+import sys
+import time
+import subprocess
+import socket
+import select
+import threading
+
+import benchutil
+
+import emulcomm
+
+
+MESSAGE = "X" * 64
+
+# How many connections may wait to be accepted
+LISTEN_BACKLOG = 4
+
+
+def run(usecallback, clientcount, rounds, port):
+  peakthreads = [0]
+
+  def echo(sockobj):
+    peakthreads[0] = max(peakthreads[0], threading.activeCount())
+    try:
+      data = sockobj.recv(1024)
+    except Exception:
+      sockobj.close()
+      return
+    sockobj.send(data)
+
+  def echoloop(sockobj):
+    while True:
+      try:
+        data = sockobj.recv(1024)
+      except Exception:
+        sockobj.close()
+        return
+      peakthreads[0] = max(peakthreads[0], threading.activeCount())
+      sockobj.send(data)
+
+  accepted = [0]
+  def newconn(remoteip, remoteport, sockobj, thiscommhandle, listencommhandle):
+    accepted[0] = accepted[0] + 1
+    if usecallback:
+      sockobj.setrecvcallback(echo)
+    else:
+      echoloop(sockobj)
+
+  handle = emulcomm.waitforconn('127.0.0.1', port, newconn)
+
+  clients = []
+  for count in xrange(clientcount):
+    clients.append(socket.create_connection(('127.0.0.1', port)))
+
+    # waitforconn's listen backlog is small.   Connections that overflow it
+    # are retried by TCP after a second or more, so don't get too far ahead.
+    while len(clients) - accepted[0] > LISTEN_BACKLOG:
+      time.sleep(0.0005)
+
+  poller = select.epoll()
+  for client in clients:
+    poller.register(client.fileno(), select.EPOLLIN)
+
+  start = time.time()
+  echoes = 0
+  for round in xrange(rounds):
+    for client in clients:
+      client.sendall(MESSAGE)
+
+    # Wait for every client's echo
+    waiting = dict([(client.fileno(), len(MESSAGE)) for client in clients])
+    byfd = dict([(client.fileno(), client) for client in clients])
+    while waiting:
+      for (fd, eventmask) in poller.poll(5):
+        if fd in waiting:
+          waiting[fd] = waiting[fd] - len(byfd[fd].recv(4096))
+          if waiting[fd] <= 0:
+            del waiting[fd]
+            echoes = echoes + 1
+  elapsed = time.time() - start
+
+  poller.close()
+  for client in clients:
+    client.close()
+  emulcomm.stopcomm(handle)
+
+  # Let the server notice the clients went away
+  time.sleep(2)
+
+  if usecallback:
+    name = "setrecvcallback"
+  else:
+    name = "thread per connection"
+  benchutil.report(name, echoes, elapsed, "echoes")
+  print "  peak thread count:", peakthreads[0]
+
+
+
+def main():
+  clientcount = 1000
+  rounds = 20
+  port = 12345
+  if len(sys.argv) > 1:
+    clientcount = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    rounds = int(sys.argv[2])
+  if len(sys.argv) > 3:
+    port = int(sys.argv[3])
+
+  # Run each server in a child process
+  if len(sys.argv) <= 4:
+    for mode in ["thread", "callback"]:
+      subprocess.call([sys.executable, sys.argv[0], str(clientcount), str(rounds), str(port), mode])
+    return
+
+  usecallback = (sys.argv[4] == "callback")
+
+  # The thread per connection server needs an event for every client
+  if usecallback:
+    events = 10
+  else:
+    events = clientcount + 10
+
+  benchutil.init_restrictions(resources={'events':events, 'insockets':clientcount + 10}, ports=[port])
+  run(usecallback, clientcount, rounds, port)
+
+
+if __name__ == '__main__':
+  main()
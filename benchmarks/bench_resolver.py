@@ -0,0 +1,91 @@
+"""
+   Description:
+
+   Measures gethostbyname_ex with the resolver cache.   The real resolver is
+   replaced with a local stand-in that sleeps for a fixed latency, so no
+   network is needed.   A workload that resolves a few names over and over
+   is run with the cache on and with the TTL set to 0 (every call misses),
+   and the hit / miss counters and the look ups charged to netsend are
+   printed for each.
+
+   Usage: python bench_resolver.py [calls] [names] [latency]
+"""
+
+import sys
+import time
+import socket
+
+import benchutil
+
+import emulcomm
+import nonportable
+import nanny
+
+
+def make_resolver(latency, lookups):
+  # A stand-in for socket.gethostbyname_ex.   Names starting with "missing"
+  # don't exist.
+  def resolver(name):
+    lookups[0] = lookups[0] + 1
+    time.sleep(latency)
+    if name.startswith("missing"):
+      raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+    return (name, [], ["10.0.0." + str(len(name) % 250)])
+  return resolver
+
+
+
+def run(name, calls, names, latency, ttl):
+  lookups = [0]
+  emulcomm.resolver_cache = emulcomm.ResolverCache(make_resolver(latency, lookups), ttl=ttl, negativettl=ttl)
+  nonportable.resolver_cache_stats['resolverhits'] = 0
+  nonportable.resolver_cache_stats['resolvermisses'] = 0
+
+  charged = [0]
+  realtattle = nanny.tattle_quantity
+  def tattle_quantity(resource, quantity):
+    if resource == 'netsend':
+      charged[0] = charged[0] + 1
+    realtattle(resource, quantity)
+  nanny.tattle_quantity = tattle_quantity
+
+  start = time.time()
+  try:
+    for count in xrange(calls):
+      hostname = "host" + str(count % names) + ".example.com"
+      if count % 10 == 9:
+        hostname = "missing" + str(count % names) + ".example.com"
+      try:
+        emulcomm.gethostbyname_ex(hostname)
+      except socket.gaierror:
+        pass
+  finally:
+    nanny.tattle_quantity = realtattle
+  elapsed = time.time() - start
+
+  benchutil.report(name, calls, elapsed, "lookups")
+  print "  hits: %d  misses: %d  resolver calls: %d  charged: %d" % (
+      nonportable.resolver_cache_stats['resolverhits'],
+      nonportable.resolver_cache_stats['resolvermisses'], lookups[0], charged[0])
+
+
+
+def main():
+  calls = 2000
+  names = 20
+  latency = 0.002
+  if len(sys.argv) > 1:
+    calls = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    names = int(sys.argv[2])
+  if len(sys.argv) > 3:
+    latency = float(sys.argv[3])
+
+  benchutil.init_restrictions()
+
+  run("no cache (ttl 0)", calls, names, latency, 0.0)
+  run("cache", calls, names, latency, emulcomm.RESOLVER_CACHE_TTL)
+
+
+if __name__ == '__main__':
+  main()
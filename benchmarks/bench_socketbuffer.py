@@ -0,0 +1,95 @@
+"""
+   Description:
+
+   Loopback TCP throughput for different socket buffer sizes.   A connection
+   from openconn() sends to one from waitforconn(), both through the emulated
+   socket objects, so send() trimming messages to the send buffer size is
+   included.   Each fixed size (the tcpbuffer resource) is run, then
+   auto-tuning (tcpbuffermax) starting from the default size.
+
+   The restriction tables can only be set up once, so each run is in its own
+   process.
+
+   Usage: python bench_socketbuffer.py [megabytes] [port]
+"""
+
+import sys
+import time
+import subprocess
+import threading
+
+import benchutil
+
+import emulcomm
+
+
+BUFFER_SIZES = [0, 16384, 65536, 262144, 1048576]
+
+# The largest size auto-tuning may use
+AUTOTUNE_MAX = 1048576
+
+MESSAGE = "X" * 1048576
+
+
+def run(name, totalbytes, port):
+  done = threading.Event()
+  received = [0]
+
+  def newconn(remoteip, remoteport, sockobj, thiscommhandle, listencommhandle):
+    while received[0] < totalbytes:
+      received[0] = received[0] + len(sockobj.recv(1048576))
+    done.set()
+    sockobj.close()
+
+  handle = emulcomm.waitforconn('127.0.0.1', port, newconn)
+  sockobj = emulcomm.openconn('127.0.0.1', port)
+
+  start = time.time()
+  sent = 0
+  sends = 0
+  while sent < totalbytes:
+    sent = sent + sockobj.send(MESSAGE[:totalbytes - sent])
+    sends = sends + 1
+  done.wait()
+  elapsed = time.time() - start
+
+  sockobj.close()
+  emulcomm.stopcomm(handle)
+
+  benchutil.report(name, totalbytes / 1048576, elapsed, "MB")
+  print "  send() calls:", sends
+
+
+
+def main():
+  megabytes = 200
+  port = 12345
+  if len(sys.argv) > 1:
+    megabytes = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    port = int(sys.argv[2])
+
+  # Run each size in a child process
+  if len(sys.argv) <= 3:
+    for size in BUFFER_SIZES:
+      subprocess.call([sys.executable, sys.argv[0], str(megabytes), str(port), str(size)])
+    subprocess.call([sys.executable, sys.argv[0], str(megabytes), str(port), "autotune"])
+    return
+
+  if sys.argv[3] == "autotune":
+    name = "auto-tuned up to " + str(AUTOTUNE_MAX)
+    resources = {'tcpbuffermax':AUTOTUNE_MAX}
+  else:
+    size = int(sys.argv[3])
+    if size:
+      name = "tcpbuffer " + str(size)
+    else:
+      name = "tcpbuffer default (" + str(emulcomm.DEFAULT_TCP_BUFFER_SIZE) + ")"
+    resources = {'tcpbuffer':size}
+
+  benchutil.init_restrictions(resources=resources, ports=[port])
+  run(name, megabytes * 1048576, port)
+
+
+if __name__ == '__main__':
+  main()
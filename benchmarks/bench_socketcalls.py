@@ -0,0 +1,67 @@
+"""
+   Description:
+
+   The per-call cost of send() and recv() on an emulated socket for small
+   messages, where the work done before any bytes move (finding the real
+   socket, deciding which resource to charge, checking the call is allowed)
+   matters most.   One thread sends small messages over a loopback
+   connection and another receives them.   The resource limits are large,
+   so the nanny doesn't make either side sleep.
+
+   Usage: python bench_socketcalls.py [messages] [port]
+"""
+
+import sys
+import time
+import threading
+
+import benchutil
+
+import emulcomm
+
+
+MESSAGE = "X" * 16
+
+
+def main():
+  messages = 200000
+  port = 12345
+  if len(sys.argv) > 1:
+    messages = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    port = int(sys.argv[2])
+
+  benchutil.init_restrictions(ports=[port])
+
+  totalbytes = messages * len(MESSAGE)
+  done = threading.Event()
+  recvcalls = [0]
+
+  def newconn(remoteip, remoteport, sockobj, thiscommhandle, listencommhandle):
+    received = 0
+    while received < totalbytes:
+      received = received + len(sockobj.recv(len(MESSAGE)))
+      recvcalls[0] = recvcalls[0] + 1
+    done.set()
+
+  handle = emulcomm.waitforconn('127.0.0.1', port, newconn)
+  sockobj = emulcomm.openconn('127.0.0.1', port)
+
+  start = time.time()
+  sendcalls = 0
+  for count in xrange(messages):
+    sockobj.send(MESSAGE)
+    sendcalls = sendcalls + 1
+  sendelapsed = time.time() - start
+  done.wait()
+  elapsed = time.time() - start
+
+  benchutil.report("send() of " + str(len(MESSAGE)) + " bytes", sendcalls, sendelapsed, "calls")
+  benchutil.report("recv() of up to " + str(len(MESSAGE)) + " bytes", recvcalls[0], elapsed, "calls")
+
+  sockobj.close()
+  emulcomm.stopcomm(handle)
+
+
+if __name__ == '__main__':
+  main()
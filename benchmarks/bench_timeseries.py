@@ -0,0 +1,78 @@
+"""
+   Description:
+
+   The cost the resource time series recorder adds to tattle_quantity().
+   record_use() (what a tattle that doesn't sleep adds) is timed on its
+   own.   Then tattle_quantity('netsend', 1) is timed with record_use()
+   replaced by a function that does nothing, and with the recorder (sampling
+   every 100ms).   Then the samples are dumped to a file, read back and the
+   newest netsend sample is printed.
+
+   Usage: python bench_timeseries.py [calls]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import benchutil
+
+import nanny
+import nonportable
+import resource_timeseries
+
+
+def run(name, calls):
+  start = time.time()
+  for count in xrange(calls):
+    nanny.tattle_quantity('netsend', 1)
+  elapsed = time.time() - start
+  benchutil.report(name, calls, elapsed, "calls")
+  return elapsed / calls
+
+
+
+def main():
+  calls = 1000000
+  if len(sys.argv) > 1:
+    calls = int(sys.argv[1])
+
+  benchutil.init_restrictions()
+
+  recorduse = resource_timeseries.record_use
+  start = time.time()
+  for count in xrange(calls):
+    recorduse('netsend', 1)
+  benchutil.report("record_use", calls, time.time() - start, "calls")
+
+  def donothing(resource, amount):
+    pass
+
+  resource_timeseries.record_use = donothing
+  without = run("tattle_quantity without recording", calls)
+
+  resource_timeseries.record_use = recorduse
+  resource_timeseries.start_recording(nonportable.getruntime, interval=0.1)
+  with_recording = run("tattle_quantity with recording", calls)
+
+  print "  difference: %.3f usec per tattle" % ((with_recording - without) * 1000000)
+
+  (fd, filename) = tempfile.mkstemp()
+  os.close(fd)
+  try:
+    resource_timeseries.dump_timeseries(filename)
+    (interval, samples) = resource_timeseries.load_timeseries(filename)
+    print "  dump: %d bytes, %d resources, %d netsend samples" % (os.path.getsize(filename), len(samples), len(samples['netsend']))
+    if samples['netsend']:
+      print "  newest netsend sample (time, rate, blocked):", samples['netsend'][-1]
+  finally:
+    os.remove(filename)
+
+  # Like repy, exit without waiting for the sampling thread
+  sys.stdout.flush()
+  os._exit(0)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,101 @@
+"""
+   Description:
+
+   Helpers for the benchmarks in this directory.   The benchmarks import the
+   repy modules directly (from the parent directory) and set up the
+   restriction and resource tables without starting the resource nanny, so
+   what they measure is the cost of the code itself.
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+# The repy modules live in the parent directory
+REPY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPY_DIR not in sys.path:
+  sys.path.insert(0, REPY_DIR)
+
+import restrictions
+import nanny
+
+
+# Used unless a benchmark asks for something else.   The rates are large so
+# that the benchmarks don't measure sleeping in the nanny.
+DEFAULT_RESOURCES = {
+  'cpu':1.0,
+  'memory':100000000,
+  'diskused':100000000,
+  'events':10,
+  'filewrite':1000000000,
+  'fileread':1000000000,
+  'filesopened':5,
+  'insockets':10,
+  'outsockets':10,
+  'netsend':1000000000,
+  'netrecv':1000000000,
+  'loopsend':1000000000,
+  'looprecv':1000000000,
+  'lograte':1000000000,
+  'random':1000000000,
+}
+
+
+def init_restrictions(resources=None, ports=[12345], extralines=[]):
+  """
+  <Purpose>
+    Sets up the restriction and consumption tables.   Every call is allowed.
+
+  <Arguments>
+    resources:
+      A dict of resource -> limit that overrides DEFAULT_RESOURCES.
+    ports:
+      The ports that may be used as messport and connport.
+    extralines:
+      Additional lines to add to the restrictions file.
+
+  <Returns>
+    None.
+  """
+  limits = DEFAULT_RESOURCES.copy()
+  if resources:
+    limits.update(resources)
+
+  lines = []
+  for resource in limits:
+    lines.append("resource " + resource + " " + str(limits[resource]))
+  for port in ports:
+    lines.append("resource messport " + str(port))
+    lines.append("resource connport " + str(port))
+  lines = lines + extralines
+  for callname in restrictions.known_calls:
+    lines.append("call " + callname + " allow")
+
+  (fd, filename) = tempfile.mkstemp()
+  try:
+    os.write(fd, "\n".join(lines) + "\n")
+    os.close(fd)
+    restrictions.init_restriction_tables(filename)
+  finally:
+    os.remove(filename)
+
+  nanny.initialize_consumed_resource_tables()
+
+
+
+def report(name, count, elapsed, unit="ops"):
+  # Prints a result line
+  if elapsed > 0:
+    rate = count / elapsed
+  else:
+    rate = 0.0
+  print "%-40s %10d %s in %8.3fs  %12.1f %s/sec" % (name, count, unit, elapsed, rate, unit)
+
+
+
+def timeit(function, *args):
+  # Returns how long it took to call function(*args)
+  start = time.time()
+  function(*args)
+  return time.time() - start
@@ -0,0 +1,431 @@
+"""
+   Program: cpu_enforcement.py
+
+   Description:
+
+   This module has the ways (backends) the resource monitor can keep the
+   repy process to its CPU limit.   Each tick the monitor works out how
+   long repy should be stopped for (see
+   nanny_resource_limits.calculate_cpu_sleep_interval) and passes it to the
+   backend's enforce() method.   enforce() returns how long repy was
+   actually stopped or throttled, which the monitor reports to repy on the
+   "repystopped" channel.
+
+   The backends are:
+     signal:  Stops repy with SIGSTOP, sleeps and continues it with
+              SIGCONT.   This is the default.
+     cgroup:  Moves repy into a delegated cgroup v2 directory and sets its
+              cpu.max, so the kernel throttles repy's threads itself and
+              the process is never stopped as a whole.   The time reported
+              is the throttled time from the cgroup's cpu.stat.
+
+   Use create_backend() to make the backend chosen by backend_name (repy's
+   --cpubackend and --cgroupdir options set it).
+
+   How long to stop repy for is worked out by a governor.   By default
+   ("interval") the monitor checks every CPU_POLLING_FREQ_LINUX seconds and
+   stops repy long enough to make up for the CPU it used in that interval.
+   The "pi" governor (PICPUGovernor) checks much more often and stops repy
+   for many short slices.   It keeps track of the CPU used over budget
+   since the start and stops repy in proportion to it and to how fast repy
+   is using CPU.   It also keeps statistics of how far the share of CPU
+   repy got in each window was from its limit.   The resource monitor sends
+   them to repy on the "cpuwindowstats" channel after each window (see
+   nonportable.get_cpu_window_stats).
+"""
+
+# For stopping repy and the cgroup files
+import os
+import signal
+
+# For sleeping while repy is stopped
+import time
+
+# The sandbox removes the open builtin, so keep the real file type
+myfile = file
+
+
+
+# The cpu.max period in microseconds.   The kernel allows 1000 to 1000000.
+CGROUP_PERIOD = 100000
+
+# The smallest quota the kernel accepts, in microseconds
+CGROUP_MIN_QUOTA = 1000
+
+# Which backend create_backend() makes and where the cgroup backend's
+# directory is.   Set by repy's --cpubackend and --cgroupdir options.
+DEFAULT_BACKEND = "signal"
+backend_name = DEFAULT_BACKEND
+cgroup_directory = None
+
+# How often the pi governor checks (seconds) and how much weight it gives
+# to how fast repy is using CPU (proportional) and to the CPU it has used
+# over budget (integral)
+GOVERNOR_SLICE = 0.01
+GOVERNOR_PROPORTIONAL_GAIN = 0.5
+GOVERNOR_INTEGRAL_GAIN = 0.5
+
+# The pi governor's longest stop, as a multiple of the stop that a
+# program that always wants the CPU needs each slice.   Anything over this
+# is left for the next slices.
+GOVERNOR_MAX_STOP_FACTOR = 2.0
+
+# The pi governor's error statistics are for windows of this many seconds.
+# The errors of the newest GOVERNOR_WINDOW_HISTORY windows are kept.
+GOVERNOR_WINDOW = 1.0
+GOVERNOR_WINDOW_HISTORY = 600
+
+# Which governor create_governor() makes.   Set by repy's --cpugovernor
+# option.
+DEFAULT_GOVERNOR = "interval"
+governor_name = DEFAULT_GOVERNOR
+
+
+
+class SignalCPUBackend:
+  """
+  Enforces the CPU limit by stopping the whole repy process.
+  """
+  def __init__(self, pid, cpulimit):
+    self.pid = pid
+    self.cpulimit = cpulimit
+
+
+  def start(self):
+    pass
+
+
+  def enforce(self, stoptime):
+    if stoptime <= 0.0:
+      return 0.0
+
+    # They must be punished by stopping
+    os.kill(self.pid, signal.SIGSTOP)
+
+    # Sleep until time to resume
+    time.sleep(stoptime)
+
+    # And now they can start back up!
+    os.kill(self.pid, signal.SIGCONT)
+
+    return stoptime
+
+
+
+class CgroupCPUBackend:
+  """
+  Enforces the CPU limit with a cgroup v2 cpu.max.   The directory must be
+  a cgroup that the monitor may write to (delegated to it) with the cpu
+  controller enabled.
+  """
+  def __init__(self, pid, cpulimit, directory, period=CGROUP_PERIOD):
+    self.pid = pid
+    self.cpulimit = cpulimit
+    self.directory = directory
+    self.period = period
+
+    # The cgroup's throttled_usec when enforce() last looked
+    self.lastthrottled = 0
+
+
+  def start(self):
+    check_cgroup_directory(self.directory)
+
+    # The limit is a fraction of one CPU.   A limit of a CPU or more still
+    # gets a quota so repy can't use more than that many CPUs.
+    quota = max(CGROUP_MIN_QUOTA, int(self.cpulimit * self.period))
+    self.write_file("cpu.max", str(quota) + " " + str(self.period) + "\n")
+    self.write_file("cgroup.procs", str(self.pid) + "\n")
+
+    self.lastthrottled = self.get_throttled_usec()
+
+
+  def enforce(self, stoptime):
+    # The kernel does the throttling.   Report how long repy was throttled
+    # since we last looked.
+    throttled = self.get_throttled_usec()
+    throttledtime = (throttled - self.lastthrottled) / 1000000.0
+    self.lastthrottled = throttled
+    return max(0.0, throttledtime)
+
+
+  def get_throttled_usec(self):
+    for line in self.read_file("cpu.stat").split("\n"):
+      fields = line.split()
+      if len(fields) == 2 and fields[0] == "throttled_usec":
+        return int(fields[1])
+
+    # The cpu controller isn't enabled, so nothing is throttled
+    return 0
+
+
+  def read_file(self, filename):
+    fileobj = myfile(os.path.join(self.directory, filename), "r")
+    try:
+      return fileobj.read()
+    finally:
+      fileobj.close()
+
+
+  def write_file(self, filename, data):
+    fileobj = myfile(os.path.join(self.directory, filename), "w")
+    try:
+      fileobj.write(data)
+    finally:
+      fileobj.close()
+
+
+
+def check_cgroup_directory(directory):
+  """
+  <Purpose>
+    Checks that a directory is a cgroup the cgroup backend can use.
+
+  <Arguments>
+    directory:
+      The cgroup directory.
+
+  <Exceptions>
+    Exception if it isn't a cgroup with the cpu controller enabled.
+
+  <Returns>
+    None.
+  """
+  for filename in ["cgroup.procs", "cpu.max", "cpu.stat"]:
+    if not os.path.isfile(os.path.join(directory, filename)):
+      raise Exception, "'" + directory + "' is not a cgroup with the cpu controller (no " + filename + ")"
+
+
+
+class PICPUGovernor:
+  """
+  Works out how long to stop repy for each slice with a proportional-integral
+  controller.   The integral is the CPU repy has used over its budget (its
+  limit times the time since the start).   The proportional part is how
+  much over budget repy would go in the next slice at the rate it uses CPU
+  while it runs.   Stopping repy for a time earns it that time times its
+  limit of budget, so dividing by the limit gives the stop time.
+  """
+  def __init__(self, cpulimit, slicetime=GOVERNOR_SLICE,
+      proportionalgain=GOVERNOR_PROPORTIONAL_GAIN,
+      integralgain=GOVERNOR_INTEGRAL_GAIN, window=GOVERNOR_WINDOW):
+    if cpulimit <= 0:
+      raise ValueError, "The CPU limit must be positive"
+
+    self.cpulimit = cpulimit
+    self.slicetime = slicetime
+    self.proportionalgain = proportionalgain
+    self.integralgain = integralgain
+    self.window = window
+
+    # A program that always wants the CPU runs a slice and must then be
+    # stopped for this long
+    self.maxstop = GOVERNOR_MAX_STOP_FACTOR * slicetime * max(1.0 - cpulimit, 0.0) / cpulimit
+
+    # The time and CPU total at the last update and how long the last stop
+    # was
+    self.lasttime = None
+    self.lastcpu = 0.0
+    self.laststop = 0.0
+
+    # The CPU used over budget (negative if under).   Only a slice's worth of
+    # unused budget is kept, so a program can't save up for a long burst.
+    self.overbudget = 0.0
+
+    # The current window
+    self.windowtime = 0.0
+    self.windowcpu = 0.0
+
+    # The error statistics (see get_window_stats)
+    self.windowerrors = []
+    self.windowcount = 0
+    self.errorsum = 0.0
+    self.abserrorsum = 0.0
+    self.squarederrorsum = 0.0
+    self.maxabserror = 0.0
+    self.updates = 0
+    self.stops = 0
+    self.stoppedtime = 0.0
+
+
+  def get_stop_time(self, now, cputime):
+    """
+    <Purpose>
+      Works out how long to stop repy for now.   The caller is expected to
+      stop repy for that long, then let it run for a slice.
+
+    <Arguments>
+      now:
+        The current time (getruntime()).
+      cputime:
+        The total CPU time used so far.
+
+    <Returns>
+      The number of seconds to stop repy for (0.0 if it needn't be).
+    """
+    if self.lasttime is None:
+      self.lasttime = now
+      self.lastcpu = cputime
+      return 0.0
+
+    elapsed = now - self.lasttime
+    used = cputime - self.lastcpu
+    if elapsed <= 0.0:
+      return 0.0
+
+    self.lasttime = now
+    self.lastcpu = cputime
+    self.updates += 1
+    self.add_to_window(elapsed, used)
+
+    # Integral: the CPU used over budget so far
+    self.overbudget = max(self.overbudget + used - self.cpulimit * elapsed, -self.cpulimit * self.slicetime)
+
+    # Proportional: how much over budget the next slice would go at the
+    # rate repy used CPU while it was running
+    runtime = elapsed - self.laststop
+    if runtime > 0.0:
+      slicedemand = (used / runtime - self.cpulimit) * self.slicetime
+    else:
+      slicedemand = 0.0
+
+    stoptime = (self.proportionalgain * slicedemand + self.integralgain * self.overbudget) / self.cpulimit
+    stoptime = min(max(stoptime, 0.0), self.maxstop)
+
+    self.laststop = stoptime
+    if stoptime > 0.0:
+      self.stops += 1
+      self.stoppedtime += stoptime
+    return stoptime
+
+
+  def add_to_window(self, elapsed, used):
+    self.windowtime += elapsed
+    self.windowcpu += used
+    if self.windowtime < self.window:
+      return
+
+    # The window is over.   The error is the share of CPU repy got minus
+    # its limit.
+    error = self.windowcpu / self.windowtime - self.cpulimit
+    self.windowtime = 0.0
+    self.windowcpu = 0.0
+
+    self.windowcount += 1
+    self.errorsum += error
+    self.abserrorsum += abs(error)
+    self.squarederrorsum += error * error
+    self.maxabserror = max(self.maxabserror, abs(error))
+    self.windowerrors.append(error)
+    if len(self.windowerrors) > GOVERNOR_WINDOW_HISTORY:
+      self.windowerrors.pop(0)
+
+
+  def get_window_stats(self, history=None):
+    """
+    <Purpose>
+      Returns how far the share of CPU repy got in each window was from its
+      limit, and how much work the governor did.
+
+    <Arguments>
+      history:
+        How many of the newest window errors to return.   None returns all
+        that are kept.
+
+    <Returns>
+      A dict with:
+        'windows':      the number of windows
+        'meanerror':    the mean of (share - limit)
+        'meanabserror': the mean of abs(share - limit)
+        'rmserror':     the root mean square of (share - limit)
+        'maxabserror':  the largest abs(share - limit)
+        'errors':       the errors of the newest windows, oldest first
+        'updates':      how many times get_stop_time() was called
+        'stops':        how many times it asked for repy to be stopped
+        'stoppedtime':  the total time it asked for repy to be stopped
+      The errors are all 0.0 if no window has finished.
+    """
+    if history is None:
+      errors = self.windowerrors[:]
+    elif history > 0:
+      errors = self.windowerrors[-history:]
+    else:
+      errors = []
+
+    stats = {'windows':self.windowcount, 'meanerror':0.0, 'meanabserror':0.0,
+        'rmserror':0.0, 'maxabserror':self.maxabserror,
+        'errors':errors, 'updates':self.updates,
+        'stops':self.stops, 'stoppedtime':self.stoppedtime}
+
+    if self.windowcount > 0:
+      stats['meanerror'] = self.errorsum / self.windowcount
+      stats['meanabserror'] = self.abserrorsum / self.windowcount
+      stats['rmserror'] = (self.squarederrorsum / self.windowcount) ** 0.5
+    return stats
+
+
+
+# backend name -> class
+CPU_BACKENDS = {"signal":SignalCPUBackend, "cgroup":CgroupCPUBackend}
+
+# governor name -> class.   The interval governor is
+# nanny_resource_limits.calculate_cpu_sleep_interval, so it has no class.
+CPU_GOVERNORS = {"interval":None, "pi":PICPUGovernor}
+
+
+
+def create_backend(pid, cpulimit):
+  """
+  <Purpose>
+    Makes the backend chosen by backend_name.
+
+  <Arguments>
+    pid:
+      The pid of the repy process.
+    cpulimit:
+      The CPU limit (the fraction of one CPU repy may use).
+
+  <Exceptions>
+    Exception if the backend is unknown or the cgroup backend has no
+    directory.
+
+  <Side Effects>
+    None.   Call the backend's start() method before enforce().
+
+  <Returns>
+    The backend.
+  """
+  if backend_name not in CPU_BACKENDS:
+    raise Exception, "Unknown CPU enforcement backend '" + str(backend_name) + "'"
+
+  if backend_name == "cgroup":
+    if cgroup_directory is None:
+      raise Exception, "The cgroup CPU enforcement backend needs a cgroup directory"
+    return CgroupCPUBackend(pid, cpulimit, cgroup_directory)
+
+  return CPU_BACKENDS[backend_name](pid, cpulimit)
+
+
+
+def create_governor(cpulimit):
+  """
+  <Purpose>
+    Makes the governor chosen by governor_name.
+
+  <Arguments>
+    cpulimit:
+      The CPU limit (the fraction of one CPU repy may use).
+
+  <Exceptions>
+    Exception if the governor is unknown.
+
+  <Returns>
+    The governor, or None for the interval governor.
+  """
+  if governor_name not in CPU_GOVERNORS:
+    raise Exception, "Unknown CPU governor '" + str(governor_name) + "'"
+
+  governorclass = CPU_GOVERNORS[governor_name]
+  if governorclass is None:
+    return None
+  return governorclass(cpulimit)
@@ -33,6 +33,11 @@ socket.setattr = setattr
 import threading
 threading.hasattr = hasattr    # Fix for #1039
 
+# The builtins are replaced while user code runs.   Save the ones that the
+# recv_into buffers need.
+_saved_bytearray = bytearray
+_saved_memoryview = memoryview
+
 # to force destruction of old sockets
 import gc
 
@@ -58,7 +63,20 @@ import time
 import errno
 
 # Armon: Used for getting the constant IP values for resolving our external IP
-import repy_constants 
+import repy_constants
+
+# for the SocketSelector wakeup pipe
+import os
+
+# for the event queue
+import collections
+
+# Used to make the wakeup pipe non-blocking.   This doesn't exist on Windows,
+# but neither does epoll.
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 # The architecture is that I have a thread which "polls" all of the sockets
 # that are being listened on using select.  If a connection
@@ -70,11 +88,149 @@ import repy_constants
 
 
 
+# The comminfo table.   This is a dictionary of commhandle -> table entry that
+# also keeps indexes so that we don't need to scan every entry to find a
+# socket.   The indexes are maintained when entries are added or deleted, so
+# the fields they use ('socket', 'type', 'localip', 'localport', 'outgoing',
+# 'remotehost' and 'remoteport') must not be changed in place afterwards.
+# Use set_remote_address() to fill in the remote end of a connection.
+class CommTable(dict):
+
+  def __init__(self):
+    dict.__init__(self)
+
+    # real socket object -> commhandle
+    self.socket_index = {}
+
+    # (type, localip, localport, outgoing) -> set of commhandles
+    self.tipo_index = {}
+
+    # (localip, localport, remotehost, remoteport) -> set of commhandles.
+    # Only outgoing TCP entries are in here.
+    self.outgoing_tcp_index = {}
+
+    # commhandle -> the keys it was indexed under, so that removal works
+    # even if the entry was modified
+    self.indexed_keys = {}
+
+    # protects the indexes
+    self.indexlock = threading.Lock()
+
+
+  # Private.   The caller must hold indexlock
+  def _add_to_index(self, handle, entry):
+    socketobject = entry.get('socket')
+    tipokey = (entry.get('type'), entry.get('localip'), entry.get('localport'), entry.get('outgoing'))
+    tcpkey = None
+    if entry.get('type') == 'TCP' and entry.get('outgoing') == True:
+      tcpkey = (entry.get('localip'), entry.get('localport'), entry.get('remotehost'), entry.get('remoteport'))
+
+    if socketobject is not None:
+      self.socket_index[socketobject] = handle
+
+    self.tipo_index.setdefault(tipokey, set()).add(handle)
+
+    if tcpkey is not None:
+      self.outgoing_tcp_index.setdefault(tcpkey, set()).add(handle)
+
+    self.indexed_keys[handle] = (socketobject, tipokey, tcpkey)
+
+
+  # Private.   The caller must hold indexlock
+  def _remove_from_index(self, handle):
+    try:
+      (socketobject, tipokey, tcpkey) = self.indexed_keys.pop(handle)
+    except KeyError:
+      return
+
+    # recvmess / waitforconn re-registration leaves the socket under a new
+    # handle.   Only drop the socket if it still points to this one.
+    if socketobject is not None and self.socket_index.get(socketobject) == handle:
+      del self.socket_index[socketobject]
+
+    for (index, key) in [(self.tipo_index, tipokey), (self.outgoing_tcp_index, tcpkey)]:
+      if key is None or key not in index:
+        continue
+      index[key].discard(handle)
+      if not index[key]:
+        del index[key]
+
+
+  def __setitem__(self, handle, entry):
+    self.indexlock.acquire()
+    try:
+      self._remove_from_index(handle)
+      dict.__setitem__(self, handle, entry)
+      self._add_to_index(handle, entry)
+    finally:
+      self.indexlock.release()
+
+
+  def __delitem__(self, handle):
+    self.indexlock.acquire()
+    try:
+      dict.__delitem__(self, handle)
+      self._remove_from_index(handle)
+    finally:
+      self.indexlock.release()
+
+
+  def set_remote_address(self, handle, remotehost, remoteport):
+    """
+    <Purpose>
+      Sets the remote host and port of an entry and re-indexes it.
+
+    <Exceptions>
+      KeyError if the handle is not in the table.
+    """
+    self.indexlock.acquire()
+    try:
+      entry = dict.__getitem__(self, handle)
+      self._remove_from_index(handle)
+      entry['remotehost'] = remotehost
+      entry['remoteport'] = remoteport
+      self._add_to_index(handle, entry)
+    finally:
+      self.indexlock.release()
+
+
+  def find_by_socket(self, socketobject):
+    # Returns the handle for this socket or None
+    return self.socket_index.get(socketobject)
+
+
+  def find_by_tipo(self, socktype, ip, port, outgoing):
+    # Returns a handle with this type, local ip, local port and direction or
+    # None
+    self.indexlock.acquire()
+    try:
+      for handle in self.tipo_index.get((socktype, ip, port, outgoing), ()):
+        return handle
+      return None
+    finally:
+      self.indexlock.release()
+
+
+  def find_outgoing_tcp(self, localip, localport, remoteip, remoteport):
+    # Returns the handle of an outgoing TCP connection with this 4-tuple or
+    # None
+    self.indexlock.acquire()
+    try:
+      for handle in self.outgoing_tcp_index.get((localip, localport, remoteip, remoteport), ()):
+        return handle
+      return None
+    finally:
+      self.indexlock.release()
+
+
+
 # Table of communications structures:
 # {'type':'UDP','localip':ip, 'localport':port,'function':func,'socket':s, outgoing:True, 'closing_lock':lockobj}
+# recvmess entries also have 'queue':deque of (addr, data), 'pending':bool when
+# UDP messages are read in batches (see queue_udp_messages)
 # {'type':'TCP','remotehost':None, 'remoteport':None,'localip':None,'localport':None, 'socket':s, 'function':func, outgoing:False, 'closing_lock':lockobj}
 
-comminfo = {}
+comminfo = CommTable()
 
 # If we have a preference for an IP/Interface this flag is set to True
 user_ip_interface_preferences = False
@@ -124,18 +280,167 @@ def unique_append(lst, elem):
   if elem not in lst:
     lst.append(elem)
       
+
+# How long a discovered IP is used before looking again, and how often to
+# check if the network configuration changed (which also means looking again)
+IP_CACHE_REFRESH_INTERVAL = 60.0  # In seconds
+IP_CHANGE_CHECK_INTERVAL = 1.0    # In seconds
+
+
+class IPDiscoveryCache:
+  """
+  <Purpose>
+    Remembers the result of an IP discovery function.   The function is
+    called again when the result is IP_CACHE_REFRESH_INTERVAL old, or when
+    nonportable.os_api.get_network_signature() (if the OS has it) changes.
+    Threads that ask while the function is running wait for that call
+    instead of making their own.
+
+  <Side Effects>
+    None.
+  """
+
+  def __init__(self, function, maxage=IP_CACHE_REFRESH_INTERVAL, checkinterval=IP_CHANGE_CHECK_INTERVAL):
+    self.function = function
+    self.maxage = maxage
+    self.checkinterval = checkinterval
+
+    self.cond = threading.Condition(threading.Lock())
+    self.valid = False
+    self.value = None
+    self.refreshtime = 0.0
+    self.checktime = 0.0
+    self.signature = None
+
+    # Set while a thread is calling function.   generation is incremented
+    # when it finishes and error is what it raised, if anything.
+    self.refreshing = False
+    self.generation = 0
+    self.error = None
+
+
+  def _get_signature(self):
+    # Not every OS can tell us about changes (getattr isn't safe to call
+    # once the user's code is running)
+    try:
+      signaturefunc = nonportable.os_api.get_network_signature
+    except AttributeError:
+      return None
+    return signaturefunc()
+
+
+  def _is_stale(self):
+    # The lock must be held
+    now = nonportable.getruntime()
+    if now - self.refreshtime >= self.maxage:
+      return True
+
+    if now - self.checktime >= self.checkinterval:
+      self.checktime = now
+      return self._get_signature() != self.signature
+
+    return False
+
+
+  def get(self):
+    """
+    <Purpose>
+      Returns the cached result, calling the function if it is too old.
+
+    <Exceptions>
+      As from the function.
+
+    <Returns>
+      The result of the function.
+    """
+    self.cond.acquire()
+    try:
+      if self.valid and not self._is_stale():
+        return self.value
+      return self._refresh()
+    finally:
+      self.cond.release()
+
+
+  def refresh(self):
+    """
+    <Purpose>
+      Calls the function, or waits for the call already in progress.
+
+    <Exceptions>
+      As from the function.
+
+    <Returns>
+      The result of the function.
+    """
+    self.cond.acquire()
+    try:
+      return self._refresh()
+    finally:
+      self.cond.release()
+
+
+  def invalidate(self):
+    # The next get() will call the function
+    self.cond.acquire()
+    self.valid = False
+    self.cond.release()
+
+
+  def _refresh(self):
+    # The lock must be held.   Share a call that is already in progress.
+    if self.refreshing:
+      generation = self.generation
+      while self.generation == generation:
+        self.cond.wait()
+      if self.error is not None:
+        raise self.error
+      return self.value
+
+    self.refreshing = True
+    self.cond.release()
+    try:
+      try:
+        # Get the signature first, so a change while we look is noticed
+        signature = self._get_signature()
+        value = self.function()
+      finally:
+        self.cond.acquire()
+        self.refreshing = False
+        self.generation = self.generation + 1
+        self.cond.notifyAll()
+    except Exception, e:
+      self.error = e
+      raise
+
+    self.error = None
+    self.value = value
+    self.valid = True
+    self.signature = signature
+    self.refreshtime = nonportable.getruntime()
+    self.checktime = self.refreshtime
+    return value
+
+
+
 # This function updates the allowed IP cache
 # It iterates through all possible IP's and stores ones which are bindable as part of the allowediplist
 def update_ip_cache():
+  # If there is no preference, this is a no-op
+  if not user_ip_interface_preferences:
+    return
+
+  allowed_ip_cache.refresh()
+
+
+
+# Does the work for update_ip_cache.   Returns the new allowediplist.
+def find_allowed_ips():
   global allowediplist
   global user_ip_interface_preferences
   global user_specified_ip_interface_list
   global allow_nonspecified_ips
   
-  # If there is no preference, this is a no-op
-  if not user_ip_interface_preferences:
-    return
-    
   # Acquire the lock to update the cache
   cachelock.acquire()
   
@@ -185,7 +490,133 @@ def update_ip_cache():
   finally:      
     # Release the lock
     cachelock.release()
+
+  return bindable_list
   
+
+
+# The allowed IPs used by getmyip when there are IP / interface preferences
+allowed_ip_cache = IPDiscoveryCache(find_allowed_ips)
+
+########################### Socket buffer sizes ###############################
+
+# The buffer sizes used when the restrictions don't set tcpbuffer / udpbuffer.
+# TCP buffers are kept small to prevent excessive buffering (#895).   UDP
+# buffers must be slightly more than 64K+e (see ticket #887) and the send
+# buffer must also be set or it will constrain UDP sendmess size on Mac.
+DEFAULT_TCP_BUFFER_SIZE = 10000
+DEFAULT_UDP_BUFFER_SIZE = 66000
+
+
+def get_socket_buffer_size(resource, default):
+  """
+  <Purpose>
+    Returns the buffer size set by a setting resource in the restrictions.
+
+  <Arguments>
+    resource:
+      'tcpbuffer', 'udpbuffer' or 'tcpbuffermax'
+    default:
+      What to return if the restrictions don't set the resource (or set it
+      to 0).
+
+  <Returns>
+    The buffer size in bytes.
+  """
+  size = int(nanny.resource_restriction_table.get(resource, 0))
+  if size <= 0:
+    return default
+  return size
+
+
+def set_socket_buffer_sizes(socketobj, protocol):
+  """
+  <Purpose>
+    Sets the send and receive buffer sizes of a new socket.
+
+  <Arguments>
+    socketobj:
+      The socket.
+    protocol:
+      'TCP' or 'UDP'
+
+  <Side Effects>
+    Changes SO_RCVBUF and SO_SNDBUF.
+
+  <Returns>
+    None.
+  """
+  if protocol == 'TCP':
+    size = get_socket_buffer_size('tcpbuffer', DEFAULT_TCP_BUFFER_SIZE)
+  else:
+    size = get_socket_buffer_size('udpbuffer', DEFAULT_UDP_BUFFER_SIZE)
+
+  socketobj.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+  socketobj.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+
+
+# If tcpbuffermax is set, TCP buffers are auto-tuned.   A connection starts
+# with tcpbuffer sized buffers and a buffer is doubled (up to tcpbuffermax)
+# each time a send or recv fills it.   A buffer never grows past what the
+# nanny lets the program send / receive in a second (netsend / netrecv, or
+# loopsend / looprecv for loopback), since more would only hold data that
+# the program is made to wait for.
+def get_socket_buffer_limit(rateresource):
+  limit = get_socket_buffer_size('tcpbuffermax', 0)
+  rate = int(nanny.resource_restriction_table.get(rateresource, 0))
+  if rate > 0:
+    limit = min(limit, rate)
+  return limit
+
+
+def grow_socket_buffer(context, option):
+  """
+  <Purpose>
+    Doubles an auto-tuned socket buffer, within the limits.   Does nothing
+    if the socket isn't auto-tuned.
+
+  <Arguments>
+    context:
+      The ConnectionContext for the socket.
+    option:
+      socket.SO_RCVBUF or socket.SO_SNDBUF
+
+  <Side Effects>
+    Changes the socket option and updates context.recvbuffersize or
+    context.sendbuffersize.
+
+  <Returns>
+    None.
+  """
+  autotune = context.autotune
+  if autotune is None:
+    return
+
+  if option == socket.SO_RCVBUF:
+    rateresource = context.recvresource
+  else:
+    rateresource = context.sendresource
+
+  newsize = min(autotune[option] * 2, get_socket_buffer_limit(rateresource))
+  if newsize <= autotune[option]:
+    return
+
+  realsocket = context.socket
+  try:
+    realsocket.setsockopt(socket.SOL_SOCKET, option, newsize)
+    actualsize = realsocket.getsockopt(socket.SOL_SOCKET, option)
+  except socket.error:
+    # The socket was likely closed.   The caller will find out.
+    return
+  autotune[option] = newsize
+
+  if option == socket.SO_RCVBUF:
+    context.recvbuffersize = actualsize
+  else:
+    context.sendbuffersize = actualsize
+
+
+
 ########################### General Purpose socket functions #################
 
 def is_already_connected_exception(exceptionobj):
@@ -422,110 +853,510 @@ selectorlock = threading.Lock()
 selectorstarted = False
 
 
+# Where the platform has it (Linux), the SocketSelector uses epoll and the
+# listening sockets stay registered between passes instead of having the
+# select() list rebuilt from comminfo every time.   recvmess and waitforconn
+# register their sockets, cleanup unregisters them.   One end of a pipe is
+# registered as well so that any change wakes the selector right away.
+# Everywhere else we use the select() loop.
+selector_use_epoll = hasattr(select, 'epoll') and fcntl is not None
+
+# The epoll object and the wakeup pipe (readfd, writefd).   These are created
+# lazily by the first registration so that they aren't shared with the
+# resource monitor process we fork.
+selector_epoll = None
+selector_wakeup_pipe = None
+
+# Maps the file descriptors registered with epoll to their socket objects
+selector_fd_table = {}
+
+# Serializes the creation of the epoll object and registration changes
+selector_epoll_lock = threading.Lock()
+
+
 #### helper functions
 
 # return the table entry for this socketobject
 def find_socket_entry(socketobject):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['socket'] is socketobject:
+  commhandle = comminfo.find_by_socket(socketobject)
+  if commhandle is not None:
+    try:
       return comminfo[commhandle], commhandle
+    except KeyError:
+      pass
   raise KeyError, "Can't find commhandle"
 
 
 
+# private.   Creates the epoll object and wakeup pipe if they don't exist.
+# The caller must hold selector_epoll_lock
+def init_selector_epoll():
+  global selector_epoll
+  global selector_wakeup_pipe
 
-# wait until there is a free event
-def wait_for_event(eventname):
-  while True:
-    try:
-      nanny.tattle_add_item('events',eventname)
-      break
-    except Exception:
-      # They must be over their event limit.   I'll sleep and check later
-      time.sleep(.1)
+  if selector_epoll is not None:
+    return
 
+  selector_epoll = select.epoll()
 
+  # The read end must not block, we drain it after every wakeup
+  (readfd, writefd) = os.pipe()
+  fcntl.fcntl(readfd, fcntl.F_SETFL, fcntl.fcntl(readfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+  fcntl.fcntl(writefd, fcntl.F_SETFL, fcntl.fcntl(writefd, fcntl.F_GETFL) | os.O_NONBLOCK)
+  selector_wakeup_pipe = (readfd, writefd)
 
-def should_selector_exit():
-  global selectorstarted
+  selector_epoll.register(readfd, select.EPOLLIN)
 
-  # Let's check to see if we should exit...   False means "nonblocking"
-  if selectorlock.acquire(False):
 
-    # Check that selector started is true.   This should *always* be the case
-    # when I enter this function.   This is to test for bugs in my code
-    if not selectorstarted:
-      # This will cause the program to exit and log things if logging is
-      # enabled. -Brent
-      tracebackrepy.handle_internalerror("SocketSelector is started when" +
-          ' selectorstarted is False', 39)
 
-    # Got the lock...
-    for comm in comminfo.values():
-      # I'm listening and waiting so all is well
-      if not comm['outgoing']:
-        break
-    else:
-      # there is no listening function so I should exit...
-      selectorstarted = False
-      # I'm exiting...
-      nanny.tattle_remove_item('events',"SocketSelector")
-      selectorlock.release()
-      return True
+# Wakes the SocketSelector up if it is blocked in epoll
+def wakeup_selector():
+  if selector_wakeup_pipe is None:
+    return
 
-    # I should continue
-    selectorlock.release()
-  return False
-    
+  try:
+    os.write(selector_wakeup_pipe[1], "x")
+  except OSError:
+    # The pipe is full, so the selector will wake up anyways
+    pass
 
 
 
+# Registers a listening socket with the SocketSelector.   This is a no-op
+# when we are using select().   eventmask defaults to waiting for reads.
+def register_selector_socket(socketobject, eventmask=None):
+  if not selector_use_epoll:
+    return
 
-# This function starts a thread to handle an entry with a readable socket in 
-# the comminfo table
-def start_event(entry, handle,eventhandle):
-  if entry['type'] == 'UDP':
-    # some sort of socket error, I'll assume they closed the socket or it's
-    # not important
+  if eventmask is None:
+    eventmask = select.EPOLLIN | select.EPOLLPRI
+
+  selector_epoll_lock.acquire()
+  try:
+    init_selector_epoll()
+
+    # The table entry must exist before epoll can report the socket, or a
+    # one-shot registration would be lost
+    fd = socketobject.fileno()
+    selector_fd_table[fd] = socketobject
     try:
-      # NOTE: 64K is the max UDP dgram size.   Let's read it all
-      data, addr = entry['socket'].recvfrom(65535)
+      selector_epoll.register(fd, eventmask)
+    except:
+      del selector_fd_table[fd]
+      raise
+  finally:
+    selector_epoll_lock.release()
+
+  wakeup_selector()
+
+
+
+# Unregisters a socket from the SocketSelector.   This must be called before
+# the socket is closed since its descriptor may be reused.   Sockets that
+# were never registered are ignored.
+def unregister_selector_socket(socketobject):
+  if selector_epoll is None:
+    return
+
+  selector_epoll_lock.acquire()
+  try:
+    try:
+      fd = socketobject.fileno()
     except socket.error:
-      # they closed in the meantime?
-      nanny.tattle_remove_item('events',eventhandle)
+      # Already closed, epoll dropped it for us
       return
 
-    # wait if we're over the limit
-    if data:
-      if is_loopback(entry['localip']):
-        nanny.tattle_quantity('looprecv',len(data))
-      else:
-       # We will charge looprecv for UDP from the net, (see #887 for details)
-        nanny.tattle_quantity('looprecv',len(data))
-    else:
-      # no data...   Let's stop this...
-      nanny.tattle_remove_item('events',eventhandle)
+    # Only remove the descriptor if it is really this socket's
+    if selector_fd_table.get(fd) is not socketobject:
       return
 
-      
+    del selector_fd_table[fd]
     try:
-      EventDeliverer(entry['function'],(addr[0], addr[1], data, handle), eventhandle).start()
-    except Exception, e:
-      # This is an internal error I think...
-      # This will cause the program to exit and log things if logging is
-      # enabled. -Brent
-      tracebackrepy.handle_internalerror("Can't start UDP EventDeliverer '" + str(e)+"'", 29)
+      selector_epoll.unregister(fd)
+    except (IOError, OSError):
+      pass
+  finally:
+    selector_epoll_lock.release()
 
+  wakeup_selector()
 
 
-  # or it's a TCP accept event...
-  elif entry['type'] == 'TCP':
-    try:
+
+
+# Re-enables a socket that was registered with EPOLLONESHOT, after it fired.
+# Sockets that were unregistered in the meantime are ignored.
+def rearm_selector_socket(socketobject, eventmask):
+  if selector_epoll is None:
+    return
+
+  selector_epoll_lock.acquire()
+  try:
+    try:
+      fd = socketobject.fileno()
+    except socket.error:
+      return
+
+    if selector_fd_table.get(fd) is not socketobject:
+      return
+
+    try:
+      selector_epoll.modify(fd, eventmask)
+    except (IOError, OSError):
+      pass
+  finally:
+    selector_epoll_lock.release()
+
+
+
+
+# Connected sockets with a function from setrecvcallback().   The comminfo
+# entry has 'recvcallback' (the function) and 'recvsocketobj' (the
+# emulated_socket, which is kept open while there is a callback).
+# 'recvbusy' is True while an event for the callback is outstanding, so that
+# the same data isn't reported again before the function reads it.
+
+# The socket is watched for data, once.   It is re-armed after the function
+# returns.
+if selector_use_epoll:
+  RECV_CALLBACK_SELECTOR_EVENTS = select.EPOLLIN | select.EPOLLPRI | select.EPOLLONESHOT
+else:
+  RECV_CALLBACK_SELECTOR_EVENTS = None
+
+
+# Runs the user's recv callback in an event, then watches the socket again
+def run_recv_callback(handle, function, socketobj):
+  try:
+    function(socketobj)
+  finally:
+    arm_recv_callback(handle)
+
+
+
+# Lets the SocketSelector report data on the socket again
+def arm_recv_callback(handle):
+  try:
+    entry = comminfo[handle]
+  except KeyError:
+    # It was closed
+    return
+
+  if entry.get('recvcallback') is None:
+    return
+
+  entry['recvbusy'] = False
+  rearm_selector_socket(entry['socket'], RECV_CALLBACK_SELECTOR_EVENTS)
+
+
+
+
+# openconn_async sockets that are still connecting.   The SocketSelector
+# waits for them to become writable (or for their deadline) and then calls
+# the user's function.   The comminfo entry has 'connect':{'function',
+# 'desthost', 'destport', 'socketobj', 'started'} until then.   If a socket
+# with the same addresses is still being cleaned up, connecting is put off
+# ('started' is False) and the SocketSelector checks for it again every
+# RETRY_INTERVAL, as openconn would.
+
+# connect_ex() returns one of these when the connection is being opened
+CONNECT_IN_PROGRESS_ERRORS = set([errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK])
+
+# A connecting socket is writable once it is connected or has failed
+if selector_use_epoll:
+  CONNECT_SELECTOR_EVENTS = select.EPOLLOUT
+else:
+  CONNECT_SELECTOR_EVENTS = None
+
+# handle -> (deadline, error, checktime).   error is an errno if connect_ex
+# failed right away, otherwise 0.   checktime is when to check for the old
+# socket again, or None if connecting was started.
+pending_connects = {}
+pending_connects_lock = threading.Lock()
+
+
+# Adds (or updates) a connecting socket and makes the SocketSelector notice it
+def add_pending_connect(handle, deadline, error, checktime=None):
+  pending_connects_lock.acquire()
+  try:
+    pending_connects[handle] = (deadline, error, checktime)
+  finally:
+    pending_connects_lock.release()
+
+  wakeup_selector()
+
+
+
+# Returns True if handle was a connecting socket.   Only the caller that gets
+# True may finish (or stop) the connection.
+def remove_pending_connect(handle):
+  pending_connects_lock.acquire()
+  try:
+    if handle not in pending_connects:
+      return False
+    del pending_connects[handle]
+    return True
+  finally:
+    pending_connects_lock.release()
+
+
+
+# Returns a list of (handle, error) for the connecting sockets that failed
+# right away or have reached their deadline
+def get_due_connects(now):
+  pending_connects_lock.acquire()
+  try:
+    due = []
+    for handle in pending_connects:
+      (deadline, error, checktime) = pending_connects[handle]
+      if error:
+        due.append((handle, error))
+      elif now >= deadline and checktime is not None:
+        due.append((handle, "Timed out checking for socket cleanup!"))
+      elif now >= deadline:
+        due.append((handle, "Connection timed out!"))
+    return due
+  finally:
+    pending_connects_lock.release()
+
+
+
+# Returns the earliest time a connecting socket needs attention, or None
+def get_next_connect_deadline():
+  pending_connects_lock.acquire()
+  try:
+    nextdeadline = None
+    for (deadline, error, checktime) in pending_connects.values():
+      if error:
+        deadline = 0.0
+      elif checktime is not None:
+        deadline = min(deadline, checktime)
+      if nextdeadline is None or deadline < nextdeadline:
+        nextdeadline = deadline
+    return nextdeadline
+  finally:
+    pending_connects_lock.release()
+
+
+
+# Returns the handles of the connecting sockets that are due to check for an
+# old socket again
+def get_cleanup_connects(now):
+  pending_connects_lock.acquire()
+  try:
+    due = []
+    for handle in pending_connects:
+      (deadline, error, checktime) = pending_connects[handle]
+      if checktime is not None and not error and now >= checktime and now < deadline:
+        due.append(handle)
+    return due
+  finally:
+    pending_connects_lock.release()
+
+
+
+# Starts connecting an openconn_async socket.   If connect_ex fails right
+# away, the SocketSelector reports the error.
+def start_connect(handle, deadline):
+  entry = comminfo[handle]
+  info = entry['connect']
+  realsocket = entry['socket']
+
+  error = realsocket.connect_ex((info['desthost'], info['destport']))
+  nonportable.socket_table_changed()
+  if error in CONNECT_IN_PROGRESS_ERRORS or error == errno.EISCONN:
+    error = 0
+
+  info['started'] = True
+  add_pending_connect(handle, deadline, error)
+  if not error:
+    register_selector_socket(realsocket, CONNECT_SELECTOR_EVENTS)
+
+
+
+# Called by the SocketSelector for a socket from get_cleanup_connects().
+# Starts connecting if the old socket is gone.
+def retry_connect_cleanup(handle):
+  try:
+    handle_lock = comminfo[handle]['closing_lock']
+  except KeyError:
+    return
+
+  # Keep stopcomm from closing the socket while we start it
+  handle_lock.acquire()
+  try:
+    pending_connects_lock.acquire()
+    try:
+      if handle not in comminfo or handle not in pending_connects:
+        return
+      (deadline, error, checktime) = pending_connects[handle]
+    finally:
+      pending_connects_lock.release()
+
+    entry = comminfo[handle]
+    info = entry['connect']
+    try:
+      inuse = check_outgoing_socket(entry['localip'], entry['localport'], info['desthost'], info['destport'])
+    except Exception, e:
+      add_pending_connect(handle, deadline, str(e))
+      return
+
+    if inuse:
+      add_pending_connect(handle, deadline, 0, nonportable.getruntime() + RETRY_INTERVAL)
+      return
+
+    try:
+      start_connect(handle, deadline)
+    except socket.error, e:
+      add_pending_connect(handle, deadline, str(e))
+  finally:
+    handle_lock.release()
+
+
+
+# Called by the SocketSelector when a connecting socket is writable (error is
+# None) or has failed (error is an errno or a message).   Calls the user's
+# function with the socket or the error.
+def finish_connect(handle, error):
+  if not remove_pending_connect(handle):
+    return
+
+  try:
+    entry = comminfo[handle]
+    info = entry['connect']
+  except KeyError:
+    # They called stopcomm in the meantime
+    return
+
+  realsocket = entry['socket']
+  unregister_selector_socket(realsocket)
+
+  # Find out if the connection worked
+  if error is None:
+    try:
+      error = realsocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    except socket.error, e:
+      error = e[0]
+
+  if error:
+    # Report it just as openconn would raise it
+    if type(error) is not str:
+      error = str(socket.error(error, os.strerror(error)))
+    cleanup(handle)
+    args = (info['desthost'], info['destport'], None, handle, error)
+  else:
+    # This updates the index as well
+    comminfo.set_remote_address(handle, info['desthost'], info['destport'])
+    args = (info['desthost'], info['destport'], info['socketobj'], handle, None)
+
+  del entry['connect']
+
+  eventhandle = idhelper.getuniqueid()
+  wait_for_event(eventhandle)
+  try:
+    deliver_event(info['function'], args, eventhandle)
+  except Exception, e:
+    # This is an internal error I think...
+    tracebackrepy.handle_internalerror("Can't start connect EventDeliverer '"+str(e)+"'", 29)
+
+
+
+
+# wait until there is a free event.   The nanny wakes us as soon as one is
+# released.
+def wait_for_event(eventname):
+  nanny.tattle_wait_for_item('events',eventname)
+
+
+
+def should_selector_exit():
+  global selectorstarted
+
+  # Let's check to see if we should exit...   False means "nonblocking"
+  if selectorlock.acquire(False):
+
+    # Check that selector started is true.   This should *always* be the case
+    # when I enter this function.   This is to test for bugs in my code
+    if not selectorstarted:
+      # This will cause the program to exit and log things if logging is
+      # enabled. -Brent
+      tracebackrepy.handle_internalerror("SocketSelector is started when" +
+          ' selectorstarted is False', 39)
+
+    # Got the lock...
+    for comm in comminfo.values():
+      # I'm listening and waiting (or connecting or waiting for data) so all
+      # is well
+      if not comm['outgoing'] or 'connect' in comm or comm.get('recvcallback'):
+        break
+    else:
+      # there is no listening function so I should exit...
+      selectorstarted = False
+      # I'm exiting...
+      nanny.tattle_remove_item('events',"SocketSelector")
+      selectorlock.release()
+      return True
+
+    # I should continue
+    selectorlock.release()
+  return False
+    
+
+
+
+
+# This function starts a thread to handle an entry with a readable socket in 
+# the comminfo table
+def start_event(entry, handle,eventhandle):
+  # There is data for a socket with a recv callback
+  if entry.get('recvcallback') is not None:
+    try:
+      deliver_event(run_recv_callback, (handle, entry['recvcallback'], entry['recvsocketobj']), eventhandle)
+    except Exception, e:
+      # This is an internal error I think...
+      tracebackrepy.handle_internalerror("Can't start recv callback EventDeliverer '"+str(e)+"'", 29)
+
+  elif entry['type'] == 'UDP':
+    # some sort of socket error, I'll assume they closed the socket or it's
+    # not important
+    try:
+      # NOTE: 64K is the max UDP dgram size.   Let's read it all
+      data, addr = entry['socket'].recvfrom(65535)
+    except socket.error:
+      # they closed in the meantime?
+      nanny.tattle_remove_item('events',eventhandle)
+      return
+
+    # wait if we're over the limit
+    if data:
+      if is_loopback(entry['localip']):
+        nanny.tattle_quantity('looprecv',len(data))
+      else:
+       # We will charge looprecv for UDP from the net, (see #887 for details)
+        nanny.tattle_quantity('looprecv',len(data))
+    else:
+      # no data...   Let's stop this...
+      nanny.tattle_remove_item('events',eventhandle)
+      return
+
+      
+    try:
+      deliver_event(entry['function'],(addr[0], addr[1], data, handle), eventhandle)
+    except Exception, e:
+      # This is an internal error I think...
+      # This will cause the program to exit and log things if logging is
+      # enabled. -Brent
+      tracebackrepy.handle_internalerror("Can't start UDP EventDeliverer '" + str(e)+"'", 29)
+
+
+
+  # or it's a TCP accept event...
+  elif entry['type'] == 'TCP':
+    try:
       realsocket, addr = entry['socket'].accept()
     except socket.error:
       # they closed in the meantime?
       nanny.tattle_remove_item('events',eventhandle)
       return
+    nonportable.socket_table_changed()
     
     # put this handle in the table
     newhandle = generate_commhandle()
@@ -537,7 +1368,7 @@ def start_event(entry, handle,eventhandle):
     safesocket = emulated_socket(newhandle)
 
     try:
-      EventDeliverer(entry['function'],(addr[0], addr[1], safesocket, newhandle, handle),eventhandle).start()
+      deliver_event(entry['function'],(addr[0], addr[1], safesocket, newhandle, handle),eventhandle)
     except Exception, e:
       # This is an internal error I think...
       # This will cause the program to exit and log things if logging is
@@ -553,6 +1384,152 @@ def start_event(entry, handle,eventhandle):
 
 
 
+# Should the SocketSelector read all of the waiting datagrams when a recvmess
+# socket is readable?   If so, they are queued and delivered as events become
+# free.   Otherwise one datagram is read per event.
+batch_udp_receive = hasattr(socket, 'MSG_DONTWAIT')
+
+# The most datagrams that may be queued for one recvmess socket.   Datagrams
+# that arrive while the queue is full are dropped.
+UDP_QUEUE_MAX_MESSAGES = 256
+
+# Protects the queues and udp_pending_entries
+udp_queue_lock = threading.Lock()
+
+# The comminfo entries that have queued messages, in the order they will be
+# served.   An entry is in here if and only if entry['pending'] is True.
+udp_pending_entries = collections.deque()
+
+# How long the SocketSelector waits for a socket when messages are queued.
+# Events that free up outside of the event workers (timers, etc.) are only
+# noticed when it wakes up.
+QUEUED_MESSAGE_CHECK_INTERVAL = 0.05
+
+
+# How long should the SocketSelector wait for a ready socket?
+def get_selector_timeout():
+  timeout = 0.5
+  if udp_pending_entries:
+    timeout = QUEUED_MESSAGE_CHECK_INTERVAL
+
+  # Wake up in time for connections that time out
+  nextdeadline = get_next_connect_deadline()
+  if nextdeadline is not None:
+    timeout = max(0.0, min(timeout, nextdeadline - nonportable.getruntime()))
+
+  return timeout
+
+
+
+# Reads all of the datagrams waiting on a recvmess socket into its queue.
+# The bytes are charged once for the whole batch.
+def queue_udp_messages(entry):
+  totalbytes = 0
+  messages = []
+
+  # Don't let one busy socket keep us from the others
+  for count in xrange(UDP_QUEUE_MAX_MESSAGES):
+    try:
+      data, addr = entry['socket'].recvfrom(65535, socket.MSG_DONTWAIT)
+    except socket.error:
+      # Nothing more to read (or they closed in the meantime)
+      break
+
+    if data:
+      totalbytes = totalbytes + len(data)
+      messages.append((addr, data))
+
+  if totalbytes:
+    # We will charge looprecv for UDP from the net, (see #887 for details)
+    nanny.tattle_quantity('looprecv',totalbytes)
+
+  if not messages:
+    return
+
+  udp_queue_lock.acquire()
+  try:
+    room = UDP_QUEUE_MAX_MESSAGES - len(entry['queue'])
+    if room < len(messages):
+      nonportable.udp_queue_stats['udpdropped'] += len(messages) - max(room, 0)
+      messages = messages[:max(room, 0)]
+
+    entry['queue'].extend(messages)
+    nonportable.udp_queue_stats['udpqueued'] += len(messages)
+
+    if entry['queue'] and not entry['pending']:
+      entry['pending'] = True
+      udp_pending_entries.append(entry)
+  finally:
+    udp_queue_lock.release()
+
+
+
+# Drops all of the queued messages for an entry.   This is used when the
+# socket is closed.
+def discard_udp_messages(entry):
+  udp_queue_lock.acquire()
+  try:
+    nonportable.udp_queue_stats['udpqueued'] -= len(entry['queue'])
+    nonportable.udp_queue_stats['udpdropped'] += len(entry['queue'])
+    entry['queue'].clear()
+  finally:
+    udp_queue_lock.release()
+
+
+
+# Starts events for queued messages until there are no more messages or no
+# free events.   The entries take turns so that one socket can't starve the
+# others.   This is called by the SocketSelector and whenever an event
+# finishes.
+def dispatch_queued_messages():
+  while True:
+    udp_queue_lock.acquire()
+    try:
+      if not udp_pending_entries:
+        return
+
+      entry = udp_pending_entries.popleft()
+
+      # Find the current handle for the socket.   If it's gone the socket was
+      # closed.
+      handle = comminfo.find_by_socket(entry['socket'])
+      if handle is None or not entry['queue']:
+        nonportable.udp_queue_stats['udpqueued'] -= len(entry['queue'])
+        nonportable.udp_queue_stats['udpdropped'] += len(entry['queue'])
+        entry['queue'].clear()
+        entry['pending'] = False
+        continue
+
+      eventhandle = idhelper.getuniqueid()
+      try:
+        nanny.tattle_add_item('events',eventhandle)
+      except Exception:
+        # They are over their event limit.   We'll try again when an event
+        # finishes
+        udp_pending_entries.appendleft(entry)
+        return
+
+      addr, data = entry['queue'].popleft()
+      nonportable.udp_queue_stats['udpqueued'] -= 1
+
+      # Go to the back of the line
+      if entry['queue']:
+        udp_pending_entries.append(entry)
+      else:
+        entry['pending'] = False
+
+    finally:
+      udp_queue_lock.release()
+
+    try:
+      deliver_event(entry['function'],(addr[0], addr[1], data, handle), eventhandle)
+    except Exception, e:
+      # This is an internal error I think...
+      tracebackrepy.handle_internalerror("Can't start UDP EventDeliverer '" + str(e)+"'", 29)
+
+
+
+
 # Armon: What is the maximum number of samples to perform per second?
 # This is to prevent excessive sampling if there is a bad socket and
 # select() returns before timing out
@@ -570,27 +1547,72 @@ class SocketSelector(threading.Thread):
     threading.Thread.__init__(self, name="SocketSelector")
 
 
+  # Gets the registered sockets which epoll says are ready.   Blocks until
+  # a socket is ready, the registrations change or the timeout expires.
+  def get_epoll_ready_sockets(self):
+    try:
+      events = selector_epoll.poll(get_selector_timeout())
+    except IOError, e:
+      # Interrupted system call.   Loop around and try again
+      if e[0] == errno.EINTR:
+        return []
+      raise
+
+    readylist = []
+    for (fd, eventmask) in events:
+      # This just tells us that the registrations changed...
+      if fd == selector_wakeup_pipe[0]:
+        try:
+          while os.read(fd, 512):
+            pass
+        except OSError:
+          # Nothing more to read
+          pass
+        continue
+
+      # If it was unregistered in the meantime, skip it
+      sock = selector_fd_table.get(fd)
+      if sock is not None:
+        readylist.append(sock)
+
+    return readylist
+
+
+
   # Gets a list of all the sockets which are ready to have
   # accept() called on them
   def get_acceptable_sockets(self):
-    # get the list of socket objects we might have a pending request on
+    # Use the persistent registrations if we can
+    if selector_epoll is not None:
+      return self.get_epoll_ready_sockets()
+
+    # get the list of socket objects we might have a pending request on,
+    # and the connecting sockets
     requestlist = []
+    connectlist = []
     for comm in comminfo.values():
       if not comm['outgoing']:
         requestlist.append(comm['socket'])
+      elif 'connect' in comm:
+        # Sockets waiting for an old socket to go away aren't connecting yet
+        if comm['connect']['started']:
+          connectlist.append(comm['socket'])
+      elif comm.get('recvcallback') and not comm.get('recvbusy'):
+        requestlist.append(comm['socket'])
 
     # nothing to request.   We should loop back around and check if all 
     # sockets have been closed
-    if requestlist == []:
+    if requestlist == [] and connectlist == []:
       return []
 
     # Perform a select on these sockets
     try:
       # Call select
-      (acceptable, not_applic, has_excp) = select.select(requestlist,[],requestlist,0.5)
+      (acceptable, connected, has_excp) = select.select(requestlist,connectlist,requestlist + connectlist,get_selector_timeout())
     
-      # Add all the sockets with exceptions to the acceptable list
-      for sock in has_excp:
+      # Add all the sockets with exceptions, and the connecting sockets
+      # that are done, to the acceptable list
+      for sock in has_excp + connected:
         if sock not in acceptable:
           acceptable.append(sock)
 
@@ -614,6 +1636,15 @@ class SocketSelector(threading.Thread):
         except:
           pass
 
+      # and each connecting socket
+      for socket in connectlist:
+        try:
+          (read_will_block, write_will_block) = socket_state(socket, "w")
+          if not write_will_block:
+            readylist.append(socket)
+        except:
+          pass
+
       # Return the ready list
       return readylist
 
@@ -632,10 +1663,11 @@ class SocketSelector(threading.Thread):
 
       # If the last sample with 0 ready sockets was less than TIME_BETWEEN_SAMPLES
       # seconds ago, sleep a while. This is to prevent a tight loop from consuming
-      # CPU time doing nothing.
+      # CPU time doing nothing.   epoll blocks until there is something to do,
+      # so this isn't needed (and only adds latency) when we use it.
       current_time = nonportable.getruntime()
       time_diff = current_time - last_sample
-      if time_diff < TIME_BETWEEN_SAMPLES:
+      if selector_epoll is None and time_diff < TIME_BETWEEN_SAMPLES:
         time.sleep(TIME_BETWEEN_SAMPLES - time_diff)
 
       # Get all the ready sockets
@@ -654,19 +1686,57 @@ class SocketSelector(threading.Thread):
           # let's skip this one, it's likely it was closed in the interim
           continue
 
+        # An openconn_async socket is connected or has failed
+        if 'connect' in commtableentry:
+          finish_connect(commhandle, None)
+          continue
+
+        # Don't report data again while the recv callback is running
+        if commtableentry.get('recvcallback') is not None:
+          if commtableentry.get('recvbusy'):
+            continue
+          commtableentry['recvbusy'] = True
+
+        # UDP sockets with a queue are read in batches.   The messages are
+        # delivered as events become free, so don't wait for one here.
+        if 'queue' in commtableentry:
+          # wait if already oversubscribed
+          if is_loopback(commtableentry['localip']):
+            nanny.tattle_quantity('looprecv',0)
+          else:
+            nanny.tattle_quantity('netrecv',0)
+
+          queue_udp_messages(commtableentry)
+          continue
+
         # now it's time to get the event...   I'll loop until there is a free
         # event
         eventhandle = idhelper.getuniqueid()
         wait_for_event(eventhandle)
 
-        # wait if already oversubscribed
-        if is_loopback(commtableentry['localip']):
+        # wait if already oversubscribed.   recv() charges connections by
+        # their remote host.
+        if commtableentry.get('recvcallback') is not None:
+          loopback = is_loopback(commtableentry['remotehost'])
+        else:
+          loopback = is_loopback(commtableentry['localip'])
+        if loopback:
           nanny.tattle_quantity('looprecv',0)
         else:
           nanny.tattle_quantity('netrecv',0)
 
         # Now I can start a thread to run the user's code...
         start_event(commtableentry,commhandle,eventhandle)
+
+      # Start connections that were waiting for an old socket to go away,
+      # and report those that failed or timed out
+      for commhandle in get_cleanup_connects(nonportable.getruntime()):
+        retry_connect_cleanup(commhandle)
+      for (commhandle, error) in get_due_connects(nonportable.getruntime()):
+        finish_connect(commhandle, error)
+
+      # Start events for any queued messages
+      dispatch_queued_messages()
       
 
 
@@ -675,7 +1745,29 @@ class SocketSelector(threading.Thread):
 
 
 
-# this gives an actual event to the user's code
+# Runs the user's function for an event in the current thread.   Each event
+# gets a new and unique thread name, even if the thread is reused.
+def run_event(function, args, eventid):
+  threading.currentThread().setName(idhelper.get_new_thread_name(COMM_PREFIX))
+  try:
+    function(*args)
+  except:
+    # we probably should exit if they raise an exception in a thread...
+    tracebackrepy.handle_exception()
+    harshexit.harshexit(14)
+
+  finally:
+    # our event is going away...
+    nanny.tattle_remove_item('events',eventid)
+
+    # ...so a queued message can have it
+    if udp_pending_entries:
+      dispatch_queued_messages()
+
+
+
+# this gives an actual event to the user's code.   This is only used when the
+# worker pool is disabled.
 class EventDeliverer(threading.Thread):
   func = None
   args = None
@@ -686,21 +1778,106 @@ class EventDeliverer(threading.Thread):
     self.args = a
     self.eventid = e
 
-    # Initialize with a custom and unique thread name
-    threading.Thread.__init__(self,name=idhelper.get_new_thread_name(COMM_PREFIX))
+    # run_event gives the thread a unique name
+    threading.Thread.__init__(self,name="EventDeliverer")
 
   def run(self):
-    try:
-      self.func(*(self.args))
-    except:
-      # we probably should exit if they raise an exception in a thread...
-      tracebackrepy.handle_exception()
-      harshexit.harshexit(14)
+    run_event(self.func, self.args, self.eventid)
+
+
+
+
+# Events are normally run by a pool of worker threads instead of starting a
+# thread for each one.   Set this to False to use a thread per event.
+use_event_pool = True
+
+# Protects the pool.   event_pool_cond is used to wake idle workers.
+event_pool_lock = threading.Lock()
+event_pool_cond = threading.Condition(event_pool_lock)
+
+# The events that are waiting for a worker: (function, args, eventid)
+event_pool_queue = collections.deque()
+
+# The number of worker threads and how many of them are waiting for an event
+event_pool_info = {'workers':0, 'idle':0}
+
+
+# The largest number of workers.   Every event holds an item of the 'events'
+# resource while it runs, so we never need more workers than that.
+def get_event_pool_size():
+  try:
+    return max(1, int(nanny.resource_restriction_table['events']))
+  except (KeyError, TypeError, ValueError):
+    return 1
+
+
+
+# A thread that runs events from the queue.   Workers are never stopped, but
+# there are at most get_event_pool_size() of them.   (Python 2's timed
+# Condition.wait() polls, so an idle timeout would add latency to every event)
+class EventWorker(threading.Thread):
+
+  def __init__(self):
+    threading.Thread.__init__(self,name="EventWorker")
+    # Idle workers shouldn't keep the process alive.   repy.py doesn't count
+    # them when it checks for pending events.
+    self.setDaemon(True)
+
+  def run(self):
+    while True:
+      event_pool_cond.acquire()
+      try:
+        while not event_pool_queue:
+          event_pool_info['idle'] += 1
+          event_pool_cond.wait()
+          event_pool_info['idle'] -= 1
+
+        function, args, eventid = event_pool_queue.popleft()
+      finally:
+        event_pool_cond.release()
+
+      run_event(function, args, eventid)
+
+
+
+# Hands an event to a worker, starting one if needed.   The caller must
+# already hold the event item (see wait_for_event).
+def deliver_event(function, args, eventid):
+  if not use_event_pool:
+    EventDeliverer(function, args, eventid).start()
+    return
+
+  event_pool_cond.acquire()
+  try:
+    event_pool_queue.append((function, args, eventid))
+
+    # If there are enough idle workers for the whole queue, wake one
+    if event_pool_info['idle'] >= len(event_pool_queue):
+      event_pool_cond.notify()
+
+    # Otherwise start a new worker if there is room.   If there isn't, the
+    # event will be run when a worker finishes.
+    elif event_pool_info['workers'] < get_event_pool_size():
+      try:
+        EventWorker().start()
+      except:
+        event_pool_queue.pop()
+        raise
+      event_pool_info['workers'] += 1
+
+  finally:
+    event_pool_cond.release()
 
-    finally:
-      # our event is going away...
-      nanny.tattle_remove_item('events',self.eventid)
-      
+
+
+# Returns the number of worker threads that are idle.   Workers that have an
+# event waiting for them are not idle.
+def get_idle_event_workers():
+  event_pool_cond.acquire()
+  try:
+    return max(0, event_pool_info['idle'] - len(event_pool_queue))
+  finally:
+    event_pool_cond.release()
 
 
 
@@ -739,36 +1916,150 @@ def check_selector():
 
 # return the table entry for this type of socket, ip, port 
 def find_tip_entry(socktype, ip, port):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['type'] == socktype and comminfo[commhandle]['localip'] == ip and comminfo[commhandle]['localport'] == port:
-      return comminfo[commhandle], commhandle
+  for outgoing in [False, True]:
+    commhandle = comminfo.find_by_tipo(socktype, ip, port, outgoing)
+    if commhandle is not None:
+      try:
+        return comminfo[commhandle], commhandle
+      except KeyError:
+        pass
   return (None,None)
 
 
 
-# Find a commhandle, given TIPO: type, ip, port, outgoing
-def find_tipo_commhandle(socktype, ip, port, outgoing):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['type'] == socktype and comminfo[commhandle]['localip'] == ip and comminfo[commhandle]['localport'] == port and comminfo[commhandle]['outgoing'] == outgoing:
-      return commhandle
-  return None
+# Find a commhandle, given TIPO: type, ip, port, outgoing
+def find_tipo_commhandle(socktype, ip, port, outgoing):
+  return comminfo.find_by_tipo(socktype, ip, port, outgoing)
+
+
+# Find an outgoing TCP commhandle, given local ip, local port, remote ip, remote port, 
+def find_outgoing_tcp_commhandle(localip, localport, remoteip, remoteport):
+  return comminfo.find_outgoing_tcp(localip, localport, remoteip, remoteport)
+
+
+
+
+
+
+######################### Simple Public Functions ##########################
+
+
+# How long a successful look up is remembered, how long a name that doesn't
+# exist is remembered and the most names that are remembered, oldest use first
+RESOLVER_CACHE_TTL = 60.0   # In seconds
+RESOLVER_CACHE_NEGATIVE_TTL = 10.0   # In seconds
+RESOLVER_CACHE_SIZE = 256
+
+# These errors mean the name doesn't exist, so they can be cached.   Other
+# errors (like EAI_AGAIN) may go away if we try again.
+NEGATIVE_RESOLVER_ERRORS = set()
+for errorname in ['EAI_NONAME', 'EAI_NODATA']:
+  if hasattr(socket, errorname):
+    NEGATIVE_RESOLVER_ERRORS.add(getattr(socket, errorname))
+
+
+class ResolverCache:
+  """
+  <Purpose>
+    Remembers the results of a resolver function, including names that don't
+    exist, for a limited time.   When full, the least recently used name is
+    forgotten.
+
+  <Side Effects>
+    Updates nonportable.resolver_cache_stats.
+  """
+
+  def __init__(self, resolver, ttl=RESOLVER_CACHE_TTL, negativettl=RESOLVER_CACHE_NEGATIVE_TTL, size=RESOLVER_CACHE_SIZE):
+    self.resolver = resolver
+    self.ttl = ttl
+    self.negativettl = negativettl
+    self.size = size
+
+    # name -> (expiretime, result, error).   One of result and error is None.
+    # The most recently used name is last.
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+
+  def lookup(self, name, missfunc=None):
+    """
+    <Purpose>
+      Returns the result of resolver(name), from the cache if possible.
+
+    <Arguments>
+      name:
+        The name to look up.
+      missfunc:
+        If given, this is called with no arguments before the resolver is
+        called.   An exception it raises prevents the look up.
+
+    <Exceptions>
+      As from the resolver.   Errors in NEGATIVE_RESOLVER_ERRORS are
+      raised again from the cache.
+
+    <Returns>
+      The result of resolver(name).
+    """
+    self.lock.acquire()
+    try:
+      if name in self.entries:
+        (expiretime, result, error) = self.entries.pop(name)
+        if nonportable.getruntime() < expiretime:
+          # Move it to the end, since it was used most recently
+          self.entries[name] = (expiretime, result, error)
+          nonportable.resolver_cache_stats['resolverhits'] += 1
+          if error is not None:
+            raise error
+          return result
+      nonportable.resolver_cache_stats['resolvermisses'] += 1
+    finally:
+      self.lock.release()
+
+    # Don't hold the lock while looking up, it may take a while
+    if missfunc is not None:
+      missfunc()
+
+    try:
+      result = self.resolver(name)
+    except (socket.gaierror, socket.herror), e:
+      if e.args and e.args[0] in NEGATIVE_RESOLVER_ERRORS:
+        self._add(name, self.negativettl, None, e)
+      raise
+
+    self._add(name, self.ttl, result, None)
+    return result
 
 
-# Find an outgoing TCP commhandle, given local ip, local port, remote ip, remote port, 
-def find_outgoing_tcp_commhandle(localip, localport, remoteip, remoteport):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['type'] == "TCP" and comminfo[commhandle]['localip'] == localip \
-    and comminfo[commhandle]['localport'] == localport and comminfo[commhandle]['remotehost'] == remoteip \
-    and comminfo[commhandle]['remoteport'] == remoteport and comminfo[commhandle]['outgoing'] == True:
-      return commhandle
-  return None
+  def _add(self, name, ttl, result, error):
+    self.lock.acquire()
+    try:
+      self.entries.pop(name, None)
+      self.entries[name] = (nonportable.getruntime() + ttl, result, error)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+    finally:
+      self.lock.release()
 
 
+  def clear(self):
+    # Forget every name
+    self.lock.acquire()
+    try:
+      self.entries.clear()
+    finally:
+      self.lock.release()
+
 
 
+# The cache used by gethostbyname_ex
+resolver_cache = ResolverCache(socket.gethostbyname_ex)
 
 
-######################### Simple Public Functions ##########################
+def charge_resolver_lookup():
+  # charge 4K for a look up...   I don't know the right number, but we should
+  # charge something.   We'll always charge to the netsend interface...
+  nanny.tattle_quantity('netsend',4096) 
+  nanny.tattle_quantity('netrecv',4096)
 
 
 
@@ -777,6 +2068,7 @@ def gethostbyname_ex(name):
   """
    <Purpose>
       Provides information about a hostname.   Calls socket.gethostbyname_ex()
+      unless the answer is in the resolver cache.
 
    <Arguments>
       name:
@@ -786,7 +2078,7 @@ def gethostbyname_ex(name):
       As from socket.gethostbyname_ex()
 
    <Side Effects>
-      None.
+      Network resources are only charged if the name isn't in the cache.
 
    <Returns>
       A tuple containing (hostname, aliaslist, ipaddrlist).   See the 
@@ -795,11 +2087,7 @@ def gethostbyname_ex(name):
 
   restrictions.assertisallowed('gethostbyname_ex',name)
 
-  # charge 4K for a look up...   I don't know the right number, but we should
-  # charge something.   We'll always charge to the netsend interface...
-  nanny.tattle_quantity('netsend',4096) 
-  nanny.tattle_quantity('netrecv',4096)
-  return socket.gethostbyname_ex(name)
+  return resolver_cache.lookup(name, charge_resolver_lookup)
 
 
 
@@ -808,6 +2096,8 @@ def getmyip():
   """
    <Purpose>
       Provides the external IP of this computer.   Does some clever trickery.
+      The answer is cached until it is old or the network configuration
+      changes (see IPDiscoveryCache).
 
    <Arguments>
       None
@@ -824,15 +2114,21 @@ def getmyip():
   """
 
   restrictions.assertisallowed('getmyip')
-  # I got some of this from: http://groups.google.com/group/comp.lang.python/browse_thread/thread/d931cdc326d7032b?hl=en
   
-  # Update the cache and return the first allowed IP
+  # Return the first allowed IP, updating the cache if needed
   # Only if a preference is set
   if user_ip_interface_preferences:
-    update_ip_cache()
-    # Return the first allowed ip, there is always at least 1 element (loopback)
-    return allowediplist[0]
-  
+    # There is always at least 1 element (loopback)
+    return allowed_ip_cache.get()[0]
+
+  return external_ip_cache.get()
+
+
+
+# Does the work for getmyip when there are no IP / interface preferences
+def find_external_ip():
+  # I got some of this from: http://groups.google.com/group/comp.lang.python/browse_thread/thread/d931cdc326d7032b?hl=en
+
   # Initialize these to None, so we can detect a failure
   myip = None
   
@@ -866,6 +2162,11 @@ def getmyip():
 
 
 
+# The IP returned by getmyip when there are no IP / interface preferences
+external_ip_cache = IPDiscoveryCache(find_external_ip)
+
+
+
 def get_localIP_to_remoteIP(connection_type, external_ip, external_port=80):
   """
   <Purpose>
@@ -1022,20 +2323,33 @@ def cleanup(handle):
   # if it's in the table then remove the entry and tattle...
   try:
     if handle in comminfo:
-      # Armon: Shutdown the socket for writing prior to close
-      # to unblock any threads that are writing
-      try:
-        comminfo[handle]['socket'].shutdown(socket.SHUT_WR)
-      except:
-        pass
+      # The SocketSelector must stop watching the socket before it is closed
+      # and the descriptor can be reused
+      if not comminfo[handle]['outgoing'] or 'connect' in comminfo[handle] or 'recvcallback' in comminfo[handle]:
+        remove_pending_connect(handle)
+        unregister_selector_socket(comminfo[handle]['socket'])
 
-      try:
-        comminfo[handle]['socket'].close()
-      except:
-        pass
-      
       info = comminfo[handle]  # Store the info
 
+      # A connection's context wakes up threads blocked in recv / send and
+      # closes the socket once they are done with it
+      if info.get('context') is not None:
+        info['context'].close()
+
+      else:
+        # Armon: Shutdown the socket for writing prior to close
+        # to unblock any threads that are writing
+        try:
+          info['socket'].shutdown(socket.SHUT_WR)
+        except:
+          pass
+
+        close_real_socket(info['socket'])
+
+      # Messages that were never delivered are dropped
+      if 'queue' in info:
+        discard_udp_messages(info)
+
       if info['outgoing']:
         nanny.tattle_remove_item('outsockets', handle)
       else:
@@ -1073,6 +2387,145 @@ def cleanup(handle):
 
 
 
+# sendmess keeps a few idle sockets for messages that don't need a specific
+# local port, so it doesn't create and close a socket for every message.
+# These are only bound to a random port, so they never hold a messport and
+# are not charged as outsockets (just like the sockets they replace).
+
+# The most idle sockets kept for each local IP
+SEND_SOCKET_POOL_SIZE = 4
+
+# Idle sockets that haven't been used for this many seconds are closed
+SEND_SOCKET_IDLE_TIME = 10.0
+
+# localip (None for any) -> list of (socket, getruntime() when it was
+# released)
+send_socket_pool = {}
+send_socket_pool_lock = threading.Lock()
+
+# The SendSocketEvictor, while there are sockets in the pool
+send_socket_evictor = None
+
+
+# Private.   Closes the sockets that have been idle for too long.   Returns
+# when the next of the remaining sockets should be closed, or None if the
+# pool is empty.   The caller must hold send_socket_pool_lock
+def evict_idle_send_sockets(now):
+  nextevict = None
+  for localip in send_socket_pool.keys():
+    keep = []
+    for (sock, releasetime) in send_socket_pool[localip]:
+      if now - releasetime < SEND_SOCKET_IDLE_TIME:
+        keep.append((sock, releasetime))
+        evicttime = releasetime + SEND_SOCKET_IDLE_TIME
+        if nextevict is None or evicttime < nextevict:
+          nextevict = evicttime
+      else:
+        try:
+          sock.close()
+        except:
+          pass
+
+    if keep:
+      send_socket_pool[localip] = keep
+    else:
+      del send_socket_pool[localip]
+
+  return nextevict
+
+
+
+# Closes the pooled send sockets as they become idle, so a program that stops
+# sending doesn't keep them (and their ports) open.   It exits when the pool
+# is empty and release_send_socket() starts a new one when needed.
+class SendSocketEvictor(threading.Thread):
+
+  def __init__(self):
+    threading.Thread.__init__(self,name="SendSocketEvictor")
+    # repy.py doesn't count this when it checks for pending events
+    self.setDaemon(True)
+
+  def run(self):
+    global send_socket_evictor
+
+    while True:
+      send_socket_pool_lock.acquire()
+      try:
+        nextevict = evict_idle_send_sockets(nonportable.getruntime())
+        if nextevict is None:
+          send_socket_evictor = None
+          return
+      finally:
+        send_socket_pool_lock.release()
+
+      time.sleep(max(0.0, nextevict - nonportable.getruntime()))
+
+
+
+# Returns the number of threads that don't run events for the program and
+# shouldn't keep it from exiting: idle event workers and the
+# SendSocketEvictor.
+def get_idle_internal_threads():
+  idlethreads = get_idle_event_workers()
+  if send_socket_evictor is not None:
+    idlethreads = idlethreads + 1
+  return idlethreads
+
+
+
+# Private.   Returns a UDP socket for sendmess that is bound to localip and a
+# random port.   Give it back with release_send_socket().
+def get_send_socket(localip):
+  send_socket_pool_lock.acquire()
+  try:
+    if send_socket_pool.get(localip):
+      # Use the one that was used last
+      return send_socket_pool[localip].pop()[0]
+  finally:
+    send_socket_pool_lock.release()
+
+  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  # the send buffer must also be set or it will constrain UDP sendmess
+  # size on Mac. 
+  s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, get_socket_buffer_size('udpbuffer', DEFAULT_UDP_BUFFER_SIZE))
+
+  if localip:
+    try:
+      s.bind((localip,0))
+    except socket.error, e:
+      s.close()
+      raise Exception, e
+
+  return s
+
+
+
+# Private.   Puts a socket from get_send_socket() back in the pool or closes
+# it if the pool is full.
+def release_send_socket(localip, sock):
+  global send_socket_evictor
+
+  send_socket_pool_lock.acquire()
+  try:
+    pool = send_socket_pool.setdefault(localip, [])
+    if len(pool) < SEND_SOCKET_POOL_SIZE:
+      pool.append((sock, nonportable.getruntime()))
+      if send_socket_evictor is None:
+        send_socket_evictor = SendSocketEvictor()
+        send_socket_evictor.start()
+      return
+  finally:
+    send_socket_pool_lock.release()
+
+  try:
+    sock.close()
+  except:
+    pass
+
+
+
+
 # Public interface!!!
 def sendmess(desthost, destport, message,localip=None,localport = None):
   """
@@ -1150,38 +2603,62 @@ def sendmess(desthost, destport, message,localip=None,localport = None):
     # no, we'll skip
     commhandle = None
 
+  if is_loopback(desthost):
+    sendresource = 'loopsend'
+  else:
+    sendresource = 'netsend'
+
   # yes it does! let's use the existing socket
   if commhandle:
 
-    # block in case we're oversubscribed
-    if is_loopback(desthost):
-      nanny.tattle_quantity('loopsend',0)
-    else:
-      nanny.tattle_quantity('netsend',0)
+    # block in case we're oversubscribed and reserve the message's charge
+    reservation = nanny.reserve_quantity(sendresource,len(message))
 
     # try to send using this socket
     try:
       bytessent =  commtableentry['socket'].sendto(message,(desthost,destport))
     except socket.error,e:
+      nanny.commit_quantity(reservation,0)
       # we're going to save this error in case we also get an error below.   
       # This is likely to be the error we actually want to raise
       firsterror = e
       # should I really fall through here?
     else:
-      # send succeeded, let's wait and return
-      if is_loopback(desthost):
-        nanny.tattle_quantity('loopsend',bytessent)
-      else:
-        nanny.tattle_quantity('netsend',bytessent)
+      # send succeeded, let's return
+      nanny.commit_quantity(reservation,bytessent)
       return bytessent
   
 
+  # Sockets with a random local port are reused
+  if not localport:
+    s = get_send_socket(localip)
+
+    # wait if already oversubscribed and reserve the message's charge
+    reservation = nanny.reserve_quantity(sendresource,len(message))
+
+    try:
+      bytessent =  s.sendto(message,(desthost,destport))
+    except:
+      nanny.commit_quantity(reservation,0)
+      # Don't reuse a socket that had an error
+      try:
+        s.close()
+      except:
+        pass
+      raise
+
+    nanny.commit_quantity(reservation,bytessent)
+    release_send_socket(localip, s)
+
+    return bytessent
+
+
   # open a new socket
   s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
  
   # the send buffer must also be set or it will constrain UDP sendmess
   # size on Mac. 
-  s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 66000)
+  s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, get_socket_buffer_size('udpbuffer', DEFAULT_UDP_BUFFER_SIZE))
 
   try:
     if localip:
@@ -1192,18 +2669,14 @@ def sendmess(desthost, destport, message,localip=None,localport = None):
           raise Exception, firsterror
         raise Exception, e
 
-    # wait if already oversubscribed
-    if is_loopback(desthost):
-      nanny.tattle_quantity('loopsend',0)
-    else:
-      nanny.tattle_quantity('netsend',0)
-
-    bytessent =  s.sendto(message,(desthost,destport))
+    # wait if already oversubscribed and reserve the message's charge
+    reservation = nanny.reserve_quantity(sendresource,len(message))
 
-    if is_loopback(desthost):
-      nanny.tattle_quantity('loopsend',bytessent)
-    else:
-      nanny.tattle_quantity('netsend',bytessent)
+    bytessent = 0
+    try:
+      bytessent =  s.sendto(message,(desthost,destport))
+    finally:
+      nanny.commit_quantity(reservation,bytessent)
 
     return bytessent
 
@@ -1311,14 +2784,16 @@ def recvmess(localip, localport, function):
   try:
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.bind((localip,localport))
+    nonportable.socket_table_changed()
 
     # set the receive buffer size to slightly more than 64K+e (see ticket #887)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 66000)
-    # the send buffer must also be set or it will constrain UDP sendmess
-    # size on Mac.   I set it here because this socket may be used for sending
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 66000)
+    # The send buffer is set too because this socket may be used for sending
+    set_socket_buffer_sizes(s, 'UDP')
 
     nonportable.preparesocket(s)
+
+    # let the SocketSelector know about it
+    register_selector_socket(s)
   except:
     try:
       s.close()
@@ -1329,6 +2804,9 @@ def recvmess(localip, localport, function):
 
   # set up our table entry
   comminfo[handle] = {'type':'UDP','localip':localip, 'localport':localport,'function':function,'socket':s, 'outgoing':False, 'closing_lock':threading.Lock() }
+  if batch_udp_receive:
+    comminfo[handle]['queue'] = collections.deque()
+    comminfo[handle]['pending'] = False
 
   # start the selector if it's not running already
   check_selector()
@@ -1380,6 +2858,72 @@ def openconn(desthost, destport,localip=None, localport=None,timeout=None):
       recv, and close just like you would an actual socket object in python.
   """
 
+  (localip, localport, timeout) = check_openconn_args(desthost, destport, localip, localport, timeout)
+  
+  # Get our start time
+  starttime = nonportable.getruntime()
+
+  wait_for_outgoing_socket_cleanup(localip, localport, desthost, destport, starttime, timeout)
+
+  handle = create_outgoing_socket(localip, localport)
+
+  try:
+    thissock = emulated_socket(handle)
+    # We set a timeout before we connect.  This allows us to timeout slow 
+    # connections...
+    oldtimeout = comminfo[handle]['socket'].gettimeout()
+ 
+    # Set the new timeout
+    comminfo[handle]['socket'].settimeout(timeout)
+
+    # Store exceptions until we exit the loop, default to timed out
+    # in case we are given a very small timeout
+    connect_exception = Exception("Connection timed out!")
+
+    # Ignore errors and retry if we have not yet reached the timeout
+    while nonportable.getruntime() - starttime < timeout:
+      try:
+        comminfo[handle]['socket'].connect((desthost,destport))
+        break
+      except Exception,e:
+        # Check if the socket is already connected (EISCONN or WSAEISCONN)
+        if is_already_connected_exception(e):
+          break
+
+        # Check if this is recoverable, only continue if it is
+        elif not is_recoverable_network_exception(e):
+          raise
+
+        else:
+          # Store the exception
+          connect_exception = e
+
+        # Sleep a bit, avoid excessive iterations of the loop
+        time.sleep(0.2)
+    else:
+      # Raise any exception that was raised
+      if connect_exception != None:
+        raise connect_exception
+
+    nonportable.socket_table_changed()
+
+    # This updates the index as well
+    comminfo.set_remote_address(handle, desthost, destport)
+  
+  except:
+    cleanup(handle)
+    raise
+  else:
+    # and restore the old timeout...
+    comminfo[handle]['socket'].settimeout(oldtimeout)
+
+  return thissock
+
+
+
+# Private.   Checks the arguments to openconn and openconn_async and fills in
+# the defaults.   Returns (localip, localport, timeout).
+def check_openconn_args(desthost, destport, localip, localport, timeout):
   # Set a default timeout of 5 seconds if none is specified.
   if timeout is None:
     timeout = 5.0
@@ -1428,36 +2972,53 @@ def openconn(desthost, destport,localip=None, localport=None,timeout=None):
     localip = getmyip()
 
   restrictions.assertisallowed('openconn',desthost,destport,localip,localport)
-  
-  # Get our start time
-  starttime = nonportable.getruntime()
 
+  return (localip, localport, timeout)
+
+
+
+# Private.   Raises an exception if the outgoing socket is already in use,
+# and waits (until starttime + timeout) if it is still being closed.
+def wait_for_outgoing_socket_cleanup(localip, localport, desthost, destport, starttime, timeout):
   # Armon: Check for any pre-existing sockets. If they are being closed, wait for them.
   # This will also serve to check if repy has a pre-existing socket open on this same tuple
   exists = True
   while exists and nonportable.getruntime() - starttime < timeout:
     # Update the status
-    (exists, status) = nonportable.os_api.exists_outgoing_network_socket(localip,localport,desthost,destport)
+    exists = check_outgoing_socket(localip, localport, desthost, destport)
     if exists:
-      # Check the socket state
-      if "ESTABLISH" in status or "CLOSE_WAIT" in status:
-        # Check if the socket is from this repy vessel
-        handle = find_outgoing_tcp_commhandle(localip, localport, desthost, destport)
-        
-        message = "Network socket is in use by an external process!"
-        if handle != None:
-          message = " Duplicate handle exists with name: "+str(handle)
-        
-        raise Exception, message
-      else:
-        # Wait for socket cleanup
-        time.sleep(RETRY_INTERVAL)
+      # Wait for socket cleanup
+      time.sleep(RETRY_INTERVAL)
   else:
     # Check if a socket exists still and we timed out
     if exists:
       raise Exception, "Timed out checking for socket cleanup!"
-        
 
+
+
+# Private.   Returns True if a socket with these addresses exists and is being
+# closed.   Raises an exception if it is in use.
+def check_outgoing_socket(localip, localport, desthost, destport):
+  (exists, status) = nonportable.os_api.exists_outgoing_network_socket(localip,localport,desthost,destport)
+  if exists:
+    # Check the socket state
+    if "ESTABLISH" in status or "CLOSE_WAIT" in status:
+      # Check if the socket is from this repy vessel
+      handle = find_outgoing_tcp_commhandle(localip, localport, desthost, destport)
+      
+      message = "Network socket is in use by an external process!"
+      if handle != None:
+        message = " Duplicate handle exists with name: "+str(handle)
+      
+      raise Exception, message
+
+  return exists
+
+
+
+# Private.   Charges an outsocket, creates the (unconnected) socket and adds
+# it to the comminfo table.   Returns the new handle.
+def create_outgoing_socket(localip, localport):
   if localport:
     nanny.tattle_check('connport',localport)
 
@@ -1477,8 +3038,7 @@ def openconn(desthost, destport,localip=None, localport=None,timeout=None):
     s = get_real_socket(localip,localport)
 
     # prevent excessive TCP buffering (#895)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 10000)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 10000)
+    set_socket_buffer_sizes(s, 'TCP')
 
   
     # add the socket to the comminfo table
@@ -1488,56 +3048,83 @@ def openconn(desthost, destport,localip=None, localport=None,timeout=None):
     nanny.tattle_remove_item('outsockets',handle)
     raise
 
+  return handle
 
-  try:
-    thissock = emulated_socket(handle)
-    # We set a timeout before we connect.  This allows us to timeout slow 
-    # connections...
-    oldtimeout = comminfo[handle]['socket'].gettimeout()
- 
-    # Set the new timeout
-    comminfo[handle]['socket'].settimeout(timeout)
 
-    # Store exceptions until we exit the loop, default to timed out
-    # in case we are given a very small timeout
-    connect_exception = Exception("Connection timed out!")
 
-    # Ignore errors and retry if we have not yet reached the timeout
-    while nonportable.getruntime() - starttime < timeout:
-      try:
-        comminfo[handle]['socket'].connect((desthost,destport))
-        break
-      except Exception,e:
-        # Check if the socket is already connected (EISCONN or WSAEISCONN)
-        if is_already_connected_exception(e):
-          break
 
-        # Check if this is recoverable, only continue if it is
-        elif not is_recoverable_network_exception(e):
-          raise
+# Public interface!!!
+def openconn_async(desthost, destport, function, localip=None, localport=None, timeout=None):
+  """
+   <Purpose>
+      Starts opening a connection and returns right away.   The SocketSelector
+      waits for the connection and then calls function.   This lets a program
+      open many connections at once without a thread for each.
+
+   <Arguments>
+      desthost:
+         The host to open communcations with
+      destport:
+         The port to use for communication
+      function:
+         The function to call when the connection is open or has failed.
+         It is called with (desthost, destport, socketlikeobj, commhandle,
+         error).   If the connection failed socketlikeobj is None and error
+         is a string describing the problem, otherwise error is None.
+      localip (optional):
+         The local ip to use for the communication
+      localport (optional):
+         The local port to use for communication (0 for a random port).   If
+         a socket with the same addresses is still being closed, the
+         SocketSelector waits for it before connecting.
+      timeout (optional):
+         The maximum amount of time to wait to connect (including waiting
+         for an old socket to be closed)
+
+   <Exceptions>
+      As from openconn for bad arguments, if the addresses are in use or if
+      a socket can't be created.   Problems connecting are passed to function
+      instead.
+
+   <Side Effects>
+      The connection is charged as an outsocket from now on.   Needs an
+      event for the SocketSelector (if it isn't running) and one to call
+      function.
+
+   <Returns>
+      A commhandle.   stopcomm() on this handle stops a connection that is
+      still being opened (function isn't called).
+  """
+
+  (localip, localport, timeout) = check_openconn_args(desthost, destport, localip, localport, timeout)
+
+  starttime = nonportable.getruntime()
+
+  # If an old socket with these addresses is still being closed, the
+  # SocketSelector waits for it instead of us
+  waitforcleanup = check_outgoing_socket(localip, localport, desthost, destport)
+
+  handle = create_outgoing_socket(localip, localport)
 
-        else:
-          # Store the exception
-          connect_exception = e
+  try:
+    # This makes the real socket non-blocking
+    thissock = emulated_socket(handle)
 
-        # Sleep a bit, avoid excessive iterations of the loop
-        time.sleep(0.2)
+    comminfo[handle]['connect'] = {'function':function, 'desthost':desthost, 'destport':destport, 'socketobj':thissock, 'started':False}
+    if waitforcleanup:
+      add_pending_connect(handle, starttime + timeout, 0, starttime + RETRY_INTERVAL)
     else:
-      # Raise any exception that was raised
-      if connect_exception != None:
-        raise connect_exception
+      # An error here is reported to function like any other
+      start_connect(handle, starttime + timeout)
 
-    comminfo[handle]['remotehost']=desthost
-    comminfo[handle]['remoteport']=destport
-  
   except:
     cleanup(handle)
     raise
-  else:
-    # and restore the old timeout...
-    comminfo[handle]['socket'].settimeout(oldtimeout)
 
-  return thissock
+  # start the selector if it's not running already
+  check_selector()
+
+  return handle
 
 
 
@@ -1618,11 +3205,15 @@ def waitforconn(localip, localport,function):
     mainsock = get_real_socket(localip,localport)
 
     # prevent excessive TCP buffering (#895)
-    mainsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 10000)
-    mainsock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 10000)
+    set_socket_buffer_sizes(mainsock, 'TCP')
 
     # NOTE: Should this be anything other than a hardcoded number?
     mainsock.listen(5)
+    nonportable.socket_table_changed()
+
+    # let the SocketSelector know about it
+    register_selector_socket(mainsock)
+
     # set up our table entry
     comminfo[handle] = {'type':'TCP','remotehost':None, 'remoteport':None,'localip':localip,'localport':localport,'socket':mainsock, 'outgoing':False, 'function':function, 'closing_lock':threading.Lock()}
   except:
@@ -1684,6 +3275,7 @@ def socket_state(realsock, waitfor="rw", timeout=0.0):
 
     timeout:
               An optional timeout to wait for the socket to be read or write ready.
+              None waits forever.
 
   <Returns>
     A tuple, (read_will_block, write_will_block).
@@ -1696,6 +3288,9 @@ def socket_state(realsock, waitfor="rw", timeout=0.0):
   if waitfor not in ["rw","r","w"]:
     raise Exception, "Illegal waitfor argument!"
 
+  if socket_state_use_poll:
+    return poll_socket_state(realsock, waitfor, timeout)
+
   # Array to hold the socket
   sock_array = [realsock]
 
@@ -1721,7 +3316,179 @@ def socket_state(realsock, waitfor="rw", timeout=0.0):
 
 
 
+# select() can't check descriptors above FD_SETSIZE (usually 1024), which a
+# program with many connections soon has.   poll() doesn't have that limit,
+# so use it where we can.
+socket_state_use_poll = hasattr(select, 'poll')
+
+# poll() flags that mean the socket is closed or has an error
+POLL_ERROR_EVENTS = 0
+if socket_state_use_poll:
+  POLL_ERROR_EVENTS = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+# The same as socket_state, using poll()
+def poll_socket_state(realsock, waitfor, timeout):
+  sockfd = realsock.fileno()
+
+  # POLLPRI is what select() reports as an exception
+  eventmask = select.POLLPRI
+  if "r" in waitfor:
+    eventmask = eventmask | select.POLLIN
+  if "w" in waitfor:
+    eventmask = eventmask | select.POLLOUT
+
+  poller = select.poll()
+  poller.register(sockfd, eventmask)
+
+  # poll() takes milliseconds
+  if timeout is not None:
+    timeout = int(timeout * 1000)
+
+  readable = False
+  writeable = False
+  for (fd, events) in poller.poll(timeout):
+    # select() raises EBADF for a closed socket
+    if events & select.POLLNVAL:
+      raise select.error(errno.EBADF, os.strerror(errno.EBADF))
+
+    # Just as select() puts it in the exception list
+    if events & (POLL_ERROR_EVENTS | select.POLLPRI):
+      return (False, False)
+
+    readable = (events & select.POLLIN) != 0
+    writeable = (events & select.POLLOUT) != 0
+
+  return (not readable, not writeable)
+
+
+
 # Public.   We pass these to the users for communication purposes
+class ConnectionContext:
+  """
+  What send() and recv() need to know about a connection: the real socket,
+  whether it is loopback, which resources to charge and the buffer sizes.
+  This is worked out the first time the connection is used instead of on
+  every call (the remote end of a connection doesn't change).   See
+  get_connection_context().
+  """
+  def __init__(self, entry):
+    self.socket = entry['socket']
+
+    # The threads waiting in recv() / send() and whether the connection was
+    # closed (see start_wait and close)
+    self.waiters = 0
+    self.closed = False
+    self.waitlock = threading.Lock()
+
+    self.loopback = is_loopback(entry['remotehost'])
+    if self.loopback:
+      self.sendresource = 'loopsend'
+      self.recvresource = 'looprecv'
+    else:
+      self.sendresource = 'netsend'
+      self.recvresource = 'netrecv'
+
+    # We'll send less than the send buffer size to avoid a bug
+    self.sendbuffersize = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    self.recvbuffersize = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    # How much the last recv() read.   The next one is charged for this much
+    # up front (see _do_recv)
+    self.lastrecvsize = 0
+
+    # The SO_RCVBUF and SO_SNDBUF sizes we asked for, if auto-tuning (see
+    # grow_socket_buffer)
+    self.autotune = None
+    if get_socket_buffer_size('tcpbuffermax', 0):
+      size = get_socket_buffer_size('tcpbuffer', DEFAULT_TCP_BUFFER_SIZE)
+      self.autotune = {socket.SO_RCVBUF:size, socket.SO_SNDBUF:size}
+
+
+  # recv() and send() call this before they wait on the socket, and
+  # end_wait() when they are done.   Returns False if it was closed.
+  def start_wait(self):
+    self.waitlock.acquire()
+    try:
+      if self.closed:
+        return False
+      self.waiters = self.waiters + 1
+      return True
+    finally:
+      self.waitlock.release()
+
+
+  def end_wait(self):
+    self.waitlock.acquire()
+    try:
+      self.waiters = self.waiters - 1
+      if self.closed and self.waiters == 0:
+        close_real_socket(self.socket)
+    finally:
+      self.waitlock.release()
+
+
+  # Called by cleanup().   Shutting the socket down makes it readable and
+  # writable, which wakes any thread waiting on it.   Those threads may be
+  # about to wait on the descriptor, so it is only closed when the last one
+  # is done with it (so they never wait on a reused descriptor).
+  def close(self):
+    self.waitlock.acquire()
+    try:
+      self.closed = True
+      try:
+        self.socket.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        # It isn't connected anymore
+        pass
+      if self.waiters == 0:
+        close_real_socket(self.socket)
+    finally:
+      self.waitlock.release()
+
+
+
+# Closes a real socket, ignoring errors
+def close_real_socket(realsocket):
+  try:
+    realsocket.close()
+  except:
+    pass
+  nonportable.socket_table_changed()
+
+
+
+def get_connection_context(handle):
+  """
+  <Purpose>
+    Returns the ConnectionContext for a connection, making it if needed.
+
+  <Arguments>
+    handle:
+      The connection's commhandle.
+
+  <Exceptions>
+    Exception if the socket is closed.
+
+  <Returns>
+    The ConnectionContext.
+  """
+  try:
+    entry = comminfo[handle]
+    context = entry.get('context')
+    if context is None:
+      context = ConnectionContext(entry)
+      entry['context'] = context
+    return context
+
+  # they likely closed the connection
+  except KeyError:
+    raise Exception, "Socket closed"
+  except socket.error:
+    raise Exception, "Socket closed"
+
+
+
 class emulated_socket:
   # This is an index into the comminfo table...
 
@@ -1741,14 +3508,8 @@ class emulated_socket:
     # Make the socket non-blocking
     realsocket.setblocking(0)
 
-    try:
-      # Store the send buffer size.   We'll send less than this to avoid a bug
-      comminfo[handle]['sendbuffersize'] = realsocket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
-
-    # Really shouldn't happen.   We just checked!
-    except KeyError:
-      raise Exception, "Internal Error. No table entry when looking up sendbuffersize for new socket!"
-
+    # The ConnectionContext (send buffer size, etc.) is made when the
+    # connection is first used.   The remote end isn't known yet for openconn.
 
     return None 
 
@@ -1807,41 +3568,110 @@ class emulated_socket:
     mycommid = self.commid
     restrictions.assertisallowed('socket.recv',bytes)
 
+    def readfunc(realsocket):
+      datarecvd = realsocket.recv(bytes)
+      return datarecvd, len(datarecvd)
+
+    return self._do_recv(mycommid, readfunc, bytes)
+
+
+
+  def recv_into(self, bufferobj, bytes=None, offset=0):
+    """
+      <Purpose>
+        Receives data from a socket directly into a buffer from
+        createbuffer().   This avoids creating a new string for every call.
+        It may receive fewer bytes than requested.
+
+      <Arguments>
+        bufferobj:
+           The buffer to store the data in.
+        bytes (optional):
+           The maximum number of bytes to read.   By default this is the
+           space left in the buffer after offset.
+        offset (optional):
+           Where in the buffer to store the data.
+
+      <Exceptions>
+        Exception if the socket is closed either locally or remotely.
+        ValueError if the data wouldn't fit in the buffer.
+
+      <Side Effects>
+        This call will block the thread until the other side calls send.
+
+      <Returns>
+        The number of bytes stored in the buffer.
+    """
+    # prevent TOCTOU race with client changing the object's properties
+    mycommid = self.commid
+
+    buffersize = len(bufferobj.data)
+    if bytes is None:
+      bytes = buffersize - offset
+
+    if offset < 0 or bytes < 0 or offset + bytes > buffersize:
+      raise ValueError("Can't receive "+str(bytes)+" bytes at offset "+str(offset)+" in a buffer of size "+str(buffersize))
+
+    # This is the same permission as recv
+    restrictions.assertisallowed('socket.recv',bytes)
+
+    view = _saved_memoryview(bufferobj.data)[offset:offset+bytes]
+
+    def readfunc(realsocket):
+      bytesrecvd = realsocket.recv_into(view, bytes)
+      return bytesrecvd, bytesrecvd
+
+    return self._do_recv(mycommid, readfunc, bytes)
+
+
+
+  # Private.   Waits until the socket is readable and calls
+  # readfunc(realsocket), which returns what it read and the number of bytes.
+  # bytes is the most readfunc will read.   This does the accounting and
+  # returns what readfunc did.
+  def _do_recv(self, mycommid, readfunc, bytes):
     # I set this here so that I don't screw up accounting with a keyerror later
-    try:
-      this_is_loopback = is_loopback(comminfo[mycommid]['remotehost'])
-    # they likely closed the connection
-    except KeyError:
+    context = get_connection_context(mycommid)
+
+    # If the socket is closed in another thread, cleanup() shuts it down,
+    # which wakes us up
+    if not context.start_wait():
       raise Exception, "Socket closed"
+    try:
+      return self._wait_and_recv(mycommid, context, readfunc, bytes)
+    finally:
+      context.end_wait()
 
-    # wait if already oversubscribed
-    if this_is_loopback:
-      nanny.tattle_quantity('looprecv',0)
-    else:
-      nanny.tattle_quantity('netrecv',0)
 
-    datarecvd = 0
+
+  # Private.   The rest of _do_recv, while counted as a waiter.
+  def _wait_and_recv(self, mycommid, context, readfunc, bytes):
+    realsocket = context.socket
+
+    # Programs tend to read the same amount each time, so guess that this
+    # read gets as much as the last one.   A wrong guess is corrected after.
+    estimate = min(bytes, context.lastrecvsize)
+
     # loop until we recv the information (looping is needed for Windows)
     while True:
+      # they likely closed the connection
+      if mycommid not in comminfo:
+        raise Exception, "Socket closed"
+
       try:
-        # the timeout is needed so that if the socket is closed in another 
-        # thread, we notice it
-        # BUG: What should the timeout be?   What is the right value?
-        #comminfo[mycommid]['socket'].settimeout(0.2)
-        
-        # Armon: Get the real socket
-        realsocket = comminfo[mycommid]['socket']
-	
         # Check if the socket is ready for reading
-        (read_will_block, write_will_block) = socket_state(realsocket, "r", 0.2)	
+        (read_will_block, write_will_block) = socket_state(realsocket, "r", None)
         if not read_will_block:
-          datarecvd = realsocket.recv(bytes)
+          # wait if already oversubscribed and reserve the estimate.   This is
+          # corrected to what was read.
+          reservation = nanny.reserve_quantity(context.recvresource,estimate)
+          data_length = 0
+          try:
+            (result, data_length) = readfunc(realsocket)
+          finally:
+            nanny.commit_quantity(reservation,data_length)
           break
 
-      # they likely closed the connection
-      except KeyError:
-        raise Exception, "Socket closed"
-
       # Catch all other exceptions, check if they are recoverable
       except Exception, e:
         # Check if this error is recoverable
@@ -1856,20 +3686,17 @@ class emulated_socket:
           else:
             raise
 
-    # Armon: Calculate the length of the data
-    data_length = len(datarecvd)
-    
     # Raise an exception if there was no data
     if data_length == 0:
       raise Exception("Socket closed")
 
-    # do accounting here...
-    if this_is_loopback:
-      nanny.tattle_quantity('looprecv',data_length)
-    else:
-      nanny.tattle_quantity('netrecv',data_length)
+    context.lastrecvsize = data_length
 
-    return datarecvd
+    # A read that takes half the receive buffer means the buffer is filling
+    if data_length * 2 >= context.recvbuffersize:
+      grow_socket_buffer(context, socket.SO_RCVBUF)
+
+    return result
 
 
 
@@ -1896,41 +3723,88 @@ class emulated_socket:
     mycommid = self.commid
     restrictions.assertisallowed('socket.send',message)
 
+    return self._do_send(mycommid, message)
+
+
+
+  def sendmany(self, messagelist):
+    """
+      <Purpose>
+        Sends several strings on a socket, as though they were joined
+        together and passed to send().   This is checked and charged once for
+        all of them.   It may send fewer bytes than requested.
+
+      <Arguments>
+        messagelist:
+          The list of strings to send.
+
+      <Exceptions>
+        Exception if the socket is closed either locally or remotely.
+
+      <Side Effects>
+        This call may block the thread until the other side calls recv.
+
+      <Returns>
+        The number of bytes sent.   Be sure not to assume this is always the 
+        complete amount!
+    """
+    # prevent TOCTOU race with client changing the object's properties
+    mycommid = self.commid
+
+    # Python 2 sockets have no sendmsg / writev, so we join the strings and
+    # make a single send call.
+    message = "".join(messagelist)
+    restrictions.assertisallowed('socket.send',message)
+
+    return self._do_send(mycommid, message)
+
+
+
+  # Private.   Sends message on the socket, waiting until it is writable, and
+  # does the accounting.   Returns the number of bytes sent.
+  def _do_send(self, mycommid, message):
     # I factor this out because we must do the accounting at the bottom of this
     # function and I want to make sure we account properly even if they close 
     # the socket right after their data is sent
+    context = get_connection_context(mycommid)
+    if not context.start_wait():
+      raise Exception, "Socket closed"
     try:
-      this_is_loopback = is_loopback(comminfo[mycommid]['remotehost'])
-    except KeyError:
-      raise Exception, "Socket closed!"
+      return self._wait_and_send(mycommid, context, message)
+    finally:
+      context.end_wait()
 
-    # wait if already oversubscribed
-    if this_is_loopback:
-      nanny.tattle_quantity('loopsend',0)
-    else:
-      nanny.tattle_quantity('netsend',0)
 
-    try:
-      # Trim the message size to be less than the sendbuffersize.
-      # This is a fix for http://support.microsoft.com/kb/823764
-      message = message[:comminfo[mycommid]['sendbuffersize']-1]
-    except KeyError:
-      raise Exception, "Socket closed!"
+
+  # Private.   The rest of _do_send, while counted as a waiter.
+  def _wait_and_send(self, mycommid, context, message):
+    realsocket = context.socket
+
+    # Trim the message size to be less than the sendbuffersize.
+    # This is a fix for http://support.microsoft.com/kb/823764
+    sendlimit = context.sendbuffersize-1
+    trimmed = len(message) > sendlimit
+    message = message[:sendlimit]
 
     # loop until we send the information (looping is needed for Windows)
     while True:
+      if mycommid not in comminfo:
+        raise Exception, "Socket closed"
+
       try:
-        # Armon: Get the real socket
-        realsocket = comminfo[mycommid]['socket']
-	
-        # Check if the socket is ready for writing, wait 0.2 seconds
-        (read_will_block, write_will_block) = socket_state(realsocket, "w", 0.2)
+        # Check if the socket is ready for writing.   We wait until it is
+        # (or the socket is closed).
+        (read_will_block, write_will_block) = socket_state(realsocket, "w", None)
         if not write_will_block:
-          bytessent = realsocket.send(message)
+          # wait if already oversubscribed and reserve the message's 
+          # charge.   This is corrected if less is sent.
+          reservation = nanny.reserve_quantity(context.sendresource,len(message))
+          bytessent = 0
+          try:
+            bytessent = realsocket.send(message)
+          finally:
+            nanny.commit_quantity(reservation,bytessent)
           break
-      
-      except KeyError:
-        raise Exception, "Socket closed"
 
       except Exception,e:
         # Determine if the exception is fatal
@@ -1943,10 +3817,9 @@ class emulated_socket:
           else:
             raise
 
-    if this_is_loopback:
-      nanny.tattle_quantity('loopsend',bytessent)
-    else:
-      nanny.tattle_quantity('netsend',bytessent)
+    # The program has more to send than the send buffer holds
+    if trimmed:
+      grow_socket_buffer(context, socket.SO_SNDBUF)
 
     return bytessent
 
@@ -1987,9 +3860,151 @@ class emulated_socket:
 
 
 
+  def setrecvcallback(self, function):
+    """
+    <Purpose>
+      Has the SocketSelector call function(socketlikeobj) in an event when
+      there is data to recv() (or the connection was closed), instead of
+      having a thread wait in recv().   function isn't called again until
+      it returns.
+
+    <Arguments>
+      function:
+        The function to call, or None to stop calling it.
+
+    <Exceptions>
+      Socket Closed if the socket has been closed.
+
+    <Side Effects>
+      The socket stays open while there is a callback, even if nothing
+      else refers to it.   Needs an event for the SocketSelector if it isn't
+      running.
+
+    <Returns>
+      None.
+    """
+    # This is a check of socket.recv since that is what function will do
+    restrictions.assertisallowed('socket.recv', 0)
+
+    try:
+      entry = comminfo[self.commid]
+    except KeyError:
+      raise Exception, "Socket closed"
+
+    entry['closing_lock'].acquire()
+    try:
+      # It may have been closed while we waited for the lock
+      if self.commid not in comminfo:
+        raise Exception, "Socket closed"
+
+      if function is None:
+        if entry.get('recvcallback') is not None:
+          unregister_selector_socket(entry['socket'])
+          entry['recvcallback'] = None
+          del entry['recvsocketobj']
+        return
+
+      # Just replace the function if we are already watching the socket
+      if entry.get('recvcallback') is not None:
+        entry['recvcallback'] = function
+        return
+
+      entry['recvcallback'] = function
+      entry['recvsocketobj'] = self
+      entry['recvbusy'] = False
+      register_selector_socket(entry['socket'], RECV_CALLBACK_SELECTOR_EVENTS)
+    finally:
+      entry['closing_lock'].release()
+
+    # start the selector if it's not running already
+    check_selector()
+
+
+
   def __del__(self):
     cleanup(self.commid)
 
 
 
 # End of emulated_socket class
+
+
+
+
+# Public.   A buffer that socket.recv_into() can store data in.   Users get
+# these from createbuffer().
+class emulated_buffer:
+
+  def __init__(self, size):
+    self.data = _saved_bytearray(size)
+
+
+  def getsize(self):
+    """
+      <Purpose>
+        Returns the size of the buffer.
+
+      <Arguments>
+        None
+
+      <Exceptions>
+        None
+
+      <Side Effects>
+        None
+
+      <Returns>
+        The size of the buffer in bytes.
+    """
+    return len(self.data)
+
+
+  def getdata(self, start=0, end=None):
+    """
+      <Purpose>
+        Returns a copy of (part of) the buffer's contents.
+
+      <Arguments>
+        start (optional):
+           The index of the first byte to return.
+        end (optional):
+           One past the index of the last byte to return.   By default, this
+           is the end of the buffer.
+
+      <Exceptions>
+        None
+
+      <Side Effects>
+        None
+
+      <Returns>
+        The data as a string.
+    """
+    return _saved_memoryview(self.data)[start:end].tobytes()
+
+
+
+# Public interface!!!
+def createbuffer(size):
+  """
+   <Purpose>
+      Creates a buffer that socket.recv_into() can store data in.   A buffer
+      can be reused for many calls, so no new string is needed for each one.
+
+   <Arguments>
+      size:
+         The size of the buffer in bytes.
+
+   <Exceptions>
+      ValueError if the size is negative.
+
+   <Side Effects>
+      None.   (The memory used is charged like any other memory.)
+
+   <Returns>
+      The buffer object.
+  """
+  if size < 0:
+    raise ValueError("Buffer size must not be negative")
+
+  return emulated_buffer(size)
@@ -89,6 +89,7 @@ def removefile(filename):
         raise Exception, 'File "'+filename+'" is open with handle "'+filehandle+'"'
 
     result = os.remove(filename)
+    nanny.tattle_file_removed(filename)
   finally:
     fileinfolock.release()
 
@@ -154,6 +155,7 @@ def emulated_open(filename, mode="rb"):
   elif mode == "w" or mode == "w+":
     file_object = emulated_file(filename, "rw", create=True)
     fileinfo[file_object.filehandle]['fobj'].truncate()
+    nanny.tattle_file_size(filename, 0)
 
   elif mode == "a" or mode == "a+":
     file_object = emulated_file(filename, "rw", create=True)
@@ -314,6 +316,7 @@ class emulated_file:
         created_file = myfile(filename, 'wb')
         created_file.close()
         nanny.tattle_remove_item('filesopened', self.filehandle)
+        nanny.tattle_file_size(filename, 0)
 
       self.filehandle = idhelper.getuniqueid()
 
@@ -392,11 +395,13 @@ class emulated_file:
       raise IOError("file.next() is invalid for write-enabled files.")
 
     # wait if it's already over used
-    nanny.tattle_quantity('fileread',0)
+    reservation = nanny.reserve_quantity('fileread',0)
 
-    readdata = fileinfo[myfilehandle]['fobj'].next()
-
-    nanny.tattle_quantity('fileread', len(readdata))
+    readdata = ''
+    try:
+      readdata = fileinfo[myfilehandle]['fobj'].next()
+    finally:
+      nanny.commit_quantity(reservation,len(readdata))
 
     return readdata
 
@@ -414,15 +419,27 @@ class emulated_file:
     if len(args) == 1 and type(args[0]) != int:
       raise TypeError("file.read() expects an integer argument")
 
-    # wait if it's already over used
-    nanny.tattle_quantity('fileread',0)
-
     try:
-      readdata = fileinfo[myfilehandle]['fobj'].read(*args)
+      fobj = fileinfo[myfilehandle]['fobj']
     except KeyError:
       raise ValueError("Invalid file object (probably closed).")
 
-    nanny.tattle_quantity('fileread',len(readdata))
+    # wait if it's already over used and reserve the charge for what the
+    # read should get (the rest of the file, or less if they asked for less).
+    # If this is wrong, it's corrected after the read.
+    try:
+      estimate = max(0, os.fstat(fobj.fileno()).st_size - fobj.tell())
+    except (OSError, IOError, ValueError):
+      estimate = 0
+    if len(args) == 1 and args[0] >= 0:
+      estimate = min(estimate, args[0])
+    reservation = nanny.reserve_quantity('fileread',estimate)
+
+    readdata = ''
+    try:
+      readdata = fobj.read(*args)
+    finally:
+      nanny.commit_quantity(reservation,len(readdata))
 
     return readdata
 
@@ -433,14 +450,15 @@ class emulated_file:
     restrictions.assertisallowed('file.readline',*args)
 
     # wait if it's already over used
-    nanny.tattle_quantity('fileread',0)
+    reservation = nanny.reserve_quantity('fileread',0)
 
+    readdata = ''
     try:
       readdata =  fileinfo[myfilehandle]['fobj'].readline(*args)
     except KeyError:
       raise ValueError("Invalid file object (probably closed).")
-
-    nanny.tattle_quantity('fileread',len(readdata))
+    finally:
+      nanny.commit_quantity(reservation,len(readdata))
 
     return readdata
 
@@ -451,18 +469,19 @@ class emulated_file:
     restrictions.assertisallowed('file.readlines',*args)
 
     # wait if it's already over used
-    nanny.tattle_quantity('fileread',0)
+    reservation = nanny.reserve_quantity('fileread',0)
 
+    readlist = []
     try:
       readlist = fileinfo[myfilehandle]['fobj'].readlines(*args)
     except KeyError:
       raise ValueError("Invalid file object (probably closed).")
+    finally:
+      readamt = 0
+      for readitem in readlist:
+        readamt = readamt + len(str(readitem))
 
-    readamt = 0
-    for readitem in readlist:
-      readamt = readamt + len(str(readitem))
-
-    nanny.tattle_quantity('fileread',readamt)
+      nanny.commit_quantity(reservation,readamt)
 
     return readlist
 
@@ -480,19 +499,23 @@ class emulated_file:
     myfilehandle = self.filehandle
     restrictions.assertisallowed('file.write',writeitem)
 
-    # wait if it's already over used
-    nanny.tattle_quantity('filewrite',0)
-
-    if "w" in self.mode:
-      try:
-        retval = fileinfo[myfilehandle]['fobj'].write(writeitem)
-      except KeyError:
-        raise ValueError("Invalid file object (probably closed).")
-    else:
+    if "w" not in self.mode:
       raise ValueError("write() isn't allowed on read-only file objects!")
 
+    # wait if it's already over used and reserve the write's charge
     writeamt = len(str(writeitem))
-    nanny.tattle_quantity('filewrite',writeamt)
+    reservation = nanny.reserve_quantity('filewrite',writeamt)
+
+    writtenamt = 0
+    try:
+      fobj = fileinfo[myfilehandle]['fobj']
+      retval = fobj.write(writeitem)
+      writtenamt = writeamt
+      nanny.tattle_file_extended(fileinfo[myfilehandle]['filename'], fobj.tell())
+    except KeyError:
+      raise ValueError("Invalid file object (probably closed).")
+    finally:
+      nanny.commit_quantity(reservation,writtenamt)
 
     return retval
 
@@ -502,21 +525,33 @@ class emulated_file:
     myfilehandle = self.filehandle
     restrictions.assertisallowed('file.writelines',writelist)
 
-    # wait if it's already over used
-    nanny.tattle_quantity('filewrite',0)
-
     if "w" not in self.mode:
       raise ValueError("writelines() isn't allowed on read-only file objects!")
     
     try:
       fh = fileinfo[myfilehandle]['fobj']
+      filename = fileinfo[myfilehandle]['filename']
     except KeyError:
       raise ValueError("Invalid file object (probably closed).")
 
+    strlist = []
     for writeitem in writelist:
-      strtowrite = str(writeitem)
-      fileinfo[myfilehandle]['fobj'].write(strtowrite)
-      nanny.tattle_quantity('filewrite', len(strtowrite))
+      strlist.append(str(writeitem))
+
+    # wait if it's already over used and reserve the charge for all of the writes
+    writeamt = 0
+    for strtowrite in strlist:
+      writeamt = writeamt + len(strtowrite)
+    reservation = nanny.reserve_quantity('filewrite',writeamt)
+
+    writtenamt = 0
+    try:
+      for strtowrite in strlist:
+        fh.write(strtowrite)
+        writtenamt = writtenamt + len(strtowrite)
+      nanny.tattle_file_extended(filename, fh.tell())
+    finally:
+      nanny.commit_quantity(reservation,writtenamt)
 
     return None   # python documentation states there is no return value
 
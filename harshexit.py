@@ -24,6 +24,12 @@ except:
 # need for status retrieval
 import statusstorage
 
+# may write out which calls used which resources
+import resource_attribution
+
+# may write out the resource use samples
+import resource_timeseries
+
 # This prevents writes to the nanny's status information after we want to stop
 statuslock = statusstorage.statuslock
 
@@ -111,6 +117,11 @@ def harshexit(val):
 
     # We intentionally do not release the lock.   We don't want anyone else 
     # writing over our status information (we're killing them).
+
+    # Write out the per-call resource table and the resource use samples if
+    # we were asked to
+    resource_attribution.dump_at_exit()
+    resource_timeseries.dump_at_exit()
     
 
   if ostype == 'Linux':
@@ -16,9 +16,14 @@ import nix_common_api as nix_api # Import the Common API
 import textops      # Import seattlelib's text processing lib
 import portable_popen  # For Popen
 
+import socket       # For converting the addresses in /proc/net
+import struct
+import threading    # To protect the socket snapshot
+import time         # To know when the socket snapshot is too old
+import ctypes       # For clock_gettime
+import ctypes.util  # To find librt
+
 # Manually import the common functions we want
-exists_outgoing_network_socket = nix_api.exists_outgoing_network_socket
-exists_listening_network_socket = nix_api.exists_listening_network_socket
 get_available_interfaces = nix_api.get_available_interfaces
 
 # Libc
@@ -81,28 +86,90 @@ FIELDS = {
 "delayacct_blkio_ticks":40
 }
 
-# Process a /proc/PID/stat or /proc/PID/task/TID/stat file and returns it as an array
-def _process_stat_file(file):
-  # Get the file in proc
-  fileo = open(file,"r")
+# The fields we use from the stat files.   They are counted from the state
+# field, which is the first one after the command name.   The command name
+# is in parentheses and may contain spaces (or parentheses), so the fields
+# are found after the last ")".
+STAT_STATE = 0
+STAT_UTIME = FIELDS["utime"] - FIELDS["state"]
+STAT_STIME = FIELDS["stime"] - FIELDS["state"]
+STAT_RSS = FIELDS["rss"] - FIELDS["state"]
+
+# A stat file is much smaller than this
+STAT_READ_SIZE = 4096
+
+# The /proc/PID/stat files are kept open and read again from the start each
+# time, instead of being opened for every sample.   The lock keeps threads
+# from seeking a shared descriptor under each other.   A forked child shares
+# the file offsets with its parent, so it opens its own (stat_file_pid is
+# the process the descriptors belong to).
+stat_file_descriptors = {}
+stat_file_lock = threading.Lock()
+stat_file_pid = None
+
+
+def _read_stat_file(filename):
+  """
+  <Purpose>
+    Reads a /proc stat file using a descriptor that is kept open.
 
-  # Read in all the data
-  data = fileo.read()
+  <Arguments>
+    filename: The stat file, e.g. "/proc/1234/stat"
 
-  # Close the file object
-  fileo.close()
+  <Exceptions>
+    OSError if the file can't be opened or read (the process is gone).
 
-  # Strip the newline
-  data = data.strip("\n")
+  <Returns>
+    The contents of the file.
+  """
+  global stat_file_pid
+
+  stat_file_lock.acquire()
+  try:
+    if stat_file_pid != os.getpid():
+      for fd in stat_file_descriptors.values():
+        os.close(fd)
+      stat_file_descriptors.clear()
+      stat_file_pid = os.getpid()
+
+    fd = stat_file_descriptors.get(filename)
+    if fd is None:
+      fd = os.open(filename, os.O_RDONLY)
+      stat_file_descriptors[filename] = fd
+
+    try:
+      os.lseek(fd, 0, 0)
+      data = os.read(fd, STAT_READ_SIZE)
+    except OSError:
+      # The process is gone.   If its pid is used again, open the new one.
+      del stat_file_descriptors[filename]
+      os.close(fd)
+      raise
+
+    if not data:
+      del stat_file_descriptors[filename]
+      os.close(fd)
+      raise OSError, "'" + filename + "' is empty (the process is gone)"
+
+    return data
+  finally:
+    stat_file_lock.release()
+
+
+def _parse_stat_fields(data):
+  """
+  <Purpose>
+    Pulls the fields we use out of the contents of a stat file.   Only the
+    fields up to the RSS are split apart.
 
-  # Remove the substring that says "(python)", since it changes the field alignment
-  start_index = data.find("(")
-  if start_index != -1:
-    end_index = data.find(")", start_index)
-    data = data[:start_index-1] + data[end_index+1:]
+  <Arguments>
+    data: The contents of a /proc/PID/stat or /proc/PID/task/TID/stat file
 
-  # Break the data into an array by spaces
-  return data.split(" ")
+  <Returns>
+    A list of the fields from the state to the RSS (and then the rest of
+    the line), to be indexed with the STAT_ constants.
+  """
+  return data[data.rfind(")") + 2:].split(" ", STAT_RSS + 1)
 
 
 def _get_proc_info_by_pid(pid):
@@ -115,14 +182,11 @@ def _get_proc_info_by_pid(pid):
   """
   global last_stat_data
 
-  # Get the file in proc
-  file = "/proc/"+str(pid)+"/stat"
-
   # Process the status file
-  last_stat_data = _process_stat_file(file)
+  last_stat_data = _parse_stat_fields(_read_stat_file("/proc/"+str(pid)+"/stat"))
   
   # Check the state, raise an exception if the process is a zombie
-  if "Z" in last_stat_data[FIELDS["state"]]:
+  if "Z" in last_stat_data[STAT_STATE]:
     raise Exception, "Queried Process is a zombie (dead)!"
   
   
@@ -143,7 +207,7 @@ def get_process_cpu_time(pid):
   _get_proc_info_by_pid(pid)
   
   # Get the raw usertime and system time
-  total_time_raw = int(last_stat_data[FIELDS["utime"]])+int(last_stat_data[FIELDS["stime"]])
+  total_time_raw = int(last_stat_data[STAT_UTIME]) + int(last_stat_data[STAT_STIME])
   
   # Adjust by the number of jiffies per second
   total_time = total_time_raw / JIFFIES_PER_SECOND
@@ -176,7 +240,7 @@ def get_process_rss(force_update=False, pid=None):
     _get_proc_info_by_pid(pid)
 
   # Fetch the RSS, convert to an integer
-  rss_pages = int(last_stat_data[FIELDS["rss"]])
+  rss_pages = int(last_stat_data[STAT_RSS])
   rss_bytes = rss_pages * PAGE_SIZE
 
   # Return the info
@@ -201,20 +265,28 @@ def get_current_thread_cpu_time():
   <Returns>
     A floating amount of time in seconds.
   """
+  # The thread's CPU clock doesn't need a file at all
+  if thread_cpu_clock_available:
+    now = timespec()
+    if _clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(now)) == 0:
+      return now.tv_sec + now.tv_nsec * 1e-9
+
   # Get the thread id
   thread_id = _get_current_thread_id()
 
   # Get our pid
   pid = os.getpid()
 
-  # Get the file with our status
-  file = "/proc/"+str(pid)+"/task/"+str(thread_id)+"/stat"
-
-  # Process the status file
-  thread_stat_data = _process_stat_file(file)
+  # Get the file with our status.   Threads come and go, so this isn't kept
+  # open.
+  fileo = myopen("/proc/"+str(pid)+"/task/"+str(thread_id)+"/stat", "r")
+  try:
+    thread_stat_data = _parse_stat_fields(fileo.read())
+  finally:
+    fileo.close()
 
   # Get the raw usertime and system time
-  total_time_raw = int(thread_stat_data[FIELDS["utime"]])+int(thread_stat_data[FIELDS["stime"]])
+  total_time_raw = int(thread_stat_data[STAT_UTIME]) + int(thread_stat_data[STAT_STIME])
   
   # Adjust by the number of jiffies per second
   total_time = total_time_raw / JIFFIES_PER_SECOND
@@ -285,6 +357,307 @@ def get_uptime_granularity():
     raise Exception, "Could not find /proc/uptime!"  
 
 
+# clock_gettime() clock ids.   CLOCK_BOOTTIME keeps counting while the
+# system is suspended (like /proc/uptime), but only exists on Linux 2.6.39+.
+CLOCK_MONOTONIC = 1
+CLOCK_BOOTTIME = 7
+
+# The CPU time used by the calling thread
+CLOCK_THREAD_CPUTIME_ID = 3
+
+# struct timespec
+class timespec(ctypes.Structure):
+  _fields_ = [("tv_sec", ctypes.c_long),
+              ("tv_nsec", ctypes.c_long)]
+
+
+# clock_gettime() moved from librt into libc in glibc 2.17
+def _find_clock_gettime():
+  try:
+    function = libc.clock_gettime
+  except AttributeError:
+    try:
+      function = ctypes.CDLL(ctypes.util.find_library("rt")).clock_gettime
+    except (AttributeError, OSError):
+      return None
+
+  function.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+  function.restype = ctypes.c_int
+  return function
+
+
+# The clock get_monotonic_time() reads, or None if neither clock works
+_clock_gettime = _find_clock_gettime()
+monotonic_clock_id = None
+if _clock_gettime is not None:
+  for clockid in [CLOCK_BOOTTIME, CLOCK_MONOTONIC]:
+    if _clock_gettime(clockid, ctypes.byref(timespec())) == 0:
+      monotonic_clock_id = clockid
+      break
+
+# get_current_thread_cpu_time() uses the thread's CPU clock if it works
+thread_cpu_clock_available = (_clock_gettime is not None and
+    _clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(timespec())) == 0)
+
+
+def get_monotonic_time():
+  """
+  <Purpose>
+    Returns the time from a clock that never goes backwards.   This doesn't
+    read any files or take any locks, so it is safe and cheap to call from
+    many threads.
+
+  <Exception>
+    Raises Exception if there is no monotonic clock.
+
+  <Returns>
+    The clock's time in seconds, as a float.   Only differences between
+    values are meaningful.
+  """
+  if monotonic_clock_id is None:
+    raise Exception, "No monotonic clock is available!"
+
+  # Each call has its own structure, so threads don't need a lock
+  now = timespec()
+  if _clock_gettime(monotonic_clock_id, ctypes.byref(now)) != 0:
+    raise Exception, "clock_gettime failed: " + nix_api.get_ctypes_error_str()
+
+  return now.tv_sec + now.tv_nsec * 1e-9
+
+
+# The network sockets are read from these files instead of running netstat
+PROC_NET_TCP_FILES = ["/proc/net/tcp", "/proc/net/tcp6"]
+PROC_NET_UDP_FILES = ["/proc/net/udp", "/proc/net/udp6"]
+
+# Maps the TCP state numbers in /proc/net/tcp to the names netstat uses
+TCP_STATES = {
+"01":"ESTABLISHED",
+"02":"SYN_SENT",
+"03":"SYN_RECV",
+"04":"FIN_WAIT1",
+"05":"FIN_WAIT2",
+"06":"TIME_WAIT",
+"07":"CLOSE",
+"08":"CLOSE_WAIT",
+"09":"LAST_ACK",
+"0A":"LISTEN",
+"0B":"CLOSING",
+}
+
+# A snapshot this recent is used instead of reading the files again.   repy
+# calls invalidate_socket_snapshot() when it opens or closes a socket, so a
+# snapshot never misses one of repy's own sockets.
+SOCKET_SNAPSHOT_VALIDITY = 0.05   # In seconds
+
+# The last snapshot from _read_socket_snapshot() and when it was taken.
+# The lock makes concurrent callers share one read.
+socket_snapshot = None
+socket_snapshot_time = 0.0
+socket_snapshot_lock = threading.Lock()
+
+
+def _parse_proc_net_address(address):
+  """
+  <Purpose>
+    Converts an address from /proc/net/{tcp,udp}[6] to an (ip, port) tuple.
+    IPv6 addresses are only converted if they are IPv4-mapped, since that is
+    all repy uses.
+
+  <Arguments>
+    address: The address, e.g. "0100007F:1F90"
+
+  <Returns>
+    A tuple (ip, port) or None if this isn't an IPv4 address
+  """
+  (hexip, hexport) = address.split(":")
+  port = int(hexport, 16)
+
+  # The kernel prints each 32 bit word in host byte order
+  if len(hexip) == 8:
+    return (socket.inet_ntoa(struct.pack("=I", int(hexip, 16))), port)
+
+  # An IPv4-mapped IPv6 address is ::ffff:a.b.c.d
+  if len(hexip) == 32:
+    words = struct.pack("=IIII", int(hexip[0:8], 16), int(hexip[8:16], 16), int(hexip[16:24], 16), int(hexip[24:32], 16))
+    if words[:12] == "\x00" * 10 + "\xff\xff":
+      return (socket.inet_ntoa(words[12:]), port)
+
+  return None
+
+
+def _read_socket_snapshot():
+  """
+  <Purpose>
+    Reads all of the TCP and UDP sockets from /proc/net.
+
+  <Exceptions>
+    IOError if the files can't be read.
+
+  <Returns>
+    A dictionary with three indexes:
+      "tcplisten": The set of (ip, port) for TCP sockets in the LISTEN state
+      "tcpconn": Maps (localip, localport, remoteip, remoteport) to the state
+      "udp": The set of (ip, port) for UDP sockets
+  """
+  snapshot = {"tcplisten":set(), "tcpconn":{}, "udp":set()}
+
+  for (filenames, istcp) in [(PROC_NET_TCP_FILES, True), (PROC_NET_UDP_FILES, False)]:
+    for filename in filenames:
+      # tcp6 and udp6 don't exist if IPv6 is disabled
+      if not os.path.exists(filename):
+        continue
+
+      fh = myopen(filename, 'r')
+      try:
+        # The first line is the header
+        lines = fh.readlines()[1:]
+      finally:
+        fh.close()
+
+      for line in lines:
+        parts = line.split()
+        if len(parts) < 4:
+          continue
+
+        local = _parse_proc_net_address(parts[1])
+        if local is None:
+          continue
+
+        if not istcp:
+          snapshot["udp"].add(local)
+          continue
+
+        state = TCP_STATES.get(parts[3], parts[3])
+        if state == "LISTEN":
+          snapshot["tcplisten"].add(local)
+          continue
+
+        remote = _parse_proc_net_address(parts[2])
+        if remote is not None:
+          snapshot["tcpconn"][local + remote] = state
+
+  return snapshot
+
+
+def get_socket_snapshot(max_age=SOCKET_SNAPSHOT_VALIDITY):
+  """
+  <Purpose>
+    Returns a snapshot of the network sockets (see _read_socket_snapshot).
+    A snapshot taken by any caller in the last max_age seconds is reused.
+
+  <Arguments>
+    max_age: How old the snapshot may be, in seconds.   0 forces a new one.
+
+  <Exceptions>
+    IOError if the files can't be read.
+
+  <Returns>
+    The snapshot dictionary.   It must not be modified.
+  """
+  global socket_snapshot
+  global socket_snapshot_time
+
+  socket_snapshot_lock.acquire()
+  try:
+    now = time.time()
+    if socket_snapshot is None or not (0 <= now - socket_snapshot_time <= max_age):
+      socket_snapshot = _read_socket_snapshot()
+      socket_snapshot_time = time.time()
+    return socket_snapshot
+  finally:
+    socket_snapshot_lock.release()
+
+
+def invalidate_socket_snapshot():
+  """
+  <Purpose>
+    Makes the next get_socket_snapshot() read the files again.   Call this
+    after opening or closing a socket.
+
+  <Returns>
+    None.
+  """
+  global socket_snapshot
+
+  socket_snapshot_lock.acquire()
+  try:
+    socket_snapshot = None
+  finally:
+    socket_snapshot_lock.release()
+
+
+def exists_outgoing_network_socket(localip, localport, remoteip, remoteport):
+  """
+  <Purpose>
+    Determines if there exists a network socket with the specified unique tuple.
+    Assumes TCP.   Uses /proc/net, or netstat if that isn't available.
+
+  <Arguments>
+    localip: The IP address of the local socket
+    localport: The port of the local socket
+    remoteip:  The IP of the remote host
+    remoteport: The port of the remote host
+    
+  <Returns>
+    A Tuple, indicating the existence and state of the socket. E.g. (Exists (True/False), State (String or None))
+  """
+  # This only works if all are not of the None type
+  if not (localip and localport and remoteip and remoteport):
+    return (False, None)
+
+  try:
+    snapshot = get_socket_snapshot()
+    state = snapshot["tcpconn"].get((localip, localport, remoteip, remoteport))
+
+    # Callers wait for a socket to go away, so make sure it is still here
+    if state is not None:
+      snapshot = get_socket_snapshot(0)
+      state = snapshot["tcpconn"].get((localip, localport, remoteip, remoteport))
+  except (IOError, OSError):
+    return nix_api.exists_outgoing_network_socket(localip, localport, remoteip, remoteport)
+
+  if state is None:
+    return (False, None)
+  return (True, state)
+
+
+def exists_listening_network_socket(ip, port, tcp):
+  """
+  <Purpose>
+    Determines if there exists a network socket with the specified ip and port which is the LISTEN state.
+    Uses /proc/net, or netstat if that isn't available.
+  
+  <Arguments>
+    ip: The IP address of the listening socket
+    port: The port of the listening socket
+    tcp: Is the socket of TCP type, else UDP
+    
+  <Returns>
+    True or False.
+  """
+  # This only works if both are not of the None type
+  if not (ip and port):
+    return False
+
+  # UDP connections are stateless, so for TCP check for the LISTEN state
+  # and for UDP, just check that there exists a UDP port
+  if tcp:
+    index = "tcplisten"
+  else:
+    index = "udp"
+
+  try:
+    exists = (ip, port) in get_socket_snapshot()[index]
+
+    # Callers wait for a socket to go away, so make sure it is still here
+    if exists:
+      exists = (ip, port) in get_socket_snapshot(0)[index]
+  except (IOError, OSError):
+    return nix_api.exists_listening_network_socket(ip, port, tcp)
+
+  return exists
+
+
 def get_system_thread_count():
   """
   <Purpose>
@@ -344,3 +717,38 @@ def get_interface_ip_addresses(interfaceName):
 
   # Done, return the interfaces
   return ipaddressList
+
+
+# The files get_network_signature() reads.   The routing table changes when
+# an interface goes up or down or moves to another subnet.   fib_trie also
+# lists each local address, so it changes when an interface is given a new
+# address in the same subnet (which leaves the routes alone).
+NETWORK_SIGNATURE_FILES = ["/proc/net/route", "/proc/net/fib_trie"]
+
+
+def get_network_signature():
+  """
+  <Purpose>
+    Returns something that changes when the network configuration does,
+    so callers can tell if cached addresses may be out of date.   This is
+    the contents of the routing table and the list of local addresses (see
+    NETWORK_SIGNATURE_FILES).
+  
+  <Returns>
+    A string, or None if none of the files can be read.
+  """
+  contents = []
+  for filename in NETWORK_SIGNATURE_FILES:
+    try:
+      fh = myopen(filename, "r")
+      try:
+        contents.append(fh.read())
+      finally:
+        fh.close()
+    except (IOError, OSError):
+      # fib_trie may not exist on old kernels
+      contents.append("")
+
+  if not "".join(contents):
+    return None
+  return "\n".join(contents)
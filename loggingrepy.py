@@ -28,30 +28,34 @@ class flush_logger(loggingrepy_core.flush_logger_core):
 
   def write(self, writeitem):
     restrictions.assertisallowed('log.write', writeitem)
-    # block if already over
-    nanny.tattle_quantity('lograte', 0)
+    # block if already over and reserve the write's charge
+    writeamt = len(str(writeitem))
+    reservation = nanny.reserve_quantity('lograte', writeamt)
 
     # do the actual write
-    loggingrepy_core.flush_logger_core.write(self, writeitem)
-
-    # block if over after log write
-    writeamt = len(str(writeitem))
-    nanny.tattle_quantity('lograte', writeamt)
+    writtenamt = 0
+    try:
+      loggingrepy_core.flush_logger_core.write(self, writeitem)
+      writtenamt = writeamt
+    finally:
+      nanny.commit_quantity(reservation,writtenamt)
 
 
   def writelines(self, writelist):
     restrictions.assertisallowed('log.writelines', writelist)
-    # block if already over
-    nanny.tattle_quantity('lograte', 0)
-
-    # do the actual writelines()
-    loggingrepy_core.flush_logger_core.writelines(self, writelist)
-
-    # block if over after log write
+    # block if already over and reserve the write's charge
     writeamt = 0
     for writeitem in writelist:
       writeamt = writeamt + len(str(writeitem))
-    nanny.tattle_quantity('lograte', writeamt)
+    reservation = nanny.reserve_quantity('lograte', writeamt)
+
+    # do the actual writelines()
+    writtenamt = 0
+    try:
+      loggingrepy_core.flush_logger_core.writelines(self, writelist)
+      writtenamt = writeamt
+    finally:
+      nanny.commit_quantity(reservation,writtenamt)
 
 
 
@@ -90,14 +94,17 @@ class circular_logger(loggingrepy_core.circular_logger_core):
     try:
       if self.should_nanny:
         # Only invoke the nanny if the should_nanny flag is set.
-        # block if already over
-        nanny.tattle_quantity('lograte',0)
-
-      writeamt = self.writedata(writeitem)
+        # block if already over and reserve the write's charge
+        estimate = len(str(writeitem))
+        reservation = nanny.reserve_quantity('lograte',estimate)
 
-      if self.should_nanny:
-        # Only invoke the nanny if the should_nanny flag is set.
-        nanny.tattle_quantity('lograte',writeamt)
+      writeamt = 0
+      try:
+        writeamt = self.writedata(writeitem)
+      finally:
+        if self.should_nanny:
+          # Only invoke the nanny if the should_nanny flag is set.
+          nanny.commit_quantity(reservation,writeamt)
 
     finally:
       self.writelock.release()
@@ -112,16 +119,20 @@ class circular_logger(loggingrepy_core.circular_logger_core):
     try:
       if self.should_nanny:
         # Only invoke the nanny if the should_nanny flag is set.
-        # block if already over
-        nanny.tattle_quantity('lograte',0)
+        # block if already over and reserve the write's charge
+        estimate = 0
+        for writeitem in writelist:
+          estimate = estimate + len(str(writeitem))
+        reservation = nanny.reserve_quantity('lograte',estimate)
   
       writeamt = 0
-      for writeitem in writelist:
-        writeamt = writeamt + self.writedata(writeitem)
-
-      if self.should_nanny:
-        # Only invoke the nanny if the should_nanny flag is set.
-        nanny.tattle_quantity('lograte',writeamt)
+      try:
+        for writeitem in writelist:
+          writeamt = writeamt + self.writedata(writeitem)
+      finally:
+        if self.should_nanny:
+          # Only invoke the nanny if the should_nanny flag is set.
+          nanny.commit_quantity(reservation,writeamt)
   
     finally:
       self.writelock.release()
@@ -78,10 +78,11 @@
     
     FILE_OBJECT_WRAPPER_INFO
     SOCKET_OBJECT_WRAPPER_INFO
+    BUFFER_OBJECT_WRAPPER_INFO
     LOCK_OBJECT_WRAPPER_INFO
     VIRTUAL_NAMESPACE_OBJECT_WRAPPER_INFO
     
-      The above four dictionaries define the methods available on the wrapped
+      The above five dictionaries define the methods available on the wrapped
       objects that are returned by wrapped functions. Additionally, timerhandle
       and commhandle objects are wrapped but instances of these do not have any
       public methods and so no *_WRAPPER_INFO dictionaries are defined for them.
@@ -176,6 +177,7 @@ def _init_namespace():
 # is empty, it means no methods can be called on a wrapped object of that type.
 file_object_wrapped_functions_dict = {}
 socket_object_wrapped_functions_dict = {}
+buffer_object_wrapped_functions_dict = {}
 lock_object_wrapped_functions_dict = {}
 virtual_namespace_object_wrapped_functions_dict = {}
 
@@ -188,6 +190,7 @@ def _prepare_wrapped_functions_for_object_wrappers():
   """
   objects_tuples = [(FILE_OBJECT_WRAPPER_INFO, file_object_wrapped_functions_dict),
                     (SOCKET_OBJECT_WRAPPER_INFO, socket_object_wrapped_functions_dict),
+                    (BUFFER_OBJECT_WRAPPER_INFO, buffer_object_wrapped_functions_dict),
                     (LOCK_OBJECT_WRAPPER_INFO, lock_object_wrapped_functions_dict),
                     (VIRTUAL_NAMESPACE_OBJECT_WRAPPER_INFO, virtual_namespace_object_wrapped_functions_dict)]
   
@@ -486,6 +489,62 @@ def allow_args_openconn(desthost, destport, localip=None, localport=0, timeout=5
 
 
 
+def allow_args_openconn_async_callback(desthost, destport, socketlikeobj, commhandle, error):
+  # The callback function should receive the following arguments:
+  # (desthost, destport, socketlikeobj, commhandle, error)
+  # Either socketlikeobj or error is None.
+
+  _require_string(desthost)
+  _require_integer(destport)
+  if socketlikeobj is None:
+    _require_string(error)
+  else:
+    _require_emulated_socket(socketlikeobj)
+    if error is not None:
+      raise NamespaceRequirementError
+
+
+
+def wrap_args_openconn_async_callback(desthost, destport, socketlikeobj, commhandle, error):
+  """
+  Wrap the socketlikeobj (if there is one) and commhandle passed into the
+  callback function before the callback function is actually called.
+  """
+  if socketlikeobj is not None:
+    socketlikeobj = wrap_socket_obj(socketlikeobj)
+  wrapped_commhandle = wrap_commhandle_obj(commhandle)
+
+  args = (desthost, destport, socketlikeobj, wrapped_commhandle, error)
+  kwargs = {}
+  return args, kwargs
+
+
+
+def allow_args_openconn_async(desthost, destport, function, localip=None, localport=0, timeout=5):
+  _require_user_function(function)
+  allow_args_openconn(desthost, destport, localip, localport, timeout)
+
+
+
+def wrap_args_openconn_async(desthost, destport, function, *args, **kwargs):
+  """
+  Wrap the callback function passed from user code to privileged code, just
+  as wrap_args_waitforconn does.
+  """
+
+  function_info = {'target_func' : function,
+                   'arg_checking_func' : allow_args_openconn_async_callback,
+                   'arg_wrapping_func' : wrap_args_openconn_async_callback,
+                   'return_checking_func' : allow_all}
+  
+  wrapperobj = NamespaceAPIFunctionWrapper(function_info)
+  
+  # The optional arguments are passed on as they were given
+  args = (desthost, destport, wrapperobj.wrapped_function) + args
+  return args, kwargs
+
+
+
 def allow_args_waitforconn_callback(remoteip, remoteport, socketlikeobj, thiscommhandle, listencommhandle):
   # The callback function should receive the following arguments:
   # (remoteip, remoteport, socketlikeobj, thiscommhandle, listencommhandle)
@@ -558,6 +617,11 @@ def allow_args_stopcomm(wrapped_commhandle):
 
 
 
+def allow_args_createbuffer(size):
+  _require_integer(size)
+
+
+
 def allow_args_open(filename, mode='r'):
   _require_string(filename)
   _require_string(mode)
@@ -607,6 +671,12 @@ def wrap_socket_obj(socketobj):
 
 
 
+def wrap_buffer_obj(bufferobj):
+  _require_emulated_buffer(bufferobj)
+  return NamespaceObjectWrapper("buffer", bufferobj, buffer_object_wrapped_functions_dict)
+
+
+
 def wrap_lock_obj(lockobj):
   _require_lock_object(lockobj)
   return NamespaceObjectWrapper("lock", lockobj, lock_object_wrapped_functions_dict)
@@ -709,6 +779,23 @@ USERCONTEXT_WRAPPER_INFO = {
        'return_checking_func' : allow_all,
        'return_wrapping_func' : wrap_socket_obj},
 
+  # reliable comm channel (TCP) that calls a function when it is open
+  'openconn_async' :
+      {'target_func' : emulcomm.openconn_async,
+       'arg_checking_func' : allow_args_openconn_async,
+       'arg_wrapping_func' : wrap_args_openconn_async,
+       'return_checking_func' : allow_all,
+       'return_wrapping_func' : wrap_commhandle_obj},
+
+  # a buffer for socket.recv_into
+  'createbuffer' :
+      {'target_func' : emulcomm.createbuffer,
+       'arg_checking_func' : allow_args_createbuffer,
+       # Even though the checking function is allow_all, the wrapping function
+       # does check the type.
+       'return_checking_func' : allow_all,
+       'return_wrapping_func' : wrap_buffer_obj},
+
   # reliable comm listen (TCP)
   'waitforconn' :
       {'target_func' : emulcomm.waitforconn,
@@ -910,12 +997,79 @@ def allow_args_emulated_socket_send(socket, data):
 
 
 
+def allow_args_emulated_socket_sendmany(socket, messagelist):
+  _require_emulated_socket(socket)
+  # The strings are immutable, so copying the list doesn't copy them
+  if not _is_in(type(messagelist), [list, tuple]):
+    raise NamespaceRequirementError("Expected a list of strings, received " + str(messagelist))
+  for item in messagelist:
+    _require_string(item)
+
+
+
+def allow_args_emulated_socket_setrecvcallback_callback(socketlikeobj):
+  _require_emulated_socket(socketlikeobj)
+
+
+
+def wrap_args_emulated_socket_setrecvcallback_callback(socketlikeobj):
+  """
+  Wrap the socketlikeobj passed into the callback function before the
+  callback function is actually called.
+  """
+  args = (wrap_socket_obj(socketlikeobj),)
+  kwargs = {}
+  return args, kwargs
+
+
+
+def allow_args_emulated_socket_setrecvcallback(socket, function):
+  _require_emulated_socket(socket)
+  if function is not None:
+    _require_user_function(function)
+
+
+
+def wrap_args_emulated_socket_setrecvcallback(socket, function):
+  """
+  Wrap the callback function passed from user code to privileged code, just
+  as wrap_args_waitforconn does.
+  """
+  if function is not None:
+    function_info = {'target_func' : function,
+                     'arg_checking_func' : allow_args_emulated_socket_setrecvcallback_callback,
+                     'arg_wrapping_func' : wrap_args_emulated_socket_setrecvcallback_callback,
+                     'return_checking_func' : allow_all}
+    function = NamespaceAPIFunctionWrapper(function_info).wrapped_function
+
+  args = (socket, function)
+  kwargs = {}
+  return args, kwargs
+
+
+
 def allow_args_emulated_socket_recv(socket, bytes):
   _require_emulated_socket(socket)
   _require_integer(bytes)
 
 
 
+def allow_args_emulated_socket_recv_into(socket, bufferobj, bytes=None, offset=0):
+  _require_emulated_socket(socket)
+  _require_wrapped_buffer(bufferobj)
+  if bytes is not None:
+    _require_integer(bytes)
+  _require_integer(offset)
+
+
+
+def unwrap_args_emulated_socket_recv_into(socket, bufferobj, *args, **kwargs):
+  # The buffer is passed in its wrapper.   The socket is already unwrapped.
+  unwrapped_args = (socket, bufferobj._wrapped__object) + args
+  return unwrapped_args, kwargs
+
+
+
 SOCKET_OBJECT_WRAPPER_INFO = {
   'close' :
       {'target_func' : emulcomm.emulated_socket.close,
@@ -927,11 +1081,31 @@ SOCKET_OBJECT_WRAPPER_INFO = {
        'arg_checking_func' : allow_args_emulated_socket_recv,
        'return_checking_func' : allow_return_string},
        
+  # Stores the data in a buffer from createbuffer() and returns the length
+  'recv_into' :
+      {'target_func' : emulcomm.emulated_socket.recv_into,
+       'arg_checking_func' : allow_args_emulated_socket_recv_into,
+       'arg_unwrapping_func' : unwrap_args_emulated_socket_recv_into,
+       'return_checking_func' : allow_return_integer},
+       
   'send' :
       {'target_func' : emulcomm.emulated_socket.send,
        'arg_checking_func' : allow_args_emulated_socket_send,
        'return_checking_func' : allow_return_integer},
   
+  # Sends a list of strings with one call
+  'sendmany' :
+      {'target_func' : emulcomm.emulated_socket.sendmany,
+       'arg_checking_func' : allow_args_emulated_socket_sendmany,
+       'return_checking_func' : allow_return_integer},
+
+  # Calls a function when there is data to recv()
+  'setrecvcallback' :
+      {'target_func' : emulcomm.emulated_socket.setrecvcallback,
+       'arg_checking_func' : allow_args_emulated_socket_setrecvcallback,
+       'arg_wrapping_func' : wrap_args_emulated_socket_setrecvcallback,
+       'return_checking_func' : allow_return_none},
+
   # Armon: Add the willblock() call. Takes no args, and returns a bool tuple with 2 entries.
   'willblock' :
       {'target_func' : emulcomm.emulated_socket.willblock,
@@ -944,6 +1118,50 @@ SOCKET_OBJECT_WRAPPER_INFO = {
 
 
 
+def _require_emulated_buffer(bufferobj):
+  if not isinstance(bufferobj, emulcomm.emulated_buffer):
+    raise NamespaceRequirementError("Expected emulated_buffer, received " + str(bufferobj))
+
+
+
+def _require_wrapped_buffer(wrappedobj):
+  # Buffers are passed to other functions in their wrappers
+  if not isinstance(wrappedobj, NamespaceObjectWrapper) or \
+      wrappedobj._wrapped__type_name != "buffer":
+    raise NamespaceRequirementError("Expected a buffer, received " + str(wrappedobj))
+  _require_emulated_buffer(wrappedobj._wrapped__object)
+
+
+
+def allow_args_emulated_buffer(bufferobj):
+  _require_emulated_buffer(bufferobj)
+
+
+
+def allow_args_emulated_buffer_getdata(bufferobj, start=0, end=None):
+  _require_emulated_buffer(bufferobj)
+  _require_integer(start)
+  if end is not None:
+    _require_integer(end)
+
+
+
+BUFFER_OBJECT_WRAPPER_INFO = {
+  'getsize' :
+      {'target_func' : emulcomm.emulated_buffer.getsize,
+       'arg_checking_func' : allow_args_emulated_buffer,
+       'return_checking_func' : allow_return_integer},
+
+  'getdata' :
+      {'target_func' : emulcomm.emulated_buffer.getdata,
+       'arg_checking_func' : allow_args_emulated_buffer_getdata,
+       'return_checking_func' : allow_return_string},
+}
+
+
+
+
+
 def _require_lock_object(lockobj):
   # The type(lockobj) is thread.lock, but there is no such thing. So, we use
   # 'isinstance()' here instead of 'is'.
@@ -1276,7 +1494,8 @@ class NamespaceAPIFunctionWrapper(object):
       # is wrapped and the client does not have access to it, it's safe to not
       # wrap it.
       elif isinstance(obj, (NamespaceObjectWrapper, emulfile.emulated_file,
-                            emulcomm.emulated_socket, thread.LockType,
+                            emulcomm.emulated_socket, emulcomm.emulated_buffer,
+                            thread.LockType,
                             virtual_namespace.VirtualNamespace)):
         return obj
       
@@ -29,6 +29,16 @@ import tracebackrepy
 import nanny_resource_limits
 nanny_resource_limits.init(nonportable.getruntime)
 
+# records the use of renewable resources over time
+import resource_timeseries
+resource_timeseries.init(nanny_resource_limits.renewable_resources)
+
+# records which API calls resources are charged to
+import resource_attribution
+
+# for the vessel directory
+import repy_constants
+
 # These are resources that drain / replenish over time
 renewable_resources = nanny_resource_limits.renewable_resources
 
@@ -50,9 +60,12 @@ individual_item_resources = nanny_resource_limits.individual_item_resources
 # Include resources that are fungible vs those that are individual...
 item_resources = fungible_item_resources + individual_item_resources
 
+# Settings for how repy uses the host (socket buffer sizes).   Not consumed.
+setting_resources = nanny_resource_limits.setting_resources
+
 
 # This is used by restrictions.py to set up our tables
-known_resources = quantity_resources + item_resources 
+known_resources = quantity_resources + item_resources + setting_resources
 
 # Whenever a resource file is attached to a vessel, an exception should
 # be thrown if these resources are not present.  If any of these are left
@@ -81,10 +94,26 @@ renewable_resource_lock_table = nanny_resource_limits.renewable_resource_lock_ta
 fungible_resource_lock_table = nanny_resource_limits.fungible_resource_lock_table
 
 
+# Conditions (using the locks above) and waiter counts for
+# tattle_wait_for_item
+fungible_resource_condition_table = nanny_resource_limits.fungible_resource_condition_table
+fungible_resource_waiter_count = nanny_resource_limits.fungible_resource_waiter_count
+
+
+# The size of each file in the vessel directory and the lock that protects it
+# and the running disk use total
+disk_file_sizes = nanny_resource_limits.disk_file_sizes
+disk_use_lock = nanny_resource_limits.disk_use_lock
+
+
 # Set up renewable resources to start now...
 renewable_resource_update_time = nanny_resource_limits.renewable_resource_update_time
 
 
+# The burst allowance of renewable resources (in seconds of their limit)
+renewable_resource_burst_table = nanny_resource_limits.renewable_resource_burst_table
+
+
 # Updates the values in the consumption table (taking the current time into 
 # account)
 def update_resource_consumption_table(resource):
@@ -116,24 +145,62 @@ def update_resource_consumption_table(resource):
 
 
 
-# I want to wait until a resource can be used again...
-def sleep_until_resource_drains(resource):
+# Renewable resources are accounted for with a token bucket.   The bucket
+# holds the burst allowance (limit * burst seconds) and refills at the limit.
+# resource_consumption_table holds how much of the bucket is used, so a
+# program is over quota when the consumption is more than the burst allowance.
+#
+# The resource lock is held only to charge the bucket and work out how long
+# the caller must wait.   The caller sleeps after releasing it.   The bucket
+# drains at a fixed rate, so each caller's wait ends after the waits of the
+# callers that charged before it.   This makes the waiters a FIFO queue
+# without keeping one.
+def charge_renewable_resource(resource, quantity):
+  """
+  <Purpose>
+    Charges a renewable resource and returns how long the caller must wait
+    for the bucket to drain below the burst allowance.   The caller must
+    hold the resource's lock.
+
+  <Arguments>
+    resource:
+      A string with the resource name.
+    quantity:
+      The amount consumed (may be 0).
+
+  <Exceptions>
+    Exception if the resource's limit is 0 (it will never drain).
+
+  <Side Effects>
+    Updates resource_consumption_table.
 
+  <Returns>
+    The number of seconds to wait (0.0 if the caller needn't wait).
+  """
   # It'll never drain!
   if resource_restriction_table[resource] == 0:
     raise Exception, "Resource '"+resource+"' limit set to 0, won't drain!"
-    
 
-  # We may need to go through this multiple times because other threads may
-  # also block and consume resources.
-  while resource_consumption_table[resource] > resource_restriction_table[resource]:
+  # update the resource counters based upon the current time.
+  update_resource_consumption_table(resource)
 
-    # Sleep until we're expected to be under quota
-    sleeptime = (resource_consumption_table[resource] - resource_restriction_table[resource]) / resource_restriction_table[resource]
+  resource_consumption_table[resource] = resource_consumption_table[resource] + quantity
+  resource_timeseries.record_use(resource, quantity)
+
+  return get_renewable_resource_wait(resource)
 
-    time.sleep(sleeptime)
 
-    update_resource_consumption_table(resource)
+
+# Returns how long it will take a renewable resource to drain below its burst
+# allowance.   The caller must hold the resource's lock.
+def get_renewable_resource_wait(resource):
+  burstallowance = resource_restriction_table[resource] * renewable_resource_burst_table.get(resource, nanny_resource_limits.DEFAULT_BURST_SECONDS)
+  overage = resource_consumption_table[resource] - burstallowance
+  if overage <= 0:
+    return 0.0
+
+  # Wait until we're expected to be under quota
+  return overage / resource_restriction_table[resource]
 
 
 
@@ -172,6 +239,8 @@ def initialize_consumed_resource_tables():
 
     resource_consumption_table[resource] = set()
 
+  disk_file_sizes.clear()
+
 
 
 
@@ -193,8 +262,51 @@ def start_resource_nanny():
       None.
   """
 
+  # Start the running disk use total from a scan of the vessel directory
+  filesizes = nonportable.get_disk_file_sizes(repy_constants.REPY_CURRENT_DIR)
+  nanny_resource_limits.reconcile_disk_use(nanny_resource_limits.calculate_disk_use(filesizes), filesizes)
+
   nonportable.monitor_cpu_disk_and_mem()
 
+  # Record the use of the renewable resources and the CPU over time
+  resource_timeseries.start_recording(nonportable.getruntime, functions={'cpu':nonportable.get_cpu_time})
+
+
+
+def set_burst_allowance(resource, seconds):
+  """
+   <Purpose>
+      Sets how much of a renewable resource the program may use before it is
+      made to wait.
+
+   <Arguments>
+      resource:
+         A string with the renewable resource name.
+      seconds:
+         The allowance in seconds worth of the resource's limit.   The
+         default is 1.0 (a second's worth).
+
+   <Exceptions>
+      ValueError if the resource isn't renewable or seconds isn't positive.
+
+   <Side Effects>
+      Changes renewable_resource_burst_table.
+
+   <Returns>
+      None.
+  """
+  if resource not in renewable_resources:
+    raise ValueError, "Resource '"+resource+"' is not renewable"
+
+  if seconds <= 0:
+    raise ValueError, "The burst allowance must be positive"
+
+  renewable_resource_lock_table[resource].acquire()
+  try:
+    renewable_resource_burst_table[resource] = float(seconds)
+  finally:
+    renewable_resource_lock_table[resource].release()
+
 
 
 # let the nanny know that the process is consuming some resource
@@ -219,7 +331,8 @@ def tattle_quantity(resource, quantity):
       None.
 
    <Side Effects>
-      May sleep the program until the resource is available.
+      May sleep the program until the resource is available.   Threads that
+      are made to wait are woken in the order they called.
 
    <Returns>
       None.
@@ -233,36 +346,171 @@ def tattle_quantity(resource, quantity):
     tracebackrepy.handle_internalerror("Resource '" + resource + 
         "' has a negative quantity " + str(quantity) + "!", 132)
     
+  # It's renewable, so I can wait for it to clear
+  if resource not in renewable_resources:
+    # Should never have a quantity tattle for a non-renewable resource
+    # This will cause the program to exit and log things if logging is
+    # enabled. -Brent
+    tracebackrepy.handle_internalerror("Resource '" + resource + 
+        "' is not renewable!", 133)
+
   # get the lock for this resource
   renewable_resource_lock_table[resource].acquire()
   
   # release the lock afterwards no matter what
   try: 
-    # update the resource counters based upon the current time.
-    update_resource_consumption_table(resource)
-
-    # It's renewable, so I can wait for it to clear
-    if resource not in renewable_resources:
-      # Should never have a quantity tattle for a non-renewable resource
-      # This will cause the program to exit and log things if logging is
-      # enabled. -Brent
-      tracebackrepy.handle_internalerror("Resource '" + resource + 
-          "' is not renewable!", 133)
-  
-
-    resource_consumption_table[resource] = resource_consumption_table[resource] + quantity
-    # I'll block if I'm over...
-    sleep_until_resource_drains(resource)
-  
+    sleeptime = charge_renewable_resource(resource, quantity)
   finally:
     # release the lock for this resource
     renewable_resource_lock_table[resource].release()
+
+  # I'll block if I'm over.   Other threads can charge the resource meanwhile
+  # and will wait behind me.
+  if sleeptime > 0:
+    time.sleep(sleeptime)
+    resource_timeseries.record_blocked(resource, sleeptime)
+  else:
+    sleeptime = 0.0
+
+  # Calls that only check the resource (quantity 0) and didn't wait aren't
+  # worth recording
+  if quantity or sleeptime:
+    resource_attribution.record_charge(resource, quantity, sleeptime)
     
 
 
 
 
 
+# The reservation API replaces calling tattle_quantity(resource, 0) before
+# an operation and tattle_quantity(resource, amount) after it.
+# reserve_quantity() waits if the resource is already over used, charges an
+# estimate of the operation's use and works out how long the operation must
+# wait afterwards, all in one nanny call.   commit_quantity() does that wait.
+# If the estimate was right (a write knows how much it will write) it doesn't
+# need the lock.   If the estimate was too high, the difference is refunded
+# without working out the resource's use again.
+def reserve_quantity(resource, estimate):
+  """
+   <Purpose>
+      Waits until a renewable resource isn't over used and charges an
+      estimate of what an operation will use.   Call commit_quantity()
+      with the amount actually used after the operation (even if it fails).
+
+   <Arguments>
+      resource:
+         A string with the resource name.   
+      estimate:
+         The amount the operation is expected to use (may be 0).   This
+         cannot be negative.
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      May sleep the program until the resource is available.
+
+   <Returns>
+      A reservation to pass to commit_quantity().
+  """
+  if estimate < 0:
+    tracebackrepy.handle_internalerror("Resource '" + resource + 
+        "' has a negative quantity " + str(estimate) + "!", 132)
+
+  if resource not in renewable_resources:
+    tracebackrepy.handle_internalerror("Resource '" + resource + 
+        "' is not renewable!", 133)
+
+  renewable_resource_lock_table[resource].acquire()
+  try:
+    # How long to wait for what was used before this operation
+    sleeptime = charge_renewable_resource(resource, 0)
+
+    # ... and how long the operation waits after it's done.
+    resource_consumption_table[resource] = resource_consumption_table[resource] + estimate
+    resource_timeseries.record_use(resource, estimate)
+    aftertime = get_renewable_resource_wait(resource) - sleeptime
+  finally:
+    renewable_resource_lock_table[resource].release()
+
+  if sleeptime > 0:
+    time.sleep(sleeptime)
+    resource_timeseries.record_blocked(resource, sleeptime)
+  else:
+    sleeptime = 0.0
+
+  resource_attribution.record_charge(resource, estimate, sleeptime)
+
+  return (resource, estimate, nonportable.getruntime(), aftertime)
+
+
+
+
+def commit_quantity(reservation, quantity):
+  """
+   <Purpose>
+      Corrects the charge made by reserve_quantity() to the amount that was
+      actually used and waits if the resource is over used.
+
+   <Arguments>
+      reservation:
+         What reserve_quantity() returned.
+      quantity:
+         The amount actually used (0 if the operation failed).
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      May sleep the program until the resource is available.
+
+   <Returns>
+      None.
+  """
+  (resource, estimate, reservetime, aftertime) = reservation
+
+  if quantity < 0:
+    tracebackrepy.handle_internalerror("Resource '" + resource + 
+        "' has a negative quantity " + str(quantity) + "!", 132)
+
+  if quantity > estimate:
+    renewable_resource_lock_table[resource].acquire()
+    try:
+      sleeptime = charge_renewable_resource(resource, quantity - estimate)
+    finally:
+      renewable_resource_lock_table[resource].release()
+
+  else:
+    if quantity < estimate:
+      # A refund.   The resource drains at a fixed rate, so taking the
+      # difference off now is the same as having charged the right amount.
+      refund = estimate - quantity
+      renewable_resource_lock_table[resource].acquire()
+      try:
+        resource_consumption_table[resource] = max(0.0, resource_consumption_table[resource] - refund)
+        resource_timeseries.record_use(resource, -refund)
+      finally:
+        renewable_resource_lock_table[resource].release()
+      aftertime = aftertime - refund / resource_restriction_table[resource]
+
+    # Take off the time the operation took
+    elapsed = max(0.0, nonportable.getruntime() - reservetime)
+    sleeptime = aftertime - elapsed
+
+  if sleeptime > 0:
+    time.sleep(sleeptime)
+    resource_timeseries.record_blocked(resource, sleeptime)
+  else:
+    sleeptime = 0.0
+
+  # reserve_quantity() counted the operation and charged the estimate
+  if quantity != estimate or sleeptime:
+    resource_attribution.record_charge(resource, quantity - estimate, sleeptime, operations=0)
+
+
+
+
+
 def tattle_add_item(resource, item):
   """
    <Purpose>
@@ -287,12 +535,17 @@ def tattle_add_item(resource, item):
       None.
   """
 
+  # It's already acquired.   This is always allowed.   Checking a set is
+  # atomic, so this doesn't need the lock.
+  if item in resource_consumption_table[resource]:
+    return
+
   fungible_resource_lock_table[resource].acquire()
 
   # always unlock as we exit...
   try: 
 
-    # It's already acquired.   This is always allowed.
+    # Another thread may have added it in the meantime
     if item in resource_consumption_table[resource]:
       return
 
@@ -337,6 +590,11 @@ def tattle_remove_item(resource, item):
       None.
   """
 
+  # Removal is idempotent, so an item that isn't there is done without the
+  # lock
+  if item not in resource_consumption_table[resource]:
+    return
+
   fungible_resource_lock_table[resource].acquire()
 
   # always unlock as we exit...
@@ -346,13 +604,179 @@ def tattle_remove_item(resource, item):
       resource_consumption_table[resource].remove(item)
     except KeyError:
       # may happen because removal is idempotent
-      pass
+      return
+
+    # One item was freed, so one waiter can have it
+    if fungible_resource_waiter_count[resource] > 0:
+      fungible_resource_condition_table[resource].notify()
 
   finally:
     fungible_resource_lock_table[resource].release()
 
 
 
+def tattle_wait_for_item(resource, item):
+  """
+   <Purpose>
+      Like tattle_add_item, but if the resource is at its limit this waits
+      until an item is released instead of raising an exception.
+
+   <Arguments>
+      resource:
+         A string with the resource name.   
+      item:
+         A unique identifier that specifies the resource (see
+         tattle_add_item).
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      May block until another thread calls tattle_remove_item.   If the limit
+      is 0 this never returns.
+
+   <Returns>
+      None.
+  """
+
+  # It's already acquired.   This is always allowed.
+  if item in resource_consumption_table[resource]:
+    return
+
+  condition = fungible_resource_condition_table[resource]
+  condition.acquire()
+
+  # always unlock as we exit...
+  try: 
+
+    # Another thread may have added it in the meantime
+    if item in resource_consumption_table[resource]:
+      return
+
+    while len(resource_consumption_table[resource]) >= resource_restriction_table[resource]:
+      fungible_resource_waiter_count[resource] += 1
+      try:
+        condition.wait()
+      finally:
+        fungible_resource_waiter_count[resource] -= 1
+
+    resource_consumption_table[resource].add(item)
+
+  finally:
+    condition.release()
+
+
+
+# Changes the size of a file in the running disk use total.   If growonly is
+# True, the size is only changed if it is larger.
+def update_disk_file_size(filename, size, growonly):
+  disk_use_lock.acquire()
+  try:
+    oldsize = disk_file_sizes.get(filename)
+    if oldsize is None:
+      change = size + nanny_resource_limits.DISK_USE_PER_FILE
+    elif growonly and size <= oldsize:
+      return
+    else:
+      change = size - oldsize
+
+    disk_file_sizes[filename] = size
+    diskused = resource_consumption_table['diskused'] + change
+    resource_consumption_table['diskused'] = diskused
+
+  finally:
+    disk_use_lock.release()
+
+  if change > 0 and diskused > resource_restriction_table['diskused']:
+    nonportable.disk_use_exceeded(diskused)
+
+
+
+def tattle_file_size(filename, size):
+  """
+   <Purpose>
+      Let the nanny know the size of a file in the vessel directory because
+      it was created or truncated.
+
+   <Arguments>
+      filename:
+         The name of the file.
+      size:
+         Its size in bytes.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      Repy is stopped if the disk use goes over its limit.
+
+   <Returns>
+      None.
+  """
+
+  update_disk_file_size(filename, size, False)
+
+
+
+def tattle_file_extended(filename, size):
+  """
+   <Purpose>
+      Let the nanny know that a file in the vessel directory was written to.
+
+   <Arguments>
+      filename:
+         The name of the file.
+      size:
+         The offset the write ended at.   The file is at least this large.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      Repy is stopped if the disk use goes over its limit.
+
+   <Returns>
+      None.
+  """
+
+  update_disk_file_size(filename, size, True)
+
+
+
+def tattle_file_removed(filename):
+  """
+   <Purpose>
+      Let the nanny know that a file in the vessel directory was removed.
+
+   <Arguments>
+      filename:
+         The name of the file.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      None.
+  """
+
+  disk_use_lock.acquire()
+  try:
+    try:
+      size = disk_file_sizes.pop(filename)
+    except KeyError:
+      # It was created by someone else since the last scan
+      return
+
+    resource_consumption_table['diskused'] = resource_consumption_table['diskused'] - size - nanny_resource_limits.DISK_USE_PER_FILE
+
+  finally:
+    disk_use_lock.release()
+
+
+
 # used for individual_item_resources
 def tattle_check(resource, item):
   """
@@ -36,8 +36,14 @@ individual_item_resources = ['messport', 'connport']
 item_resources = fungible_item_resources + individual_item_resources
 
 
+# These resources aren't consumed.   They are settings for how repy uses the
+# host (the TCP / UDP socket buffer sizes and the largest size TCP buffers
+# are auto-tuned to).   If unset (0), the built-in defaults are used.
+setting_resources = ['tcpbuffer', 'udpbuffer', 'tcpbuffermax']
+
+
 # This is used by restrictions.py to set up our tables
-known_resources = quantity_resources + item_resources 
+known_resources = quantity_resources + item_resources + setting_resources
 
 # Whenever a resource file is attached to a vessel, an exception should
 # be thrown if these resources are not present.  If any of these are left
@@ -70,10 +76,39 @@ for init_resource in fungible_item_resources:
   fungible_resource_lock_table[init_resource] = threading.Lock()
 
 
+# Threads waiting for an item to be released (tattle_wait_for_item) wait on
+# the resource's condition, which uses the lock above.   The waiter count
+# lets tattle_remove_item skip the notify when nobody is waiting.
+fungible_resource_condition_table = {}
+fungible_resource_waiter_count = {}
+for init_resource in fungible_item_resources:
+  fungible_resource_condition_table[init_resource] = threading.Condition(fungible_resource_lock_table[init_resource])
+  fungible_resource_waiter_count[init_resource] = 0
+
+
 # Set up renewable resources to start now...
 renewable_resource_update_time = {}
 
 
+# How much of a renewable resource a program may use before it is made to
+# wait, in seconds worth of the resource's limit.   Resources that aren't
+# listed get DEFAULT_BURST_SECONDS.
+DEFAULT_BURST_SECONDS = 1.0
+renewable_resource_burst_table = {}
+
+
+# Disk use is tracked as the program creates, writes and removes files.
+# disk_file_sizes maps the name of each file in the vessel directory to its
+# size and resource_consumption_table["diskused"] is the running total: the
+# sizes plus DISK_USE_PER_FILE for each file (to prevent lots of little files
+# from using up the disk).   Full scans of the directory correct the total
+# for changes made by others (see reconcile_disk_use).   disk_use_lock
+# protects both.
+DISK_USE_PER_FILE = 4096
+disk_file_sizes = {}
+disk_use_lock = threading.Lock()
+
+
 # Set up individual_item_resources to be in the restriction_table (as a set)
 for init_resource in individual_item_resources:
   resource_restriction_table[init_resource] = set()
@@ -163,3 +198,57 @@ def resource_limit(resource):
   """
   
   return resource_restriction_table[resource]
+
+
+
+def calculate_disk_use(filesizes):
+  """
+  <Purpose>
+    Calculates the disk use charged for a set of files.
+
+  <Arguments>
+    filesizes:
+      A dict of file name -> size in bytes.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    The sizes plus DISK_USE_PER_FILE for each file.
+  """
+  return sum(filesizes.values()) + DISK_USE_PER_FILE * len(filesizes)
+
+
+
+def reconcile_disk_use(diskused, filesizes):
+  """
+  <Purpose>
+    Replaces the running disk use total with one found by scanning the
+    vessel directory.   Writes made while the scan was running are lost
+    from the total until the next scan.
+
+  <Arguments>
+    diskused:
+      The disk use found by the scan.
+    filesizes:
+      A dict of file name -> size in bytes found by the scan.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    Replaces disk_file_sizes.
+
+  <Returns>
+    None.
+  """
+  disk_use_lock.acquire()
+  try:
+    resource_consumption_table["diskused"] = diskused
+    disk_file_sizes.clear()
+    disk_file_sizes.update(filesizes)
+  finally:
+    disk_use_lock.release()
@@ -17,9 +17,6 @@ import time
 # needed for sys.stderr and windows Popen hackery
 import sys
 
-# needed for signal numbers
-import signal
-
 # needed for harshexit
 import harshexit
 
@@ -51,6 +48,15 @@ import nmstatusinterface
 # This gives us our restrictions information
 import nanny_resource_limits
 
+# Records the time repy is stopped for using too much CPU
+import resource_timeseries
+
+# The resource monitor must not write the per-call resource table
+import resource_attribution
+
+# How the resource monitor enforces the CPU limit
+import cpu_enforcement
+
 # This is used for IPC
 import marshal
 
@@ -72,27 +78,42 @@ class UnsupportedSystemException(Exception):
 
 ###################     Publicly visible functions   #######################
 
-# check the disk space used by a dir.
-def compute_disk_use(dirname):
+# find the size of each file in a dir.
+def get_disk_file_sizes(dirname):
   # Convert path to absolute
   dirname = os.path.abspath(dirname)
-  
-  diskused = 0
-  
+
+  filesizes = {}
+
   for filename in os.listdir(dirname):
     try:
-      diskused = diskused + os.path.getsize(os.path.join(dirname, filename))
+      filesizes[filename] = os.path.getsize(os.path.join(dirname, filename))
     except IOError:   # They likely deleted the file in the meantime...
-      pass
+      filesizes[filename] = 0
     except OSError:   # They likely deleted the file in the meantime...
-      pass
+      filesizes[filename] = 0
 
-    # charge an extra 4K for each file to prevent lots of little files from 
-    # using up the disk.   I'm doing this outside of the except clause in
-    # the failure to get the size wasn't related to deletion
-    diskused = diskused + 4096
-        
-  return diskused
+  return filesizes
+
+
+# check the disk space used by a dir.   Each file is charged an extra 4K 
+# (see nanny_resource_limits.calculate_disk_use).   I'm doing this even if 
+# the failure to get the size was related to deletion
+def compute_disk_use(dirname):
+  return nanny_resource_limits.calculate_disk_use(get_disk_file_sizes(dirname))
+
+
+# The nanny calls this when a file operation takes the running disk use total
+# over the limit.   The resource monitor would only find this the next time
+# it scans the vessel directory, so we stop now.
+def disk_use_exceeded(diskused):
+  try:
+    print >> sys.stderr, "Disk use '"+str(diskused)+"' over limit '"+str(nanny_resource_limits.resource_limit("diskused"))+"'. Impolitely killing repy!"
+    sys.stderr.flush()
+  except:
+    pass
+
+  harshexit.harshexit(98)
 
 
 # prepare a socket so it behaves how we want
@@ -119,6 +140,13 @@ def preparesocket(socketobject):
     raise UnsupportedSystemException, "Unsupported system type: '"+osrealtype+"' (alias: "+ostype+")"
   
 
+# emulcomm calls this when it opens or closes a socket.   On Linux, checks
+# for sockets share a recent snapshot of them, which would miss the change.
+def socket_table_changed():
+  if ostype == 'Linux':
+    os_api.invalidate_socket_snapshot()
+
+
 # Armon: Also launches the nmstatusinterface thread.
 # This will result in an internal thread on Windows
 # and a thread on the external process for *NIX
@@ -261,6 +289,35 @@ def getruntime():
           
   # Return the new elapsedtime
   return elapsedtime
+
+
+
+# The monotonic clock's time when we were loaded (see getruntime_monotonic)
+monotonic_starttime = None
+
+def getruntime_monotonic():
+  """
+   <Purpose>
+      Return the amount of time the program has been running, using the
+      operating system's monotonic clock.   Unlike the uptime based
+      getruntime, this takes no lock and reads no files, so threads don't
+      wait for each other, and the clock can't go backwards.   getruntime
+      is replaced with this on Linux when the clock is available.
+
+   <Arguments>
+      None
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None
+
+   <Returns>
+      The elapsed time as float
+  """
+  return os_api.get_monotonic_time() - monotonic_starttime
+
  
 
 # This lock is used to serialize calls to get_resouces
@@ -271,15 +328,22 @@ exposed_resources = set(["cpu","memory","diskused","events",
                      "filewrite","fileread","filesopened",
                      "insockets","outsockets","netsend",
                      "netrecv","loopsend","looprecv",
-                     "lograte","random","messport","connport"])
+                     "lograte","random","messport","connport",
+                     "tcpbuffer","udpbuffer","tcpbuffermax"])
             
 # These are the resources that we don't flatten using
 # len() for the usage. For example, instead of given the
 # set of thread's, we flatten this into N number of threads.
 flatten_exempt_resources = set(["connport","messport"])
 
-# Cache the disk used from the external process
-cached_disk_used = 0L
+# The number of UDP messages waiting to be delivered to recvmess functions and
+# the number that were dropped because a queue was full or the socket was
+# closed.   emulcomm keeps these up to date.
+udp_queue_stats = {'udpqueued':0, 'udpdropped':0}
+
+# The number of gethostbyname_ex calls answered from the resolver cache and
+# the number that had to do a look up.   emulcomm keeps these up to date.
+resolver_cache_stats = {'resolverhits':0, 'resolvermisses':0}
 
 # This array holds the times that repy was stopped.
 # It is an array of tuples, of the form (time, amount)
@@ -288,6 +352,13 @@ cached_disk_used = 0L
 process_stopped_timeline = []
 process_stopped_max_entries = 100
 
+# The pi CPU governor's window statistics, from the resource monitor (see
+# get_cpu_window_stats).   None until a window has finished or if another
+# governor is used.   The monitor only sends the newest window's error, so
+# the errors are kept here.
+cpu_window_stats = None
+cpu_window_errors = []
+
 # Method to expose resource limits and usage
 def get_resources():
   """
@@ -305,7 +376,10 @@ def get_resources():
     to its maximum limit.
 
     Usage is the dictionary which maps the resource name
-    to its current usage.
+    to its current usage.   It also has "udpqueued" and "udpdropped",
+    the number of UDP messages waiting for an event and the number dropped,
+    and "resolverhits" and "resolvermisses", the number of gethostbyname_ex
+    calls that were and weren't answered from the resolver cache.
 
     Stoptimes is an array of tuples with the times which the Repy proces
     was stopped and for how long, due to CPU over-use.
@@ -389,8 +463,11 @@ def get_resources():
   else:
     raise EnvironmentError("Unsupported Platform!")
 
-  # Use the cached disk used amount
-  usage["diskused"] = cached_disk_used
+  # The UDP message queue depth and drops
+  usage.update(udp_queue_stats)
+
+  # The resolver cache hits and misses
+  usage.update(resolver_cache_stats)
 
   # Release the lock
   get_resources_lock.release()
@@ -438,8 +515,10 @@ class WindowsNannyThread(threading.Thread):
 
         # Check if we should check the disk
         if (current_interval % disk_interval) == 0:
-          # Check diskused
-          diskused = compute_disk_use(repy_constants.REPY_CURRENT_DIR)
+          # Scan the disk and correct the running total the nanny keeps
+          filesizes = get_disk_file_sizes(repy_constants.REPY_CURRENT_DIR)
+          diskused = nanny_resource_limits.calculate_disk_use(filesizes)
+          nanny_resource_limits.reconcile_disk_use(diskused, filesizes)
           if diskused > nanny_resource_limits.resource_limit("diskused"):
             raise Exception, "Disk use '"+str(diskused)+"' over limit '"+str(nanny_resource_limits.resource_limit("diskused"))+"'"
         
@@ -504,6 +583,7 @@ def win_check_cpu_use(cpulim, pid):
     if windows_api.timeout_process(pid, stoptime):
       # Log the stoptime
       process_stopped_timeline.append((now, stoptime))
+      resource_timeseries.record_blocked('cpu', stoptime)
 
       # Drop the first element if the length is greater than the maximum entries
       if len(process_stopped_timeline) > process_stopped_max_entries:
@@ -572,10 +652,24 @@ class WinCPUNannyThread(threading.Thread):
 ##############     *nix specific functions (may include Mac)  ###############
 
 # This method handles messages on the "diskused" channel from
-# the external process. When the external process measures disk used,
-# it is piped in and cached for calls to getresources.
-def IPC_handle_diskused(bytes):
-  cached_disk_used = bytes
+# the external process. When the external process scans the vessel
+# directory, it sends a tuple with (disk used, dict of file name -> size).
+# These replace the running total and the file sizes the nanny keeps as
+# files are written.
+def IPC_handle_diskused(info):
+  (diskused, filesizes) = info
+  nanny_resource_limits.reconcile_disk_use(diskused, filesizes)
+
+
+# Returns the CPU time (in seconds) used by this process.   The resource
+# time series recorder uses this to find the CPU rate.
+def get_cpu_time():
+  if ostype in ["Linux", "Darwin"]:
+    return os_api.get_process_cpu_time(os.getpid())
+  elif ostype in ["Windows", "WindowsCE"]:
+    return windows_api.get_process_cpu_time(os.getpid())
+  else:
+    raise EnvironmentError("Unsupported Platform!")
 
 
 # This method handles meessages on the "repystopped" channel from
@@ -585,12 +679,49 @@ def IPC_handle_diskused(bytes):
 def IPC_handle_stoptime(info):
   # Push this onto the timeline
   process_stopped_timeline.append(info)
+  resource_timeseries.record_blocked('cpu', info[1])
 
   # Drop the first element if the length is greater than the max
   if len(process_stopped_timeline) > process_stopped_max_entries:
     process_stopped_timeline.pop(0)
 
 
+# This method handles messages on the "cpuwindowstats" channel from the
+# external process.   It sends the pi CPU governor's statistics (see
+# cpu_enforcement.PICPUGovernor.get_window_stats) after each window, with
+# only the newest window's error.
+def IPC_handle_cpuwindowstats(stats):
+  global cpu_window_stats
+
+  cpu_window_errors.extend(stats['errors'])
+  if len(cpu_window_errors) > cpu_enforcement.GOVERNOR_WINDOW_HISTORY:
+    del cpu_window_errors[:len(cpu_window_errors) - cpu_enforcement.GOVERNOR_WINDOW_HISTORY]
+
+  cpu_window_stats = stats
+
+
+def get_cpu_window_stats():
+  """
+  <Purpose>
+    Returns how far the share of CPU repy got in each window was from its
+    limit, as measured by the pi CPU governor in the resource monitor.
+
+  <Arguments>
+    None.
+
+  <Returns>
+    A dict as from cpu_enforcement.PICPUGovernor.get_window_stats, with the
+    errors of the newest windows.   None if no window has finished or the
+    pi governor isn't used.
+  """
+  if cpu_window_stats is None:
+    return None
+
+  stats = cpu_window_stats.copy()
+  stats['errors'] = cpu_window_errors[:]
+  return stats
+
+
 # Use a special class of exception for when
 # resource limits are exceeded
 class ResourceException(Exception):
@@ -704,7 +835,8 @@ def read_message_from_pipe(readhandle):
 # on each channel. E.g. when a message arrives on the "repystopped" channel,
 # the IPC_handle_stoptime function should be invoked to handle it.
 IPC_HANDLER_FUNCTIONS = {"repystopped":IPC_handle_stoptime,
-                         "diskused":IPC_handle_diskused }
+                         "diskused":IPC_handle_diskused,
+                         "cpuwindowstats":IPC_handle_cpuwindowstats }
 
 
 # This thread checks that the parent process is alive and invokes
@@ -780,6 +912,11 @@ def do_forked_resource_monitor():
     # We are the parent, close the read end
     os.close(readhandle)
 
+    # Only the child runs the program, so the monitor has no per-call
+    # resource table or resource use samples to write when it exits
+    resource_attribution.dump_filename = None
+    resource_timeseries.dump_filename = None
+
   # Store the childpid
   repy_process_id = childpid
 
@@ -850,15 +987,31 @@ def resource_monitor(childpid, pipe_handle):
   """
   # Get our pid
   ourpid = os.getpid()
+
+  # What decides how long to stop repy for.   None means the interval
+  # governor (calculate_cpu_sleep_interval), which checks every
+  # CPU_POLLING_FREQ_LINUX seconds.   The pi governor checks more often.
+  cpu_governor = cpu_enforcement.create_governor(nanny_resource_limits.resource_limit("cpu"))
+  if cpu_governor is None:
+    polling_interval = repy_constants.CPU_POLLING_FREQ_LINUX
+  else:
+    polling_interval = cpu_governor.slicetime
+
+  # How many windows the governor had finished when it last sent its stats
+  cpu_window_count = 0
   
   # Calculate how often disk should be checked
-  disk_interval = int(repy_constants.RESOURCE_POLLING_FREQ_LINUX / repy_constants.CPU_POLLING_FREQ_LINUX)
+  disk_interval = max(1, int(repy_constants.RESOURCE_POLLING_FREQ_LINUX / polling_interval))
   current_interval = -1 # What cycle are we on  
   
   # Store time of the last interval
   last_time = getruntime()
   last_CPU_time = 0
   resume_time = 0 
+
+  # What keeps repy to its CPU limit (see cpu_enforcement)
+  cpu_backend = cpu_enforcement.create_backend(childpid, nanny_resource_limits.resource_limit("cpu"))
+  cpu_backend.start()
   
   # Run forever...
   while True:
@@ -890,25 +1043,25 @@ def resource_monitor(childpid, pipe_handle):
       last_CPU_time = totalCPU
       
     # Calculate stop time
-    stoptime = nanny_resource_limits.calculate_cpu_sleep_interval(nanny_resource_limits.resource_limit("cpu"), percentused, elapsedtime)
+    if cpu_governor is None:
+      stoptime = nanny_resource_limits.calculate_cpu_sleep_interval(nanny_resource_limits.resource_limit("cpu"), percentused, elapsedtime)
+    else:
+      stoptime = cpu_governor.get_stop_time(currenttime, totalCPU)
     
-    # If we are supposed to stop repy, then suspend, sleep and resume
-    if stoptime > 0.0:
-      # They must be punished by stopping
-      os.kill(childpid, signal.SIGSTOP)
-
-      # Sleep until time to resume
-      time.sleep(stoptime)
-
-      # And now they can start back up!
-      os.kill(childpid, signal.SIGCONT)
-      
+    # Have the backend stop (or throttle) repy
+    stoppedtime = cpu_backend.enforce(stoptime)
+    if stoppedtime > 0.0:
       # Save the resume time
       resume_time = getruntime()
 
       # Send this information as a tuple containing the time repy was stopped and
       # for how long it was stopped
-      write_message_to_pipe(pipe_handle, "repystopped", (currenttime, stoptime))
+      write_message_to_pipe(pipe_handle, "repystopped", (currenttime, stoppedtime))
+
+    # Send the pi governor's statistics once each window is over
+    if cpu_governor is not None and cpu_governor.windowcount != cpu_window_count:
+      cpu_window_count = cpu_governor.windowcount
+      write_message_to_pipe(pipe_handle, "cpuwindowstats", cpu_governor.get_window_stats(history=1))
       
     
     ########### End Check CPU ###########
@@ -928,25 +1081,27 @@ def resource_monitor(childpid, pipe_handle):
     # Increment our current cycle
     current_interval += 1;
     
-    # Check if it is time to check the disk usage
+    # Check if it is time to check the disk usage.   Repy keeps a running
+    # total as it writes files, so this only catches changes made by others.
     if (current_interval % disk_interval) == 0:
       # Reset the interval
       current_interval = 0
        
       # Calculate disk used
-      diskused = compute_disk_use(repy_constants.REPY_CURRENT_DIR)
+      filesizes = get_disk_file_sizes(repy_constants.REPY_CURRENT_DIR)
+      diskused = nanny_resource_limits.calculate_disk_use(filesizes)
 
       # Raise exception if we are over limit
       if diskused > nanny_resource_limits.resource_limit("diskused"):
         raise ResourceException, "Disk use '"+str(diskused)+"' over limit '"+str(nanny_resource_limits.resource_limit("diskused"))+"'."
 
-      # Send the disk usage information, raw bytes used
-      write_message_to_pipe(pipe_handle, "diskused", diskused)
+      # Send the disk use and the size of each file
+      write_message_to_pipe(pipe_handle, "diskused", (diskused, filesizes))
     
     ########### End Check Disk ###########
     
     # Sleep before the next iteration
-    time.sleep(repy_constants.CPU_POLLING_FREQ_LINUX)
+    time.sleep(polling_interval)
 
 
 ###########     functions that help me figure out the os type    ###########
@@ -1021,6 +1176,14 @@ else:
   # Reset elapsed time 
   elapsedtime = 0
 
+  # Keep the uptime based version around.   It is used if there is no
+  # monotonic clock.
+  getruntime_uptime = getruntime
+
+  if ostype == "Linux" and os_api.monotonic_clock_id is not None:
+    monotonic_starttime = os_api.get_monotonic_time()
+    getruntime = getruntime_monotonic
+
 
 # Conrad: initialize nanny (Prevents circular imports)
 # Note: nanny_resource_limits can be initialized at any time after getruntime()
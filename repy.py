@@ -38,6 +38,12 @@
   --status filename.txt  : Write status information into this file
   --cwd dir              : Set Current working directory
   --servicelog           : Enable usage of the servicelogger for internal errors
+  --sampleinterval secs  : How often to record resource use (default 1.0, 0 disables)
+  --attributionfile file : At exit, write the resources each API call used to this file
+  --timeseriesfile file  : At exit, write the resource use samples to this file
+  --cpubackend name      : How the CPU limit is enforced: signal (the default) or cgroup
+  --cgroupdir dir        : The delegated cgroup v2 directory the cgroup backend uses
+  --cpugovernor name     : How the CPU stop time is worked out: interval (the default) or pi
 """
 
 
@@ -73,6 +79,15 @@ import virtual_namespace
 ## we'll use tracebackrepy to print our exceptions
 import tracebackrepy
 
+# the --sampleinterval and --timeseriesfile options configure this
+import resource_timeseries
+
+# the --attributionfile option configures this
+import resource_attribution
+
+# the --cpubackend, --cgroupdir and --cpugovernor options configure this
+import cpu_enforcement
+
 
 # This block allows or denies different actions in the safe module.   I'm 
 # doing this here rather than the natural place in the safe module because
@@ -224,8 +239,9 @@ def main(restrictionsfn, program, args):
 
 
   # I've changed to the threading library, so this should increase if there are
-  # pending events
-  while threading.activeCount() > idlethreadcount:
+  # pending events.   Idle event workers (and other internal threads) don't
+  # count.
+  while threading.activeCount() - emulcomm.get_idle_internal_threads() > idlethreadcount:
     # do accounting here?
     time.sleep(0.25)
 
@@ -298,6 +314,12 @@ Where [options] are some combination of the following:
 --cwd dir              : Set Current working directory
 --servicelog           : Enable usage of the servicelogger for internal errors
 --norestrictions       : Disable the use of function restrictions, but not resource limits
+--sampleinterval secs  : How often to record resource use (default 1.0, 0 disables)
+--attributionfile file : At exit, write the resources each API call used to this file
+--timeseriesfile file  : At exit, write the resource use samples to this file
+--cpubackend name      : How the CPU limit is enforced: signal (the default) or cgroup
+--cgroupdir dir        : The delegated cgroup v2 directory the cgroup backend uses
+--cpugovernor name     : How the CPU stop time is worked out: interval (the default) or pi
 """
   return
 
@@ -344,7 +366,9 @@ if __name__ == '__main__':
   try:
     optlist, fnlist = getopt.getopt(args, '', [
       'simple', 'execinfo', 'ip=', 'iface=', 'nootherips', 'logfile=',
-      'stop=', 'status=', 'cwd=', 'servicelog', 'norestrictions'
+      'stop=', 'status=', 'cwd=', 'servicelog', 'norestrictions',
+      'sampleinterval=', 'attributionfile=', 'timeseriesfile=',
+      'cpubackend=', 'cgroupdir=', 'cpugovernor='
       ])
 
   except getopt.GetoptError:
@@ -426,6 +450,55 @@ if __name__ == '__main__':
     elif option == '--execinfo':
       displayexecinfo = True
 
+    # How often resource use is recorded (see resource_timeseries)
+    elif option == '--sampleinterval':
+      try:
+        sampleinterval = float(value)
+      except ValueError:
+        sampleinterval = -1
+
+      if sampleinterval < 0:
+        usage("The sample interval must be a number that is 0 or more")
+        sys.exit(1)
+      resource_timeseries.sample_interval = sampleinterval
+
+    # Where to write the resources used by each API call at exit.   --cwd
+    # may change the directory, so remember the full path.
+    elif option == '--attributionfile':
+      resource_attribution.dump_filename = os.path.abspath(value)
+
+    # Where to write the resource use samples at exit (see
+    # resource_timeseries.load_timeseries)
+    elif option == '--timeseriesfile':
+      resource_timeseries.dump_filename = os.path.abspath(value)
+
+    # How the resource monitor enforces the CPU limit
+    elif option == '--cpubackend':
+      if value not in cpu_enforcement.CPU_BACKENDS:
+        usage("Unknown CPU backend '" + value + "'")
+        sys.exit(1)
+      cpu_enforcement.backend_name = value
+
+    elif option == '--cgroupdir':
+      cpu_enforcement.cgroup_directory = os.path.abspath(value)
+
+    elif option == '--cpugovernor':
+      if value not in cpu_enforcement.CPU_GOVERNORS:
+        usage("Unknown CPU governor '" + value + "'")
+        sys.exit(1)
+      cpu_enforcement.governor_name = value
+
+  # Check the cgroup now.   The resource monitor can't report problems well.
+  if cpu_enforcement.backend_name == "cgroup":
+    if cpu_enforcement.cgroup_directory is None:
+      usage("The cgroup CPU backend needs --cgroupdir")
+      sys.exit(1)
+    try:
+      cpu_enforcement.check_cgroup_directory(cpu_enforcement.cgroup_directory)
+    except Exception, e:
+      usage(str(e))
+      sys.exit(1)
+
   # Update repy current directory
   repy_constants.REPY_CURRENT_DIR = os.path.abspath(os.getcwd())
 
@@ -26,10 +26,12 @@ REPY_START_DIR = "."
 
 # Polling Frequency for different Platforms, This is for non-CPU resources
 # Poll non-cpu resources less often to reduce overhead
-# Memory may need to be tighted, since it is possible to debilitate a system in less time than this.
-RESOURCE_POLLING_FREQ_LINUX = .5 # Linux
-RESOURCE_POLLING_FREQ_WIN = .5 # Windows
-RESOURCE_POLLING_FREQ_WINCE = 4 # Mobile devices are pretty slow
+# Memory is checked with the CPU.   The disk use is kept up to date as files
+# are written, so scanning the vessel directory only corrects it for changes
+# made outside of repy and can be done rarely.
+RESOURCE_POLLING_FREQ_LINUX = 10 # Linux
+RESOURCE_POLLING_FREQ_WIN = 10 # Windows
+RESOURCE_POLLING_FREQ_WINCE = 20 # Mobile devices are pretty slow
 
 # CPU Polling Frequency for different Platforms
 CPU_POLLING_FREQ_LINUX = .1 # Linux
@@ -0,0 +1,180 @@
+"""
+   Program: resource_attribution.py
+
+   Description:
+
+   This module records which API calls (and threads) renewable resources are
+   charged to and how long they were blocked waiting for them.   This helps
+   to work out why a repy program is slow.
+
+   restrictions.assertisallowed() stores the name of the API call each thread
+   is making.   When the nanny charges a resource or makes a thread sleep it
+   calls record_charge(), which adds the amount and blocked time to that
+   call's row.   Charges made by threads that never made an API call (the
+   socket selector, for example) are recorded under the call None.
+
+   get_call_attribution() returns the table.   If dump_filename is set
+   (repy's --attributionfile), harshexit writes the table to that file when
+   the program exits.
+"""
+
+# For the per-thread call name and the table lock
+import threading
+
+# The sandbox removes the open builtin, so keep the real file type
+myfile = file
+
+
+
+# Event threads get a new name for every event, so the per-thread table could
+# grow without bound.   After this many rows, charges are recorded under
+# OTHER_THREADS instead of the thread's name.   The per-call table is
+# always complete.
+MAX_THREAD_ROWS = 1000
+OTHER_THREADS = "(other threads)"
+
+
+# (call, resource) -> [operations, charged, blocked]
+call_table = {}
+
+# (call, thread name, resource) -> [operations, charged, blocked]
+thread_table = {}
+
+# Protects updates to the tables.   Readers just copy them.
+table_lock = threading.Lock()
+
+# Where harshexit writes the table.   None means it isn't written.
+dump_filename = None
+
+
+
+class CallState(threading.local):
+  # The API call this thread is making (or last made)
+  def __init__(self):
+    self.call = None
+
+current_call = CallState()
+
+
+
+def add_to_row(table, key, operations, quantity, blocked):
+  # The caller must hold table_lock
+  row = table.get(key)
+  if row is None:
+    row = table[key] = [0, 0.0, 0.0]
+  row[0] = row[0] + operations
+  row[1] = row[1] + quantity
+  row[2] = row[2] + blocked
+
+
+
+def record_charge(resource, quantity, blocked, operations=1):
+  """
+  <Purpose>
+    Charges an amount of a resource and time blocked waiting for it to the
+    API call the current thread is making.
+
+  <Arguments>
+    resource:
+      The resource name.
+    quantity:
+      The amount charged.   This is negative for a refund.
+    blocked:
+      How long the thread slept waiting for the resource.
+    operations:
+      How many operations to count.   commit_quantity() passes 0, since
+      reserve_quantity() already counted the operation.
+
+  <Returns>
+    None.
+  """
+  call = current_call.call
+  threadname = threading.currentThread().getName()
+
+  table_lock.acquire()
+  try:
+    add_to_row(call_table, (call, resource), operations, quantity, blocked)
+
+    threadkey = (call, threadname, resource)
+    if threadkey not in thread_table and len(thread_table) >= MAX_THREAD_ROWS:
+      threadkey = (call, OTHER_THREADS, resource)
+    add_to_row(thread_table, threadkey, operations, quantity, blocked)
+  finally:
+    table_lock.release()
+
+
+
+def get_call_attribution(bythread=False):
+  """
+  <Purpose>
+    Returns how much of each renewable resource was charged to each API
+    call and how long the calls were blocked waiting for it.
+
+  <Arguments>
+    bythread:
+      If True, each call is split up by the thread that made it.
+
+  <Returns>
+    A dict of call -> dict of resource -> (operations, charged, blocked
+    seconds).   If bythread is True, the keys are (call, thread name).
+    The call is None for charges made outside of an API call.
+  """
+  if bythread:
+    rows = thread_table.items()
+  else:
+    rows = call_table.items()
+
+  attribution = {}
+  for key, (operations, charged, blocked) in rows:
+    resource = key[-1]
+    if bythread:
+      callkey = key[:2]
+    else:
+      callkey = key[0]
+    attribution.setdefault(callkey, {})[resource] = (operations, charged, blocked)
+  return attribution
+
+
+
+def dump_call_attribution(filename):
+  """
+  <Purpose>
+    Writes the per-thread table to a file, one tab separated row per call,
+    thread and resource: call, thread, resource, operations, charged and
+    blocked seconds.   The rows are sorted by blocked time, longest first.
+
+  <Arguments>
+    filename:
+      The file to write.
+
+  <Exceptions>
+    IOError if the file can't be written.
+
+  <Returns>
+    None.
+  """
+  rows = []
+  for (call, threadname, resource), (operations, charged, blocked) in thread_table.items():
+    rows.append((blocked, str(call), threadname, resource, operations, charged))
+  rows.sort(reverse=True)
+
+  lines = ["call\tthread\tresource\toperations\tcharged\tblocked\n"]
+  for (blocked, call, threadname, resource, operations, charged) in rows:
+    lines.append("%s\t%s\t%s\t%d\t%.0f\t%.6f\n" % (call, threadname, resource, operations, charged, blocked))
+
+  dumpfile = myfile(filename, "w")
+  try:
+    dumpfile.write("".join(lines))
+  finally:
+    dumpfile.close()
+
+
+
+def dump_at_exit():
+  # Called by harshexit.   We're exiting, so don't raise anything.
+  if dump_filename is None:
+    return
+  try:
+    dump_call_attribution(dump_filename)
+  except Exception:
+    pass
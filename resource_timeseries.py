@@ -0,0 +1,399 @@
+"""
+   Program: resource_timeseries.py
+
+   Description:
+
+   This module records how a vessel uses its renewable resources over time.
+   Every sample interval, each resource gets a sample with the time, the rate
+   it was used at over the interval and how long the program was blocked
+   waiting for it (sleeping in the nanny, or stopped for using too much CPU).
+   Each resource keeps its samples in a fixed-size ring buffer, so the newest
+   samples are kept.
+
+   The nanny calls record_use() and record_blocked(), which only add to
+   running totals.   A thread started by start_recording() takes the samples.
+
+   Use get_samples() to look at the samples and dump_timeseries() to write
+   them all to a file.   load_timeseries() reads the file back.   If
+   dump_filename is set (repy's --timeseriesfile), harshexit writes the
+   samples to that file when the program exits.
+
+   The file format is (all in network byte order):
+     header:     "RTS1", the sample interval (double), the resource count
+                 (unsigned int)
+     per resource:
+                 the name length (unsigned char), the name, the sample count
+                 (unsigned int), then for each sample (oldest first) the time,
+                 rate and blocked time (three doubles)
+"""
+
+# For the ring buffers
+import array
+
+# For the file format
+import struct
+
+# For the sampling thread and the blocked time lock
+import threading
+
+# For sleeping between samples
+import time
+
+# The sandbox removes the open builtin, so keep the real file type
+myfile = file
+
+
+
+# How often samples are taken (seconds) and how many are kept per resource
+DEFAULT_SAMPLE_INTERVAL = 1.0
+DEFAULT_SAMPLE_COUNT = 600
+
+# Identifies the dump file format
+DUMP_MAGIC = "RTS1"
+
+
+# resource -> the total used so far.   The nanny only changes this while
+# holding the resource's lock.
+use_totals = {}
+
+# resource -> the total time blocked so far.   Threads add to this after they
+# sleep, so it has its own lock.
+blocked_totals = {}
+blocked_lock = threading.Lock()
+
+# resource -> a function returning the total used so far, for resources that
+# the nanny isn't told about (CPU)
+use_functions = {}
+
+# resource -> ResourceRing.   Filled in by start_recording().
+rings = {}
+
+# How often the sampling thread takes samples.   Set this before
+# start_recording() to change it (repy's --sampleinterval).   0 turns
+# recording off.
+sample_interval = DEFAULT_SAMPLE_INTERVAL
+
+# Where harshexit writes the samples.   None means they aren't written.
+dump_filename = None
+
+
+
+def init(resources):
+  # Call on import with the names of the resources the nanny is told about.
+  for resource in resources:
+    use_totals[resource] = 0.0
+    blocked_totals[resource] = 0.0
+
+
+
+def record_use(resource, amount):
+  """
+  <Purpose>
+    Adds to the amount of a resource used.   The caller must hold the
+    resource's lock (or otherwise keep others from updating it).
+
+  <Arguments>
+    resource:
+      The resource name.
+    amount:
+      How much was used.   This is negative for a refund.
+
+  <Returns>
+    None.
+  """
+  use_totals[resource] = use_totals[resource] + amount
+
+
+
+def record_blocked(resource, seconds):
+  """
+  <Purpose>
+    Adds to the time spent blocked on a resource.
+
+  <Arguments>
+    resource:
+      The resource name.
+    seconds:
+      How long the program was blocked.
+
+  <Returns>
+    None.
+  """
+  blocked_lock.acquire()
+  try:
+    blocked_totals[resource] = blocked_totals.get(resource, 0.0) + seconds
+  finally:
+    blocked_lock.release()
+
+
+
+class ResourceRing:
+  """
+  The newest samples for one resource.   The samples are stored in arrays of
+  doubles, so adding one doesn't allocate anything.
+  """
+  def __init__(self, size):
+    self.size = size
+    self.times = array.array('d', [0.0] * size)
+    self.rates = array.array('d', [0.0] * size)
+    self.blocked = array.array('d', [0.0] * size)
+
+    # Where the next sample goes and how many samples have been added
+    self.nextindex = 0
+    self.count = 0
+    self.lock = threading.Lock()
+
+
+  def add(self, sampletime, rate, blocked):
+    self.lock.acquire()
+    try:
+      self.times[self.nextindex] = sampletime
+      self.rates[self.nextindex] = rate
+      self.blocked[self.nextindex] = blocked
+      self.nextindex = (self.nextindex + 1) % self.size
+      self.count = self.count + 1
+    finally:
+      self.lock.release()
+
+
+  def get_samples(self):
+    # Returns a list of (time, rate, blocked) tuples, oldest first
+    self.lock.acquire()
+    try:
+      samplecount = min(self.count, self.size)
+      firstindex = (self.nextindex - samplecount) % self.size
+      samples = []
+      for offset in xrange(samplecount):
+        index = (firstindex + offset) % self.size
+        samples.append((self.times[index], self.rates[index], self.blocked[index]))
+      return samples
+    finally:
+      self.lock.release()
+
+
+
+class SamplerThread(threading.Thread):
+  """
+  Takes a sample of every resource each interval.   The rate is the change
+  in the amount used divided by the time since the last sample.
+  """
+  def __init__(self, getruntime, interval):
+    threading.Thread.__init__(self, name="ResourceSampler")
+    self.setDaemon(True)
+    self.getruntime = getruntime
+    self.interval = interval
+
+
+  def run(self):
+    lasttime = self.getruntime()
+    lastused = get_use_totals()
+    lastblocked = blocked_totals.copy()
+
+    while True:
+      time.sleep(self.interval)
+
+      now = self.getruntime()
+      elapsed = now - lasttime
+      if elapsed <= 0:
+        continue
+
+      used = get_use_totals()
+      blocked = blocked_totals.copy()
+
+      for resource in rings:
+        rate = (used.get(resource, 0.0) - lastused.get(resource, 0.0)) / elapsed
+        blockedtime = blocked.get(resource, 0.0) - lastblocked.get(resource, 0.0)
+        rings[resource].add(now, rate, blockedtime)
+
+      lasttime = now
+      lastused = used
+      lastblocked = blocked
+
+
+
+# Returns the totals used so far of every resource being recorded
+def get_use_totals():
+  totals = use_totals.copy()
+  for resource in use_functions:
+    try:
+      totals[resource] = use_functions[resource]()
+    except Exception:
+      # Leave it out.   The rate for this sample will look like 0.
+      pass
+  return totals
+
+
+
+def start_recording(getruntime, interval=None, samplecount=DEFAULT_SAMPLE_COUNT, functions={}):
+  """
+  <Purpose>
+    Starts taking samples.
+
+  <Arguments>
+    getruntime:
+      The function that returns the time used for the samples
+      (nonportable.getruntime).
+    interval:
+      How often to take samples, in seconds.   Nothing is recorded if this
+      is 0.   By default sample_interval is used.
+    samplecount:
+      How many samples to keep for each resource.
+    functions:
+      A dict of resource -> function returning the total used so far, for
+      resources the nanny isn't told about.
+
+  <Exceptions>
+    ValueError if the interval is negative or samplecount isn't positive.
+
+  <Side Effects>
+    Starts a thread.
+
+  <Returns>
+    None.
+  """
+  global sample_interval
+
+  if interval is None:
+    interval = sample_interval
+
+  if interval < 0:
+    raise ValueError, "The sample interval can't be negative"
+  if samplecount <= 0:
+    raise ValueError, "At least one sample must be kept"
+
+  if interval == 0:
+    return
+
+  use_functions.update(functions)
+  for resource in use_totals.keys() + use_functions.keys():
+    rings[resource] = ResourceRing(samplecount)
+
+  sample_interval = float(interval)
+  SamplerThread(getruntime, sample_interval).start()
+
+
+
+def get_samples(resource=None):
+  """
+  <Purpose>
+    Returns the samples that have been recorded.
+
+  <Arguments>
+    resource:
+      The resource to return samples for.   If None, all of them are
+      returned.
+
+  <Exceptions>
+    KeyError if the resource isn't being recorded.
+
+  <Returns>
+    A list of (time, rate, blocked time) tuples, oldest first.   If resource
+    is None, a dict of resource -> list.
+  """
+  if resource is not None:
+    return rings[resource].get_samples()
+
+  allsamples = {}
+  for resource in rings:
+    allsamples[resource] = rings[resource].get_samples()
+  return allsamples
+
+
+
+def dump_timeseries(filename):
+  """
+  <Purpose>
+    Writes all of the samples to a file (see the format above).
+
+  <Arguments>
+    filename:
+      The file to write.
+
+  <Exceptions>
+    IOError if the file can't be written.
+
+  <Returns>
+    None.
+  """
+  allsamples = get_samples()
+
+  chunks = [struct.pack("!4sdI", DUMP_MAGIC, sample_interval, len(allsamples))]
+  for resource in allsamples:
+    samples = allsamples[resource]
+    chunks.append(struct.pack("!B", len(resource)) + resource)
+    chunks.append(struct.pack("!I", len(samples)))
+    values = []
+    for sample in samples:
+      values.extend(sample)
+    chunks.append(struct.pack("!" + str(len(values)) + "d", *values))
+
+  dumpfile = myfile(filename, "wb")
+  try:
+    dumpfile.write("".join(chunks))
+  finally:
+    dumpfile.close()
+
+
+
+def load_timeseries(filename):
+  """
+  <Purpose>
+    Reads a file written by dump_timeseries().
+
+  <Arguments>
+    filename:
+      The file to read.
+
+  <Exceptions>
+    IOError if the file can't be read.   ValueError if it isn't a dump.
+
+  <Returns>
+    A tuple (interval, samples) where samples is a dict of resource -> list
+    of (time, rate, blocked time) tuples, oldest first.
+  """
+  dumpfile = myfile(filename, "rb")
+  try:
+    data = dumpfile.read()
+  finally:
+    dumpfile.close()
+
+  try:
+    (magic, interval, resourcecount) = struct.unpack_from("!4sdI", data, 0)
+    if magic != DUMP_MAGIC:
+      raise ValueError, "'" + filename + "' isn't a resource time series dump"
+    offset = struct.calcsize("!4sdI")
+
+    allsamples = {}
+    for count in xrange(resourcecount):
+      namelength = struct.unpack_from("!B", data, offset)[0]
+      offset = offset + 1
+      resource = data[offset:offset + namelength]
+      offset = offset + namelength
+
+      samplecount = struct.unpack_from("!I", data, offset)[0]
+      offset = offset + 4
+
+      valueformat = "!" + str(samplecount * 3) + "d"
+      values = struct.unpack_from(valueformat, data, offset)
+      offset = offset + struct.calcsize(valueformat)
+
+      samples = []
+      for index in xrange(0, len(values), 3):
+        samples.append(values[index:index + 3])
+      allsamples[resource] = samples
+
+  except struct.error, e:
+    raise ValueError, "'" + filename + "' is truncated or corrupt: " + str(e)
+
+  return (interval, allsamples)
+
+
+
+def dump_at_exit():
+  # Called by harshexit.   We're exiting, so don't raise anything.
+  if dump_filename is None:
+    return
+  try:
+    dump_timeseries(dump_filename)
+  except Exception:
+    pass
@@ -19,6 +19,9 @@ import nanny
 # Used to handle internal errors
 import tracebackrepy
 
+# Tells the nanny which call is charging resources
+import resource_attribution
+
 """ 
 The restrictions file format consists of lines that look like this:
  
@@ -102,6 +105,11 @@ known_calls = [ "canceltimer", "exitall", "file.close", "file.flush",
 # this table is indexed by call name and contains tuples of (rule, action)
 call_rule_table = {}
 
+# The calls whose first rule allows them no matter what the arguments are.
+# assertisallowed() doesn't need to look at the rules for these.   Filled in
+# by init_restriction_tables
+always_allowed_calls = set()
+
 
 
 
@@ -286,6 +294,16 @@ def init_restriction_tables(filename):
       nanny.resource_restriction_table[resource] = 0.0
 
 
+  # remember which calls are allowed without checking their arguments.   
+  # The first rule is the one that's used if it matches, and the empty rule
+  # always matches.
+  always_allowed_calls.clear()
+  for callname in call_rule_table:
+    ruleset = call_rule_table[callname]
+    if ruleset and ruleset[0] == ([], 'allow'):
+      always_allowed_calls.add(callname)
+
+
 
 
 
@@ -361,9 +379,16 @@ disablerestrictions = False
 
 
 def assertisallowed(call,*args):
+  # The nanny charges resources used from here on to this call
+  resource_attribution.current_call.call = call
+
   if disablerestrictions:
     return True
 
+  # This is checked on every send / recv, so avoid the rule matching if we can
+  if call in always_allowed_calls:
+    return True
+
   # let's pre-reject certain open / file calls
   #print call_rule_table[call]
   matches = find_action(call_rule_table[call], args)
@@ -0,0 +1,79 @@
+"""
+Test the cgroup CPU enforcement backend against a fake cgroup directory.
+"""
+
+import os
+import shutil
+import tempfile
+
+import cpu_enforcement
+
+
+def write_file(directory, filename, data):
+  fileobj = open(os.path.join(directory, filename), "w")
+  fileobj.write(data)
+  fileobj.close()
+
+def read_file(directory, filename):
+  fileobj = open(os.path.join(directory, filename), "r")
+  data = fileobj.read()
+  fileobj.close()
+  return data
+
+
+cgroupdir = tempfile.mkdtemp()
+try:
+  write_file(cgroupdir, "cgroup.procs", "")
+  write_file(cgroupdir, "cpu.max", "max 100000\n")
+  write_file(cgroupdir, "cpu.stat", "usage_usec 100\nuser_usec 60\nsystem_usec 40\nnr_periods 0\nnr_throttled 0\nthrottled_usec 2500\n")
+
+  cpu_enforcement.backend_name = "cgroup"
+  cpu_enforcement.cgroup_directory = cgroupdir
+  backend = cpu_enforcement.create_backend(12345, 0.1)
+  assert(isinstance(backend, cpu_enforcement.CgroupCPUBackend))
+  backend.start()
+
+  # The quota is 10% of the period and the pid was moved into the cgroup
+  assert(read_file(cgroupdir, "cpu.max") == "10000 100000\n")
+  assert(read_file(cgroupdir, "cgroup.procs") == "12345\n")
+
+  # Throttling that happened before start() isn't reported
+  assert(backend.enforce(1.0) == 0.0)
+
+  # The stop time is ignored.   The throttled time since the last call is
+  # reported.
+  write_file(cgroupdir, "cpu.stat", "usage_usec 900\nnr_periods 10\nnr_throttled 3\nthrottled_usec 252500\n")
+  assert(abs(backend.enforce(0.0) - 0.25) < 0.000001)
+  assert(backend.enforce(0.0) == 0.0)
+
+  # Very small limits get the smallest quota the kernel allows
+  cpu_enforcement.create_backend(12345, 0.001).start()
+  assert(read_file(cgroupdir, "cpu.max") == "1000 100000\n")
+
+  # A directory without the cpu controller is rejected
+  os.remove(os.path.join(cgroupdir, "cpu.max"))
+  try:
+    cpu_enforcement.create_backend(12345, 0.1).start()
+  except Exception, e:
+    assert("cpu.max" in str(e))
+  else:
+    print "A cgroup without cpu.max was accepted"
+
+  # The cgroup backend needs a directory
+  cpu_enforcement.cgroup_directory = None
+  try:
+    cpu_enforcement.create_backend(12345, 0.1)
+  except Exception:
+    pass
+  else:
+    print "The cgroup backend was created without a directory"
+
+finally:
+  shutil.rmtree(cgroupdir)
+
+# The signal backend is the default and doesn't stop repy if it needn't
+cpu_enforcement.backend_name = cpu_enforcement.DEFAULT_BACKEND
+backend = cpu_enforcement.create_backend(os.getpid(), 0.1)
+assert(isinstance(backend, cpu_enforcement.SignalCPUBackend))
+backend.start()
+assert(backend.enforce(0.0) == 0.0)
@@ -0,0 +1,94 @@
+"""
+Test that the running disk use total the nanny keeps as files are created,
+written, truncated and removed matches a scan of the directory.
+"""
+
+import os
+
+import restrictions
+import nanny
+import nanny_resource_limits
+import nonportable
+import emulfile
+
+
+def check(when):
+  scanned = nonportable.compute_disk_use('.')
+  if nanny.resource_consumption_table['diskused'] != scanned:
+    print "After", when, "the total was", nanny.resource_consumption_table['diskused'], "but the scan found", scanned
+
+
+restrictions.init_restriction_tables("restrictions.pythontests")
+nanny.initialize_consumed_resource_tables()
+
+filesizes = nonportable.get_disk_file_sizes('.')
+nanny_resource_limits.reconcile_disk_use(nanny_resource_limits.calculate_disk_use(filesizes), filesizes)
+check("the first scan")
+
+for oldfile in ["junk_diskuse.out", "junk_diskuse2.out"]:
+  if oldfile in filesizes:
+    emulfile.removefile(oldfile)
+    check("removing an old file")
+
+fileobj = emulfile.emulated_open("junk_diskuse.out", "w")
+check("creating a file")
+fileobj.write("X" * 1000)
+fileobj.writelines(["Y" * 100, "Z" * 10])
+fileobj.close()
+check("writing")
+
+# Writing over the start of a file doesn't make it larger
+fileobj = emulfile.emulated_open("junk_diskuse.out", "r+")
+fileobj.write("A" * 10)
+fileobj.close()
+check("overwriting")
+
+fileobj = emulfile.emulated_open("junk_diskuse.out", "a")
+fileobj.write("B" * 5000)
+fileobj.close()
+check("appending")
+
+fileobj = emulfile.emulated_open("junk_diskuse.out", "w")
+fileobj.close()
+check("truncating")
+
+emulfile.removefile("junk_diskuse.out")
+check("removing")
+
+# The resource monitor's scan replaces the file sizes too.   Make changes
+# outside of repy, then send the scan the way the monitor does.
+outsidefile = file("junk_diskuse.out", "w")
+outsidefile.write("C" * 3000)
+outsidefile.close()
+outsidefile = file("junk_diskuse2.out", "w")
+outsidefile.write("D" * 100)
+outsidefile.close()
+
+filesizes = nonportable.get_disk_file_sizes('.')
+(readhandle, writehandle) = os.pipe()
+try:
+  nonportable.write_message_to_pipe(writehandle, "diskused", (nanny_resource_limits.calculate_disk_use(filesizes), filesizes))
+  (channel, data) = nonportable.read_message_from_pipe(readhandle)
+  nonportable.IPC_HANDLER_FUNCTIONS[channel](data)
+finally:
+  os.close(readhandle)
+  os.close(writehandle)
+check("the monitor's scan")
+
+# A file only the monitor saw is removed
+emulfile.removefile("junk_diskuse.out")
+check("removing a file made outside of repy")
+
+# Writing over a file that grew outside of repy doesn't count it twice
+fileobj = emulfile.emulated_open("junk_diskuse2.out", "r+")
+fileobj.write("E" * 50)
+fileobj.close()
+check("overwriting a file made outside of repy")
+
+fileobj = emulfile.emulated_open("junk_diskuse2.out", "a")
+fileobj.write("F" * 50)
+fileobj.close()
+check("appending to a file made outside of repy")
+
+emulfile.removefile("junk_diskuse2.out")
+check("removing the last file")
@@ -0,0 +1,79 @@
+"""
+Test tattle_wait_for_item: a waiter blocked at the limit wakes when an item
+is removed, an item that is already held is added again at once, and
+removing an item twice only notifies a waiter once.
+"""
+
+import time
+import threading
+
+import restrictions
+import nanny
+
+
+# Two events
+restrictions.init_restriction_tables("restrictions.itemwait")
+nanny.initialize_consumed_resource_tables()
+
+events = nanny.resource_consumption_table['events']
+
+
+# Count the notifications
+condition = nanny.fungible_resource_condition_table['events']
+notifications = [0]
+realnotify = condition.notify
+def counting_notify(*args):
+  notifications[0] += 1
+  realnotify(*args)
+condition.notify = counting_notify
+
+
+# Waits for item in a thread and returns the thread
+def start_waiter(item):
+  waiter = threading.Thread(target=nanny.tattle_wait_for_item, args=('events', item))
+  waiter.setDaemon(True)
+  waiter.start()
+  return waiter
+
+# Waits until there are count waiters
+def wait_for_waiters(count):
+  for tries in range(100):
+    if nanny.fungible_resource_waiter_count['events'] == count:
+      return
+    time.sleep(0.01)
+  print "There are", nanny.fungible_resource_waiter_count['events'], "waiters instead of", count
+
+
+nanny.tattle_add_item('events', 'first')
+nanny.tattle_wait_for_item('events', 'second')
+assert(events == set(['first', 'second']))
+
+# Items that are held are added again at once, even at the limit
+nanny.tattle_add_item('events', 'first')
+nanny.tattle_wait_for_item('events', 'second')
+assert(events == set(['first', 'second']))
+
+# A waiter blocks at the limit and wakes when an item is removed
+waiter = start_waiter('third')
+wait_for_waiters(1)
+assert('third' not in events)
+nanny.tattle_remove_item('events', 'first')
+waiter.join(5)
+assert(not waiter.isAlive())
+assert(events == set(['second', 'third']))
+assert(notifications[0] == 1)
+
+# Removing an item that is gone doesn't notify the next waiter
+waiter = start_waiter('fourth')
+wait_for_waiters(1)
+nanny.tattle_remove_item('events', 'first')
+time.sleep(0.1)
+assert(notifications[0] == 1)
+assert(waiter.isAlive())
+assert(events == set(['second', 'third']))
+
+nanny.tattle_remove_item('events', 'third')
+waiter.join(5)
+assert(not waiter.isAlive())
+assert(events == set(['second', 'fourth']))
+assert(notifications[0] == 2)
@@ -0,0 +1,86 @@
+"""
+Test that the pi CPU governor keeps a simulated program that always wants
+the CPU (and one that only sometimes does) to its limit, even if the slices
+it runs for aren't all the same length.   Also test that its window
+statistics get through the pipe from the resource monitor.
+"""
+
+import os
+import random
+
+import cpu_enforcement
+import nonportable
+
+
+def simulate(cpulimit, demand, seconds, jitter=0.0):
+  # The slices are up to jitter times longer or shorter, like a monitor
+  # that doesn't wake up on time
+  slicerandom = random.Random(1)
+  governor = cpu_enforcement.PICPUGovernor(cpulimit)
+  now = 0.0
+  cputime = 0.0
+  while now < seconds:
+    # The program is stopped, then runs for a slice using demand of the CPU
+    now += governor.get_stop_time(now, cputime)
+    runtime = governor.slicetime * slicerandom.uniform(1.0 - jitter, 1.0 + jitter)
+    now += runtime
+    cputime += runtime * demand
+  return (cputime / now, governor.get_window_stats())
+
+
+for cpulimit in [0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.75]:
+  (share, stats) = simulate(cpulimit, 1.0, 60.0)
+  assert(abs(share - cpulimit) <= 0.02)
+
+  # Each window is within 2% after the first
+  assert(max([abs(error) for error in stats['errors'][1:]]) <= 0.02)
+
+  # A window ends at the first update after a second, so there are a few
+  # fewer than 60
+  assert(stats['windows'] >= 50)
+  assert(stats['stops'] > 0)
+  assert(stats['stops'] <= stats['updates'])
+
+  (share, stats) = simulate(cpulimit, 1.0, 60.0, jitter=0.5)
+  assert(abs(share - cpulimit) <= 0.02)
+  assert(max([abs(error) for error in stats['errors'][1:]]) <= 0.02)
+
+# A program that uses less than its limit is never stopped
+(share, stats) = simulate(0.5, 0.3, 10.0)
+assert(abs(share - 0.3) < 0.001)
+assert(stats['stops'] == 0)
+assert(stats['meanerror'] < 0)
+
+# The limit must be positive
+try:
+  cpu_enforcement.PICPUGovernor(0)
+except ValueError:
+  pass
+else:
+  print "A limit of 0 was allowed"
+
+
+# The monitor sends only the newest error.   Repy keeps the history.
+(share, stats) = simulate(0.3, 1.0, 5.0)
+assert(stats['windows'] >= 3)
+assert(nonportable.get_cpu_window_stats() is None)
+
+(readhandle, writehandle) = os.pipe()
+governor = cpu_enforcement.PICPUGovernor(0.3)
+for count in range(len(stats['errors'])):
+  # A window has finished
+  governor.windowcount = count + 1
+  governor.windowerrors = stats['errors'][:count + 1]
+  sent = governor.get_window_stats(history=1)
+  assert(sent['errors'] == [stats['errors'][count]])
+
+  nonportable.write_message_to_pipe(writehandle, "cpuwindowstats", sent)
+  (channel, data) = nonportable.read_message_from_pipe(readhandle)
+  nonportable.IPC_HANDLER_FUNCTIONS[channel](data)
+
+os.close(readhandle)
+os.close(writehandle)
+
+received = nonportable.get_cpu_window_stats()
+assert(received['errors'] == stats['errors'])
+assert(received['windows'] == len(stats['errors']))
@@ -0,0 +1,34 @@
+"""
+Test that a jump in the wall clock between reserve_quantity and
+commit_quantity doesn't skip the wait after the operation.
+"""
+
+import time
+
+import restrictions
+import nanny
+import nanny_resource_limits
+import nonportable
+
+
+# 10000 bytes of filewrite a second
+restrictions.init_restriction_tables("restrictions.reservation")
+nanny.initialize_consumed_resource_tables()
+
+# Writing 5000 bytes more than the burst allowance must be followed by a
+# wait of about half a second
+amount = 10000 * nanny_resource_limits.DEFAULT_BURST_SECONDS + 5000
+reservation = nanny.reserve_quantity('filewrite', amount)
+
+# The wall clock is set an hour ahead during the operation
+realtime = time.time
+time.time = lambda: realtime() + 3600.0
+try:
+  start = nonportable.getruntime()
+  nanny.commit_quantity(reservation, amount)
+  waited = nonportable.getruntime() - start
+finally:
+  time.time = realtime
+
+if waited < 0.3:
+  print "Only waited", waited, "seconds after the operation"
@@ -0,0 +1,107 @@
+"""
+Test the resolver cache with a stand-in resolver and clock: hits and misses,
+how long answers and unknown names are kept, least recently used eviction
+and that gethostbyname_ex only charges the network for a miss.
+"""
+
+import socket
+
+import restrictions
+import nanny
+import nonportable
+import resource_timeseries
+import emulcomm
+
+
+restrictions.init_restriction_tables("restrictions.pythontests")
+nanny.initialize_consumed_resource_tables()
+
+
+# The cache reads the time from nonportable.getruntime
+clock = [1000.0]
+nonportable.getruntime = lambda: clock[0]
+
+lookups = []
+def fake_resolver(name):
+  lookups.append(name)
+  if name.startswith('unknown'):
+    raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+  if name.startswith('broken'):
+    raise socket.gaierror(socket.EAI_AGAIN, 'Temporary failure in name resolution')
+  return (name, [], ['10.0.0.1'])
+
+def get_stats():
+  return (nonportable.resolver_cache_stats['resolverhits'], nonportable.resolver_cache_stats['resolvermisses'])
+
+
+cache = emulcomm.ResolverCache(fake_resolver, ttl=60.0, negativettl=10.0, size=256)
+
+# A miss, then a hit
+(hits, misses) = get_stats()
+assert(cache.lookup('a.com') == ('a.com', [], ['10.0.0.1']))
+assert(cache.lookup('a.com') == ('a.com', [], ['10.0.0.1']))
+assert(lookups == ['a.com'])
+assert(get_stats() == (hits + 1, misses + 1))
+
+# Answers expire after the TTL
+clock[0] += 59.0
+cache.lookup('a.com')
+assert(lookups == ['a.com'])
+clock[0] += 2.0
+cache.lookup('a.com')
+assert(lookups == ['a.com', 'a.com'])
+
+# Unknown names are remembered for the negative TTL
+del lookups[:]
+for count in range(2):
+  try:
+    cache.lookup('unknown.com')
+  except socket.gaierror, e:
+    assert(e.args[0] == socket.EAI_NONAME)
+  else:
+    print "An unknown name didn't raise an error"
+assert(lookups == ['unknown.com'])
+clock[0] += 11.0
+try:
+  cache.lookup('unknown.com')
+except socket.gaierror:
+  pass
+assert(lookups == ['unknown.com', 'unknown.com'])
+
+# Temporary failures aren't remembered
+del lookups[:]
+for count in range(2):
+  try:
+    cache.lookup('broken.com')
+  except socket.gaierror:
+    pass
+assert(lookups == ['broken.com', 'broken.com'])
+
+# When full, the least recently used name is forgotten
+cache.clear()
+for number in range(256):
+  cache.lookup('name' + str(number))
+cache.lookup('name0')
+cache.lookup('name256')
+assert(len(cache.entries) == 256)
+del lookups[:]
+cache.lookup('name0')
+cache.lookup('name2')
+assert(lookups == [])
+cache.lookup('name1')
+assert(lookups == ['name1'])
+
+
+# gethostbyname_ex charges 4096 bytes of netsend and netrecv for a miss and
+# nothing for a hit
+emulcomm.resolver_cache = emulcomm.ResolverCache(fake_resolver)
+del lookups[:]
+sent = resource_timeseries.use_totals['netsend']
+received = resource_timeseries.use_totals['netrecv']
+emulcomm.gethostbyname_ex('b.com')
+assert(resource_timeseries.use_totals['netsend'] == sent + 4096)
+assert(resource_timeseries.use_totals['netrecv'] == received + 4096)
+emulcomm.gethostbyname_ex('b.com')
+assert(resource_timeseries.use_totals['netsend'] == sent + 4096)
+assert(resource_timeseries.use_totals['netrecv'] == received + 4096)
+assert(lookups == ['b.com'])
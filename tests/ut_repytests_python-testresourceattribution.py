@@ -0,0 +1,79 @@
+"""
+Test that the nanny charges renewable resources to the API call and thread
+that used them, that refunds from commit_quantity add up, that the thread
+table is capped and that dump_call_attribution writes the rows.
+"""
+
+import os
+import tempfile
+import threading
+
+import restrictions
+import nanny
+import resource_attribution
+
+
+restrictions.init_restriction_tables("restrictions.pythontests")
+nanny.initialize_consumed_resource_tables()
+
+threading.currentThread().setName("tester")
+
+
+# Charges go to the call assertisallowed was last given, and to the thread
+restrictions.assertisallowed('sendmess')
+nanny.tattle_quantity('netsend', 100)
+nanny.tattle_quantity('netsend', 50)
+attribution = resource_attribution.get_call_attribution()
+assert(attribution['sendmess']['netsend'] == (2, 150, 0.0))
+attribution = resource_attribution.get_call_attribution(bythread=True)
+assert(attribution[('sendmess', 'tester')]['netsend'] == (2, 150, 0.0))
+
+# A reservation counts one operation and the amount actually used
+restrictions.assertisallowed('file.write')
+reservation = nanny.reserve_quantity('filewrite', 1000)
+nanny.commit_quantity(reservation, 400)
+reservation = nanny.reserve_quantity('filewrite', 1000)
+nanny.commit_quantity(reservation, 1000)
+attribution = resource_attribution.get_call_attribution()
+assert(attribution['file.write']['filewrite'] == (2, 1400, 0.0))
+assert(attribution['sendmess']['netsend'] == (2, 150, 0.0))
+
+
+# After MAX_THREAD_ROWS rows, new threads share one row.   The per-call
+# table still has everything.
+resource_attribution.MAX_THREAD_ROWS = len(resource_attribution.thread_table) + 1
+
+def charge():
+  restrictions.assertisallowed('sendmess')
+  nanny.tattle_quantity('netsend', 10)
+
+for threadname in ["first", "second", "third"]:
+  chargethread = threading.Thread(target=charge, name=threadname)
+  chargethread.start()
+  chargethread.join()
+
+attribution = resource_attribution.get_call_attribution(bythread=True)
+assert(attribution[('sendmess', 'first')]['netsend'] == (1, 10, 0.0))
+assert(('sendmess', 'second') not in attribution)
+assert(('sendmess', 'third') not in attribution)
+assert(attribution[('sendmess', resource_attribution.OTHER_THREADS)]['netsend'] == (2, 20, 0.0))
+assert(len(resource_attribution.thread_table) == resource_attribution.MAX_THREAD_ROWS + 1)
+attribution = resource_attribution.get_call_attribution()
+assert(attribution['sendmess']['netsend'] == (5, 180, 0.0))
+
+
+# The dump has a header and a row for each call, thread and resource
+(fd, dumpfilename) = tempfile.mkstemp()
+os.close(fd)
+try:
+  resource_attribution.dump_call_attribution(dumpfilename)
+  dumplines = file(dumpfilename).read().splitlines()
+finally:
+  os.remove(dumpfilename)
+
+assert(dumplines[0] == "call\tthread\tresource\toperations\tcharged\tblocked")
+rows = dumplines[1:]
+assert(len(rows) == len(resource_attribution.thread_table))
+assert("sendmess\ttester\tnetsend\t2\t150\t0.000000" in rows)
+assert("file.write\ttester\tfilewrite\t2\t1400\t0.000000" in rows)
+assert("sendmess\t" + resource_attribution.OTHER_THREADS + "\tnetsend\t2\t20\t0.000000" in rows)
@@ -0,0 +1,42 @@
+"""
+Test that the resource use samples keep the newest samples, that a dump
+reads back the same and that dump_at_exit writes to dump_filename.
+"""
+
+import os
+import tempfile
+
+import resource_timeseries
+
+
+resource_timeseries.init(['netsend'])
+
+# The ring keeps the newest samples, oldest first
+ring = resource_timeseries.ResourceRing(3)
+for count in range(5):
+  ring.add(float(count), count * 10.0, count / 10.0)
+assert(ring.get_samples() == [(2.0, 20.0, 0.2), (3.0, 30.0, 0.3), (4.0, 40.0, 0.4)])
+
+resource_timeseries.rings['netsend'] = ring
+resource_timeseries.sample_interval = 0.5
+
+(fd, dumpfilename) = tempfile.mkstemp()
+os.close(fd)
+try:
+  # Nothing is written unless a file was given
+  resource_timeseries.dump_filename = None
+  resource_timeseries.dump_at_exit()
+  assert(os.path.getsize(dumpfilename) == 0)
+
+  resource_timeseries.dump_filename = dumpfilename
+  resource_timeseries.dump_at_exit()
+  (interval, samples) = resource_timeseries.load_timeseries(dumpfilename)
+  assert(interval == 0.5)
+  assert(samples == {'netsend': ring.get_samples()})
+
+  # A file that can't be written doesn't raise an exception at exit
+  resource_timeseries.dump_filename = os.path.join(dumpfilename, "notadirectory")
+  resource_timeseries.dump_at_exit()
+
+finally:
+  os.remove(dumpfilename)
@@ -0,0 +1,52 @@
+"""
+Test that sendmess reuses a pooled socket when no local port is given and
+that the pooled socket is closed once it has been idle for
+SEND_SOCKET_IDLE_TIME, even if nothing is sent again.
+"""
+
+import time
+import socket
+
+import restrictions
+import nanny
+import emulcomm
+
+
+restrictions.init_restriction_tables("restrictions.pythontests")
+nanny.initialize_consumed_resource_tables()
+
+emulcomm.SEND_SOCKET_IDLE_TIME = 0.5
+
+# A plain socket receives the messages, so we can see which port sent them
+receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+receiver.bind(('127.0.0.1', 0))
+destport = receiver.getsockname()[1]
+
+emulcomm.sendmess('127.0.0.1', destport, 'first')
+assert(len(emulcomm.send_socket_pool[None]) == 1)
+pooledsocket = emulcomm.send_socket_pool[None][0][0]
+assert(emulcomm.send_socket_evictor is not None)
+
+# The same socket sends the next message
+emulcomm.sendmess('127.0.0.1', destport, 'second')
+assert(len(emulcomm.send_socket_pool[None]) == 1)
+assert(emulcomm.send_socket_pool[None][0][0] is pooledsocket)
+
+receiver.settimeout(5)
+(first, firstaddress) = receiver.recvfrom(100)
+(second, secondaddress) = receiver.recvfrom(100)
+assert(first == 'first' and second == 'second')
+assert(firstaddress == secondaddress)
+
+# After the idle time it is closed without another sendmess
+time.sleep(1.5)
+assert(None not in emulcomm.send_socket_pool)
+assert(emulcomm.send_socket_evictor is None)
+try:
+  pooledsocket.fileno()
+except socket.error:
+  pass
+else:
+  print "The idle pooled socket wasn't closed"
+
+receiver.close()
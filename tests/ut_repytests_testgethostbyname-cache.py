@@ -0,0 +1,15 @@
+#pragma repy
+
+# A name looked up twice should get the same answer, and changing an answer
+# must not change what the resolver cache returns.   localhost is used so
+# that no network is needed.
+
+first = gethostbyname_ex('localhost')
+second = gethostbyname_ex('localhost')
+
+if first != second:
+  print "The cached answer",second,"differs from",first
+
+second[1].append('notanalias')
+if gethostbyname_ex('localhost') != first:
+  print "Changing a returned answer changed the cache"
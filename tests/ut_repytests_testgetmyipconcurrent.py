@@ -0,0 +1,23 @@
+#pragma repy
+
+# Several events calling getmyip at once should all get the same answer.
+
+def askforip():
+  ip = getmyip()
+  mycontext['lock'].acquire()
+  mycontext['ips'].append(ip)
+  mycontext['lock'].release()
+
+
+if callfunc == 'initialize':
+  mycontext['ips'] = []
+  mycontext['lock'] = getlock()
+  for count in range(5):
+    settimer(0, askforip, ())
+  sleep(2)
+
+  if len(mycontext['ips']) != 5:
+    print "Only",len(mycontext['ips']),"of 5 getmyip calls returned"
+  for ip in mycontext['ips']:
+    if ip != getmyip():
+      print "getmyip returned",ip,"and",getmyip()
@@ -0,0 +1,58 @@
+#pragma repy
+
+# Opens several connections at once with openconn_async.   They should all
+# be delivered to the callback, along with an error for a port nobody is
+# listening on.
+
+def echo(remoteip, remoteport, sockobj, thiscommhandle, listencommhandle):
+  try:
+    sockobj.send(sockobj.recv(5))
+  except Exception:
+    # The connection that was stopped may get here and be closed
+    pass
+
+
+def connected(desthost, destport, sockobj, commhandle, error):
+  mycontext['lock'].acquire()
+  if destport == <connport>:
+    if error is not None:
+      print "Unexpected error",error
+    else:
+      sockobj.send("hello")
+      if sockobj.recv(5) != "hello":
+        print "Bad echo"
+      sockobj.close()
+      mycontext['connected'] = mycontext['connected'] + 1
+  else:
+    if sockobj is not None or error is None:
+      print "Connecting to a closed port should fail"
+    mycontext['failed'] = mycontext['failed'] + 1
+  mycontext['lock'].release()
+
+
+def check_and_exit():
+  if mycontext['connected'] != 3:
+    print "Only",mycontext['connected'],"of 3 connections were opened"
+  if mycontext['failed'] != 1:
+    print "Got",mycontext['failed'],"failures instead of 1"
+  exitall()
+
+
+if callfunc == 'initialize':
+  mycontext['connected'] = 0
+  mycontext['failed'] = 0
+  mycontext['lock'] = getlock()
+
+  waitforconn('127.0.0.1', <connport>, echo)
+
+  for count in range(3):
+    openconn_async('127.0.0.1', <connport>, connected)
+
+  # Nobody is listening on the messport
+  openconn_async('127.0.0.1', <messport>, connected)
+
+  # A connection that is stopped before it is open is never reported
+  handle = openconn_async('127.0.0.1', <connport>, connected)
+  stopcomm(handle)
+
+  settimer(3, check_and_exit, ())
@@ -0,0 +1,37 @@
+#pragma repy
+
+# openconn_async with the local port of a connection that was just closed
+# returns right away.   The SocketSelector waits for the old socket instead.
+
+def echo(remoteip, remoteport, sockobj, thiscommhandle, listencommhandle):
+  pass
+
+
+def connected(desthost, destport, sockobj, commhandle, error):
+  mycontext['error'] = error
+  if sockobj is not None:
+    sockobj.close()
+
+
+def check_and_exit():
+  if 'error' not in mycontext:
+    print "The connection was never reported"
+  elif mycontext['error'] is not None and "socket cleanup" not in mycontext['error']:
+    print "Unexpected error", mycontext['error']
+  exitall()
+
+
+if callfunc == 'initialize':
+  ip = getmyip()
+  waitforconn('127.0.0.1', <connport>, echo)
+
+  # We close first, so our end stays around for a while
+  sockobj = openconn('127.0.0.1', <connport>, ip, <connport>)
+  sockobj.close()
+
+  start = getruntime()
+  openconn_async('127.0.0.1', <connport>, connected, ip, <connport>, timeout=1)
+  if getruntime() - start > 0.5:
+    print "openconn_async waited for the old socket"
+
+  settimer(3, check_and_exit, ())
@@ -0,0 +1,42 @@
+#pragma repy
+
+# Receive into a buffer from createbuffer() in several pieces
+
+def foo(ip,port,sockobj, ch,mainch):
+  for piece in ["Hello", " ", "World"]:
+    sockobj.send(piece)
+    sleep(.05)
+
+  stopcomm(mainch)
+  stopcomm(ch)
+
+
+if callfunc == 'initialize':
+  waitforconn('127.0.0.1',<connport>,foo)
+  sleep(.2)
+  sockobj = openconn('127.0.0.1',<connport>)
+
+  buf = createbuffer(20)
+  if buf.getsize() != 20:
+    print "Wrong buffer size", buf.getsize()
+
+  received = 0
+  while received < 11:
+    received = received + sockobj.recv_into(buf, 11 - received, received)
+
+  if buf.getdata(0, received) != "Hello World":
+    print 'Error: data did not match "Hello World":', buf.getdata(0, received)
+
+  # The rest of the buffer should be untouched
+  if buf.getdata(received) != "\x00" * 9:
+    print "Error: data was written past the end"
+
+  # Data that doesn't fit is an error
+  try:
+    sockobj.recv_into(buf, 10, 15)
+  except ValueError:
+    pass
+  else:
+    print "Receiving past the end of the buffer didn't raise ValueError"
+
+  sockobj.close()
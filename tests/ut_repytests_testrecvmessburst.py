@@ -0,0 +1,29 @@
+#pragma repy
+
+# Send a burst of messages to a handler that is slow.   There are more
+# messages than events, so most of them have to wait to be delivered, but
+# none of them should be lost.
+
+def slowhandler(ip,port,mess, ch):
+  sleep(.05)
+  mycontext['lock'].acquire()
+  mycontext['received'] = mycontext['received'] + 1
+  mycontext['lock'].release()
+
+
+def check_and_exit():
+  if mycontext['received'] != 200:
+    print "Only received",mycontext['received'],"of 200 messages"
+  exitall()
+
+
+if callfunc == 'initialize':
+  mycontext['received'] = 0
+  mycontext['lock'] = getlock()
+  settimer(5, check_and_exit, ())
+  recvmess('127.0.0.1',<messport>,slowhandler)
+  for count in range(200):
+    sendmess('127.0.0.1',<messport>,'hello')
+    # Give the selector a chance to read them, even on a busy machine
+    if count % 50 == 49:
+      sleep(.1)
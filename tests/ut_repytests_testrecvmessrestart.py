@@ -0,0 +1,36 @@
+#pragma repy
+
+# Stop listening on a port and listen on it again.   Messages sent to the new
+# handler must still be delivered.
+
+def first(ip,port,mess, ch):
+  print "The stopped handler got a message"
+
+def second(ip,port,mess, ch):
+  mycontext['lock'].acquire()
+  mycontext['received'] = mycontext['received'] + 1
+  received = mycontext['received']
+  mycontext['lock'].release()
+  if received == 10:
+    stopcomm(ch)
+
+
+def check_and_exit():
+  if mycontext['received'] != 10:
+    print "Only received",mycontext['received'],"of 10 messages"
+  exitall()
+
+
+if callfunc == 'initialize':
+  mycontext['received'] = 0
+  mycontext['lock'] = getlock()
+
+  # Set the timer first.   The handlers may use up the events later.
+  settimer(2, check_and_exit, ())
+
+  ch = recvmess('127.0.0.1',<messport>,first)
+  stopcomm(ch)
+  recvmess('127.0.0.1',<messport>,second)
+  for count in range(10):
+    sendmess('127.0.0.1',<messport>,'hi')
+    sleep(.01)
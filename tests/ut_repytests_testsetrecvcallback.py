@@ -0,0 +1,42 @@
+#pragma repy
+
+# The server doesn't keep a thread for each connection.   It sets a recv
+# callback on each one and echoes whatever arrives.
+
+def echodata(sockobj):
+  try:
+    data = sockobj.recv(1024)
+  except Exception:
+    # The client closed the connection
+    sockobj.close()
+    return
+  sockobj.send(data)
+
+
+def newconn(remoteip, remoteport, sockobj, thiscommhandle, listencommhandle):
+  sockobj.setrecvcallback(echodata)
+
+
+if callfunc == 'initialize':
+  waitforconn('127.0.0.1', <connport>, newconn)
+
+  clients = []
+  for count in range(3):
+    clients.append(openconn('127.0.0.1', <connport>))
+
+  # Several messages on each connection, interleaved
+  for message in ["first", "second", "third"]:
+    for sockobj in clients:
+      sockobj.send(message)
+    for sockobj in clients:
+      data = ""
+      while len(data) < len(message):
+        data = data + sockobj.recv(len(message) - len(data))
+      if data != message:
+        print "Expected",message,"got",data
+
+  for sockobj in clients:
+    sockobj.close()
+
+  sleep(.5)
+  exitall()
@@ -0,0 +1,35 @@
+#pragma repy
+
+# Send a header and a body with one sendmany call
+
+def foo(ip,port,sockobj, ch,mainch):
+  data = ""
+  while len(data) < 11:
+    data = data + sockobj.recv(4096)
+
+  if data != "Hello World":
+    print 'Error: data did not match "Hello World":', data
+
+  stopcomm(mainch)
+  stopcomm(ch)
+
+
+if callfunc == 'initialize':
+  waitforconn('127.0.0.1',<connport>,foo)
+  sleep(.2)
+  sockobj = openconn('127.0.0.1',<connport>)
+
+  sent = sockobj.sendmany(["Hello", " ", "World"])
+  if sent != 11:
+    print "sendmany sent",sent,"bytes, not 11"
+
+  # Only strings may be sent
+  try:
+    sockobj.sendmany(["Hello", 5])
+  except TypeError:
+    pass
+  else:
+    print "sendmany accepted a list with a number in it"
+
+  sleep(.2)
+  sockobj.close()
@@ -0,0 +1,33 @@
+#pragma repy restrictions.autotunebuffers
+
+# The buffers start at 4096 bytes (the kernel may double that), so a send
+# can't take more than about 8K.   Once auto-tuning grows the send buffer,
+# larger sends should go through.
+
+def handleconnection(ip, port, connobj, ch, mainch):
+  while True:
+    connobj.recv(100000)
+
+
+def check_and_exit():
+  print "The send buffer never grew: largest send was", mycontext['largest']
+  exitall()
+
+
+if callfunc == 'initialize':
+  mycontext['largest'] = 0
+  ip = '127.0.0.1'
+  waitforconn(ip, <connport>, handleconnection)
+  clientsockobj = openconn(ip, <connport>)
+  timer = settimer(10.0, check_and_exit, ())
+
+  message = "X" * 100000
+  while True:
+    sent = clientsockobj.send(message)
+    if sent > mycontext['largest']:
+      mycontext['largest'] = sent
+    if mycontext['largest'] > 16384:
+      break
+
+  canceltimer(timer)
+  exitall()